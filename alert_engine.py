@@ -0,0 +1,406 @@
+"""
+Evaluation of the ALERT-RULES sheet against a keen report.
+
+Each rule's formula, e.g. `(data["playerload"] > 1000) & (data["errorpage"] > 5)`,
+is parsed once with `ast`, checked against the small expression language the
+sheet uses and compiled into a function of the report's columns. As in
+`pd.eval`, which evaluated the rules before, `&` and `|` bind looser than
+comparisons, so `data["a"] > 1 & data["b"] < 2` is `(a > 1) & (b < 2)`. Compiled
+rules are cached by name and formula, so a cycle only compiles the rules
+that changed. All rules are evaluated over one shared set of numpy column
+arrays, without copying the report, and subexpressions that several rules
+share are computed once per evaluation.
+"""
+import ast
+import operator
+import tokenize
+from collections import Counter
+from warnings import warn
+
+import numpy as np
+import pandas as pd
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+class AlertRuleError(ValueError):
+    pass
+
+
+_compare_ops = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt,
+    ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge}
+
+_binary_ops = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.Mod: operator.mod, ast.Pow: operator.pow}
+
+_unary_ops = {
+    ast.Not: np.logical_not, ast.Invert: np.logical_not,
+    ast.USub: operator.neg, ast.UAdd: operator.pos}
+
+_names = {'True': True, 'False': False}
+_text = (str, type(u''))
+# node types that only exist in some python versions
+_Num = getattr(ast, 'Num', ())
+_Str = getattr(ast, 'Str', ())
+_Index = getattr(ast, 'Index', ())
+
+
+def _constant(node):
+    """The value of a literal node, or raise KeyError. Handles the node types
+    of both python 2 and 3."""
+    if type(node).__name__ in ('Constant', 'NameConstant'):
+        return node.value
+    if isinstance(node, _Num):
+        return node.n
+    if isinstance(node, _Str):
+        return node.s
+    if isinstance(node, ast.Name) and node.id in _names:
+        return _names[node.id]
+    raise KeyError(node)
+
+
+def _column_name(node):
+    """'col' for a data["col"] node, or None"""
+    if not (isinstance(node, ast.Subscript) and
+            isinstance(node.value, ast.Name) and node.value.id == 'data'):
+        return None
+    index = node.slice
+    if isinstance(index, _Index):
+        index = index.value
+    try:
+        name = _constant(index)
+    except KeyError:
+        return None
+    return name if isinstance(name, _text) else None
+
+
+class SharedResults(dict):
+    """Results of the subexpressions in `shared`, kept while several rules
+    are evaluated on the same columns"""
+
+    def __init__(self, shared=()):
+        dict.__init__(self)
+        self.shared = frozenset(shared)
+
+
+class _Compiler(object):
+
+    def __init__(self, formula, functions=None):
+        self.formula = formula
+        self.functions = functions or {}
+        self.columns = set()
+        self.keys = set()
+
+    def fail(self, node, what):
+        raise AlertRuleError("{} not allowed in formula '{}'".format(
+            what, self.formula))
+
+    def compile(self, node):
+        """func(columns, memo) evaluating a node. A node is identified by
+        its ast dump, and the results of nodes in memo.shared are kept in
+        memo so a subexpression several rules share is computed once."""
+        key = ast.dump(node)
+
+        def memoized(func):
+            self.keys.add(key)
+
+            def evaluate(columns, memo):
+                if key in memo:
+                    return memo[key]
+                result = func(columns, memo)
+                if key in memo.shared:
+                    memo[key] = result
+                return result
+            return evaluate
+
+        column = _column_name(node)
+        if column is not None:
+            self.columns.add(column)
+            return lambda columns, memo: columns[column]
+
+        try:
+            value = _constant(node)
+        except KeyError:
+            pass
+        else:
+            return lambda columns, memo: value
+
+        if isinstance(node, ast.Expression):
+            return self.compile(node.body)
+
+        if isinstance(node, ast.Compare):
+            left = self.compile(node.left)
+            parts = []
+            for op, right in zip(node.ops, node.comparators):
+                if type(op) not in _compare_ops:
+                    self.fail(node, type(op).__name__)
+                parts.append((_compare_ops[type(op)], self.compile(right)))
+
+            def compare(columns, memo):
+                result = None
+                a = left(columns, memo)
+                for op, right in parts:
+                    b = right(columns, memo)
+                    check = op(a, b)
+                    result = check if result is None else \
+                        np.logical_and(result, check)
+                    a = b
+                return result
+            return memoized(compare)
+
+        if isinstance(node, ast.BoolOp):
+            combine = np.logical_and if isinstance(node.op, ast.And) \
+                else np.logical_or
+            values = [self.compile(v) for v in node.values]
+
+            def boolop(columns, memo):
+                result = values[0](columns, memo)
+                for value in values[1:]:
+                    result = combine(result, value(columns, memo))
+                return result
+            return memoized(boolop)
+
+        if isinstance(node, ast.BinOp):
+            if type(node.op) not in _binary_ops:
+                self.fail(node, type(node.op).__name__)
+            op = _binary_ops[type(node.op)]
+            left, right = self.compile(node.left), self.compile(node.right)
+            return memoized(
+                lambda columns, memo: op(left(columns, memo),
+                                         right(columns, memo)))
+
+        if isinstance(node, ast.UnaryOp):
+            if type(node.op) not in _unary_ops:
+                self.fail(node, type(node.op).__name__)
+            op = _unary_ops[type(node.op)]
+            operand = self.compile(node.operand)
+            return memoized(lambda columns, memo: op(operand(columns, memo)))
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+                and node.func.id in self.functions and not node.keywords \
+                and getattr(node, 'starargs', None) is None \
+                and getattr(node, 'kwargs', None) is None:
+            func = self.functions[node.func.id]
+            args = [self.compile(a) for a in node.args]
+            return memoized(
+                lambda columns, memo: func(columns,
+                                           *[a(columns, memo) for a in args]))
+
+        self.fail(node, type(node).__name__)
+
+
+def _replace_booleans(formula):
+    """The formula with `&` and `|` written as `and` and `or`, which python
+    parses with the precedence pd.eval gives `&` and `|`"""
+    tokens = []
+    for token in tokenize.generate_tokens(StringIO(formula).readline):
+        kind, value = token[0], token[1]
+        if kind == tokenize.OP and value in ('&', '|'):
+            kind, value = tokenize.NAME, 'and' if value == '&' else 'or'
+        tokens.append((kind, value))
+    return tokenize.untokenize(tokens)
+
+
+def compile_formula(formula, functions=None):
+    """
+    Compile a formula over data["<column>"] references
+
+    Parameters
+    ----------
+    formula : str
+    functions : dict
+        {name: func(columns, *args)} callable from the formula
+
+    Returns
+    -------
+    (callable, set, set)
+        func(columns, memo), the columns it reads and its subexpression keys,
+        see SharedResults
+
+    Raises
+    ------
+    AlertRuleError
+        if the formula can't be parsed or uses anything not allowed
+    """
+    try:
+        tree = ast.parse(_replace_booleans(formula.strip()), mode='eval')
+    except (SyntaxError, tokenize.TokenError) as e:
+        raise AlertRuleError("can't parse formula '{}': {}".format(formula, e))
+    compiler = _Compiler(formula, functions)
+    return compiler.compile(tree), compiler.columns, compiler.keys
+
+
+class CompiledRule(object):
+    """One alert rule, ready to be evaluated
+
+    Attributes
+    ----------
+    name : str
+    formula : str
+    columns : set of str
+        report columns the formula reads
+    keys : set of str
+        its subexpressions, see SharedResults
+    """
+
+    def __init__(self, name, formula):
+        self.name = name
+        self.formula = formula
+        self._evaluate, self.columns, self.keys = compile_formula(formula)
+
+    def __repr__(self):
+        return '<CompiledRule {}: {}>'.format(self.name, self.formula)
+
+    def evaluate(self, columns, memo=None):
+        """Boolean array of the rows the rule fires on
+
+        Parameters
+        ----------
+        columns : dict
+            {column name: np.ndarray}
+        memo : SharedResults
+            subexpression results shared between rules evaluated on the same
+            columns
+        """
+        n = len(next(iter(columns.values()))) if columns else 0
+        with np.errstate(all='ignore'):
+            result = self._evaluate(
+                columns, SharedResults() if memo is None else memo)
+        result = np.asarray(result)
+        if result.ndim == 0:
+            result = np.repeat(result, n)
+        if result.dtype == bool:
+            # the caller may modify it, and it can be a shared result
+            return result.copy()
+        # NaN from arithmetic on missing counts never fires
+        return result.astype(bool) & ~pd.isnull(result)
+
+
+_compiled = {}
+
+
+def compile_rules(rules):
+    """
+    Compile the rows of the ALERT-RULES sheet, reusing rules compiled for
+    earlier cycles. Rules whose formula can't be compiled are skipped with a
+    warning.
+
+    Parameters
+    ----------
+    rules : pd.DataFrame
+        with 'alertName' and 'formula' columns
+
+    Returns
+    -------
+    list of CompiledRule
+    """
+    compiled = []
+    for name, formula in zip(rules['alertName'], rules['formula']):
+        key = (name, formula)
+        if key not in _compiled:
+            try:
+                _compiled[key] = CompiledRule(name, formula)
+            except AlertRuleError as e:
+                warn("skipping alert rule '{}': {}".format(name, e))
+                continue
+        compiled.append(_compiled[key])
+    return compiled
+
+
+def exclusion_mask(campaigns, exclusions, names):
+    """
+    Which campaigns each rule must ignore, as a boolean (rule x campaign)
+    matrix
+
+    Parameters
+    ----------
+    campaigns : np.ndarray
+        distinct campaigns of the report
+    exclusions : pd.DataFrame
+        'campaign' and one boolean 'exclude-<alertName>' column per rule, as
+        returned by run_alerts.get_alert_exclusions
+    names : list of str
+        distinct alert names
+
+    Returns
+    -------
+    np.ndarray
+        shape (len(names), len(campaigns)). Campaigns missing from
+        `exclusions` are never excluded
+    """
+    columns = ['exclude-' + n for n in names]
+    present = [c for c in columns if c in exclusions.columns]
+    table = exclusions[['campaign'] + present].copy()
+    for c in present:
+        table[c] = table[c].fillna(False).astype(bool)
+    for c in set(columns) - set(present):
+        table[c] = False
+    if table['campaign'].duplicated().any():
+        # a campaign listed twice is excluded if either row says so
+        table = table.groupby('campaign')[columns].max()
+    else:
+        table = table.set_index('campaign')[columns]
+
+    rows = table.index.get_indexer(campaigns)
+    listed = rows >= 0
+    mask = np.zeros((len(names), len(campaigns)), dtype=bool)
+    mask[:, listed] = table.values.astype(bool)[rows[listed]].T
+    return mask
+
+
+def evaluate_rules(data, rules, exclusions):
+    """
+    Evaluate every alert rule against a report in one pass
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        keen report with a 'campaign' column
+    rules : pd.DataFrame or list of CompiledRule
+    exclusions : pd.DataFrame
+        see `exclusion_mask`
+
+    Returns
+    -------
+    list of (str, list)
+        (alertName, sorted campaigns it fired for), for the rules that fired
+    """
+    if isinstance(rules, pd.DataFrame):
+        rules = compile_rules(rules)
+    if not rules:
+        return []
+    needed = set().union(*[r.columns for r in rules])
+    missing = needed - set(data.columns)
+    if missing:
+        raise AlertRuleError('alert rules use columns missing from the '
+                             'report: {}'.format(sorted(missing)))
+    columns = dict((c, data[c].values) for c in needed)
+    # sorted, so each rule's campaigns come out sorted
+    codes, campaigns = pd.factorize(data['campaign'].values, sort=True)
+    campaigns = np.asarray(campaigns, dtype=object)
+    names = []
+    for rule in rules:
+        if rule.name not in names:
+            names.append(rule.name)
+    position = dict((name, j) for j, name in enumerate(names))
+    excluded = exclusion_mask(campaigns, exclusions, names)
+
+    uses = Counter(key for rule in rules for key in rule.keys)
+    memo = SharedResults(key for key, n in uses.items() if n > 1)
+    fired = []
+    fired_campaigns = np.zeros(len(campaigns), dtype=bool)
+    for rule in rules:
+        hits = codes[rule.evaluate(columns, memo)]
+        if not len(hits):
+            continue
+        fired_campaigns[:] = False
+        fired_campaigns[hits[hits >= 0]] = True
+        fired_campaigns &= ~excluded[position[rule.name]]
+        if fired_campaigns.any():
+            fired.append((rule.name, campaigns[fired_campaigns].tolist()))
+    return fired
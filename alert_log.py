@@ -0,0 +1,124 @@
+"""
+Which alerts have been texted recently, kept in a local sqlite file so that a
+restart of always_on_alerts doesn't text every active alert again.
+
+Each alert is keyed by its rule and campaign. A rule that keeps firing for a
+campaign is texted once per `keep` seconds, while a campaign newly firing for
+the same rule is texted right away. Entries older than `keep` can never
+suppress an alert again and are deleted as the log is used, so the file stays
+the size of one alert window.
+"""
+import os
+import sqlite3
+import threading
+from time import time
+
+
+DEFAULT_ALERT_LOG_PATH = os.path.expanduser('~/keen-alert-log.db')
+KEEP_ALERT_TIME = 60*60 # seconds
+COMPACT_INTERVAL = 60*5 # seconds between deletes of expired entries
+
+
+class AlertLog(object):
+    """
+    Alerts sent within the last `keep` seconds
+
+    Parameters
+    ----------
+    path : str
+        sqlite file, ':memory:' for a log that isn't kept
+    keep : int
+        seconds an alert is not re-sent for
+    compact_interval : int
+        seconds between deletes of expired entries
+    """
+
+    def __init__(self, path=DEFAULT_ALERT_LOG_PATH, keep=KEEP_ALERT_TIME,
+                 compact_interval=COMPACT_INTERVAL):
+        self.path = path
+        self.keep = keep
+        self.compact_interval = compact_interval
+        self.compacted = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sent ("
+            "rule TEXT, campaign TEXT, sent REAL, "
+            "PRIMARY KEY (rule, campaign))")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS sent_time ON sent (sent)")
+        self._conn.commit()
+
+    def _compact(self, now):
+        if now - self.compacted < self.compact_interval:
+            return
+        self.compacted = now
+        self._conn.execute("DELETE FROM sent WHERE sent <= ?",
+                           (now - self.keep,))
+
+    def was_sent(self, rule, campaign, now=None):
+        """Whether the alert was sent within the last `keep` seconds"""
+        now = time() if now is None else now
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sent FROM sent WHERE rule = ? AND campaign = ?",
+                (rule, campaign)).fetchone()
+        return row is not None and now - row[0] < self.keep
+
+    def new_alerts(self, fired, now=None):
+        """
+        Filter fired alerts down to the ones to send, and log them as sent
+
+        Parameters
+        ----------
+        fired : list of (str, list)
+            (alertName, campaigns) as returned by
+            alert_engine.evaluate_rules
+        now : float
+            unix time, defaults to now
+
+        Returns
+        -------
+        list of (str, list)
+            (alertName, campaigns not alerted on within `keep` seconds), for
+            the rules that have any
+        """
+        now = time() if now is None else now
+        to_send = []
+        with self._lock:
+            self._compact(now)
+            for rule, campaigns in fired:
+                new = []
+                for campaign in campaigns:
+                    row = self._conn.execute(
+                        "SELECT sent FROM sent WHERE rule = ? AND "
+                        "campaign = ?", (rule, campaign)).fetchone()
+                    if row is None or now - row[0] >= self.keep:
+                        new.append(campaign)
+                if new:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO sent (rule, campaign, sent) "
+                        "VALUES (?, ?, ?)", [(rule, c, now) for c in new])
+                    to_send.append((rule, new))
+            self._conn.commit()
+        return to_send
+
+    def forget(self, rule, campaign=None):
+        """Let an alert, or all of a rule's alerts, be sent again"""
+        with self._lock:
+            if campaign is None:
+                self._conn.execute("DELETE FROM sent WHERE rule = ?", (rule,))
+            else:
+                self._conn.execute(
+                    "DELETE FROM sent WHERE rule = ? AND campaign = ?",
+                    (rule, campaign))
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM sent").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
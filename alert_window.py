@@ -0,0 +1,119 @@
+import json
+import re
+import threading
+
+import pandas as pd
+
+from keen_queries import (query_spec, result_to_frame, string_types,
+                          sum_by_groups)
+
+
+WINDOW_MINUTES = 60
+REFETCH_MINUTES = 2 # re-read the newest minutes to pick up late events
+KEEN_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+
+_previous_minutes = re.compile(r'^previous_(\d+)_minutes?$')
+
+
+class _MinuteBuffer(object):
+    """Per-minute grouped counts for one event/group_by/filters"""
+
+    def __init__(self):
+        self.minutes = {}
+        self.end = None
+        self.lock = threading.Lock()
+
+    def add(self, intervals):
+        for interval in intervals:
+            minute = pd.Timestamp(interval['timeframe']['start'])
+            values = interval['value']
+            if not isinstance(values, list):
+                # ungrouped interval results are a bare count
+                values = [{'result': values}]
+            self.minutes[minute] = values
+
+    def evict(self, before):
+        for minute in [m for m in self.minutes if m < before]:
+            del self.minutes[minute]
+
+    def records(self, start, end):
+        records = []
+        for minute, values in self.minutes.items():
+            if start <= minute < end:
+                records.extend(values)
+        return records
+
+
+class MinuteWindowClient(object):
+    """Wrap a KeenClient so that rolling `previous_N_minutes` counts are kept
+    up to date incrementally.
+
+    Per-minute grouped counts are held in memory for the last `minutes`
+    minutes. Each `count` for a previous_N_minutes timeframe only queries keen
+    (with a minutely interval) for the minutes since the last call, plus the
+    newest `refetch` minutes again, and returns the rolling sum in the same
+    shape keen would. Keep one instance alive between polls; `client` can be
+    swapped for a fresh KeenClient on each poll. Other timeframes and
+    attributes go straight to the wrapped client.
+    """
+
+    def __init__(self, client=None, minutes=WINDOW_MINUTES,
+                 refetch=REFETCH_MINUTES):
+        self.client = client
+        self.minutes = minutes
+        self.refetch = refetch
+        self.buffers = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _buffer(self, event_collection, timezone, filters, by):
+        key = json.dumps([event_collection, timezone, filters or [], by],
+                         sort_keys=True)
+        with self._lock:
+            return self.buffers.setdefault(key, _MinuteBuffer())
+
+    def count(self, event_collection, timeframe=None, timezone=None,
+              interval=None, filters=None, group_by=None, now=None, **kwargs):
+        match = None
+        if not isinstance(timeframe, dict) and timeframe:
+            match = _previous_minutes.match(timeframe)
+        n = int(match.group(1)) if match else None
+        if n is None or n > self.minutes or interval or kwargs:
+            return self.client.count(event_collection, timeframe=timeframe,
+                                     timezone=timezone, interval=interval,
+                                     filters=filters, group_by=group_by,
+                                     **kwargs)
+
+        if isinstance(group_by, string_types):
+            group_by = [group_by]
+        by = list(group_by or [])
+        now = now if now is not None else pd.Timestamp.utcnow()
+        end = now.floor('min')
+        start = end - pd.Timedelta(minutes=n)
+        buf = self._buffer(event_collection, timezone, filters, by)
+        with buf.lock:
+            fetch_start = end - pd.Timedelta(minutes=self.minutes)
+            if buf.end is not None:
+                fetch_start = max(fetch_start,
+                                  buf.end - pd.Timedelta(minutes=self.refetch))
+            if fetch_start < end:
+                spec = query_spec(
+                    {'start': fetch_start.strftime(KEEN_TIME_FORMAT),
+                     'end': end.strftime(KEEN_TIME_FORMAT)},
+                    timezone, filters, by)
+                buf.add(self.client.count(event_collection=event_collection,
+                                          interval='minutely', **spec))
+                buf.end = end
+            buf.evict(end - pd.Timedelta(minutes=self.minutes))
+            records = buf.records(start, end)
+
+        if not by:
+            return sum(r['result'] for r in records)
+        data = sum_by_groups(result_to_frame(records, 'result', by), by,
+                             ['result'])
+        records = data.to_dict('records')
+        for r in records:
+            r['result'] = int(r['result'])
+        return records
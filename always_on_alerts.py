@@ -1,13 +1,51 @@
-from time import sleep
-import warnings
+from functools import partial
 
-from run_alerts import main
+from alert_log import AlertLog
+from alert_window import MinuteWindowClient
+from event_ingest import EventCounters, serve_ingest
+from run import get_keen_client
+from run_alerts import get_shared_gdrive_client, main
+from run_bw_video_keen import get_filters
+from scheduler import Job, Scheduler
 
-alert_log = None
+# on disk, so a restart doesn't re-send the alerts of the last hour
+alert_log = AlertLog()
+keen_window = MinuteWindowClient()
+# set to e.g. 8766 to take events from the players as well, and check the
+# rules against them every LIVE_EVERY seconds
+INGEST_PORT = None
+LIVE_EVERY = 15
+LIVE_TIMEFRAME = 'previous_5_minutes'
 
-run_frequency = 60*5 # in seconds
-while True:
-    warnings.warn("checking for alerts")
-    alert_log = main(alert_log)
-    warnings.warn("sleeping for %s seconds" % run_frequency)
-    sleep(run_frequency)
+
+def check_alerts(run, timeframe, rule_pattern=None, counters=None):
+    main(alert_log, keen_window, timeframe, rule_pattern, run, counters)
+
+
+# each job checks the rules whose alertName matches rule_pattern against its
+# own window, on its own cadence (seconds). A run is cancelled at its deadline
+# and a tick where the previous run is still going is skipped. e.g.
+#   Job('broken-player', partial(check_alerts, timeframe='previous_5_minutes',
+#       rule_pattern='player'), every=60, deadline=50),
+#   Job('fill-rate', partial(check_alerts, timeframe='previous_60_minutes',
+#       rule_pattern='fill'), every=60*15),
+JOBS = [
+    Job('alerts', partial(check_alerts, timeframe='previous_60_minutes'),
+        every=60*5, deadline=60*4),
+]
+
+
+if __name__ == '__main__':
+    # one client shared by every run, so concurrent runs don't replace it
+    keen_window.client = get_keen_client(
+        '/home/robertdavidwest/keen-buzzworthy-aol.json')
+    if INGEST_PORT:
+        # each live run updates the filters, these are applied until then
+        filters = get_filters(get_shared_gdrive_client(
+            '/home/robertdavidwest/gdrive-keen-buzzworthy-aol.json'))
+        ingest = serve_ingest(EventCounters(filters=filters), host='',
+                              port=INGEST_PORT)
+        JOBS.append(Job('live', partial(check_alerts, timeframe=LIVE_TIMEFRAME,
+                                        counters=ingest.counters),
+                        every=LIVE_EVERY, deadline=LIVE_EVERY - 2))
+    Scheduler(JOBS).run_forever()
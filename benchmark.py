@@ -0,0 +1,293 @@
+"""
+Benchmarks for the report pipeline on synthetic data.
+
+    python benchmark.py                      # 1k, 100k and 1M group rows
+    python benchmark.py --sizes 1000 --save  # store results as the baseline
+    python benchmark.py --compare            # exit 1 on a regression
+
+Each stage of get_keen_report (assembling the per-event keen results, adding
+reference rates, metrics, encrave costs, column order) is timed separately
+with its peak memory, as are apply_alert_rules with hundreds of rules and the
+keen/AOL merges of run_aol_and_keen. The sheets publishing paths are run
+against the offline sheets backend, recording their api request counts.
+"""
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+from time import time
+
+import numpy as np
+import pandas as pd
+
+from keen_queries import EVENTS, assemble_wide
+from run_bw_video_keen import (merge_reference_rates, add_metrics,
+                               merge_encrave_costs, reorder_cols)
+from run_alerts import apply_alert_rules
+from offline_sheets import get_offline_client
+from sheets import (write_to_sheets, create_compare_report, read_sheets,
+                    clean_sheets, delete_sheet, update_sheet)
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+
+DEFAULT_SIZES = [1000, 100000, 1000000]
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark_baseline.json')
+REGRESSION_FACTOR = 1.5
+N_RULES = 300
+PUBLISH_ROWS = 10000 # a sheet can't hold much more than this report
+REFERS = ['qr', 'tp', 'sb', 'o', 'ss', 'en']
+
+
+def synthetic_keen_results(n, seed=0):
+    """Per-event count frames, as count_events returns them, for n distinct
+    (program, campaign, refer) groups. Each event is missing for ~10% of the
+    groups."""
+    rng = np.random.RandomState(seed)
+    i = np.arange(n)
+    keys = pd.DataFrame({
+        'program': np.array(['program-%d' % p for p in range(3)])[i % 3],
+        'campaign': pd.Series(i // len(REFERS)).map('campaign-{}'.format),
+        'refer': np.array(REFERS)[i % len(REFERS)]},
+        columns=['program', 'campaign', 'refer'])
+    frames = []
+    for e in EVENTS:
+        present = rng.rand(n) > 0.1
+        frame = keys[present].reset_index(drop=True)
+        frame[e] = rng.poisson(50, present.sum())
+        frames.append(frame)
+    return frames
+
+
+def synthetic_reference_rates(n, seed=0):
+    """REVENUE RATE and COST RATE sheets covering roughly half the groups"""
+    rng = np.random.RandomState(seed)
+    campaigns = n // len(REFERS)
+    rev = pd.DataFrame({'program': ['program-%d' % p for p in range(3)],
+                        'revenue_rate': ['$%.3f' % r for r in rng.rand(3)]})
+    m = max(n // 2, 1)
+    cost = pd.DataFrame({
+        'campaign': ['campaign-%d' % c for c in rng.randint(0, max(campaigns, 1), m)],
+        'refer': np.array(REFERS)[rng.randint(0, len(REFERS), m)],
+        'cost_rate': rng.rand(m) / 10,
+        'cost_multiplier': 1,
+        'cost_event_variable': np.array(['rewardevent', 'prerollplay',
+                                         'playerload'])[rng.randint(0, 3, m)]})
+    cost = cost.drop_duplicates(['campaign', 'refer'])
+    return {'REVENUE RATE': rev, 'COST RATE': cost}
+
+
+def synthetic_encrave_costs(n, seed=0):
+    rng = np.random.RandomState(seed)
+    campaigns = max(n // len(REFERS), 1)
+    return pd.DataFrame({
+        'campaign': ['campaign-%d' % c for c in range(campaigns)],
+        'Cost': rng.rand(campaigns) * 100,
+        'ReportName': 'Encrave: buzzworthy MTD'})
+
+
+def synthetic_alert_rules(n_rules, seed=0):
+    rng = np.random.RandomState(seed)
+    rules = []
+    for r in range(n_rules):
+        if r % 2:
+            formula = 'data["playerload"] > %d' % rng.randint(40, 80)
+        else:
+            formula = 'data["preroll/playerload"] < %.2f' % rng.rand()
+        rules.append({'alertName': 'alert-%d' % r, 'formula': formula})
+    return pd.DataFrame(rules)
+
+
+def synthetic_alert_exclusions(report, rules, seed=0):
+    rng = np.random.RandomState(seed)
+    campaigns = report['campaign'].drop_duplicates().tolist()
+    exclusions = pd.DataFrame({'campaign': campaigns})
+    for name in rules['alertName']:
+        exclusions['exclude-' + name] = rng.rand(len(campaigns)) < 0.05
+    return exclusions
+
+
+def synthetic_aol_frames(n, seed=0):
+    rng = np.random.RandomState(seed)
+    vidids = ['vid-%d' % v for v in range(n)]
+    campaigns = ['campaign-%d' % (v // 20) for v in range(n)]
+    keen_df = pd.DataFrame({'vidid': vidids, 'campaign': campaigns,
+                            'prerollplay': rng.poisson(50, n),
+                            'contentplay': rng.poisson(200, n)})
+    aol_df = pd.DataFrame({'vidid': vidids,
+                           'Video title': ['title %d' % v for v in range(n)],
+                           'prerollplay': rng.poisson(50, n),
+                           'contentplay': rng.poisson(200, n)})
+    m = max(n // 20, 1) * len(REFERS)
+    keen_vendor_df = pd.DataFrame({
+        'campaign': ['campaign-%d' % (i // len(REFERS)) for i in range(m)],
+        'refer': [REFERS[i % len(REFERS)] for i in range(m)],
+        'prerollplay': rng.poisson(50, m),
+        'contentplay': rng.poisson(200, m)})
+    return keen_df, keen_vendor_df, aol_df
+
+
+def measure(func, *args):
+    """Run func(*args), returning (result, seconds, peak memory in MB)"""
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+        t = time()
+        result = func(*args)
+        seconds = time() - t
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    else:
+        # process high-water mark, only grows, so this is an upper bound
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        t = time()
+        result = func(*args)
+        seconds = time() - t
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = (after - before) / 1e3
+    return result, seconds, peak
+
+
+def bench_report(n):
+    frames = synthetic_keen_results(n)
+    ref_rates = synthetic_reference_rates(n)
+    encrave = synthetic_encrave_costs(n)
+    by = ['program', 'campaign', 'refer']
+    stages = [
+        ('assemble', lambda d: assemble_wide(frames, by).sort_values(by)),
+        ('reference_rates', lambda d: merge_reference_rates(d, ref_rates)),
+        ('metrics', add_metrics),
+        ('encrave_costs', lambda d: merge_encrave_costs(d, encrave)),
+        ('reorder_cols', reorder_cols)]
+    results = {}
+    data = None
+    for name, stage in stages:
+        data, seconds, peak = measure(stage, data)
+        results[name] = {'seconds': seconds, 'peak_mb': peak}
+    return results, data
+
+
+def bench_alerts(report, n_rules=N_RULES):
+    rules = synthetic_alert_rules(n_rules)
+    exclusions = synthetic_alert_exclusions(report, rules)
+    report = report.copy()
+    report['campaign'] = report['campaign'].fillna('None')
+    _, seconds, peak = measure(apply_alert_rules, report, rules, exclusions)
+    return {'seconds': seconds, 'peak_mb': peak}
+
+
+def bench_aol_merge(n):
+    from run_aol_and_keen import merge_keen_and_aol
+    keen_df, keen_vendor_df, aol_df = synthetic_aol_frames(n)
+    _, seconds, peak = measure(merge_keen_and_aol, keen_df, keen_vendor_df,
+                               aol_df)
+    return {'seconds': seconds, 'peak_mb': peak}
+
+
+def bench_publish(report, rows=PUBLISH_ROWS):
+    """Time and api requests of each sheets publishing path, against an
+    offline sheets backend without latency or quota"""
+    directory = tempfile.mkdtemp()
+    report = report.head(rows)
+    blocks = [report.head(rows // 2), report.tail(rows // 2)]
+    changed = report.copy()
+    changed.iloc[::100, 3] += 1
+    title = 'benchmark'
+    keys = ['program', 'campaign', 'refer']
+    steps = [
+        ('update_sheet_new', lambda gc: update_sheet(
+            gc, report, title, 'hourly', keys)),
+        ('update_sheet_1pct', lambda gc: update_sheet(
+            gc, changed, title, 'hourly', keys)),
+        ('write_to_sheets', lambda gc: write_to_sheets(
+            gc, report, title, '2016-01-01 00:00:00 report')),
+        ('compare_report', lambda gc: create_compare_report(
+            gc, blocks, title, '2016-01-02 00:00:00 compare', [0, 1])),
+        ('read_sheets', lambda gc: read_sheets(gc, title)),
+        ('clean_sheets', lambda gc: clean_sheets(gc, title, 1)),
+        ('delete_sheet', lambda gc: delete_sheet(
+            gc, title, '2016-01-02 00:00:00 compare'))]
+    results = {}
+    try:
+        gc = get_offline_client(directory, read_quota=None, write_quota=None)
+        for name, step in steps:
+            gc.reset_stats()
+            _, seconds, peak = measure(step, gc)
+            results['publish_' + name] = {'seconds': seconds, 'peak_mb': peak,
+                                          'calls': gc.stats()['total']}
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def run(sizes, n_rules=N_RULES):
+    results = {}
+    for n in sizes:
+        print('benchmarking {} rows'.format(n))
+        stages, report = bench_report(n)
+        stages['apply_alert_rules'] = bench_alerts(report, n_rules)
+        stages.update(bench_publish(report))
+        try:
+            stages['aol_merge'] = bench_aol_merge(n)
+        except ImportError as e:
+            print('skipping aol_merge: {}'.format(e))
+        results[str(n)] = stages
+        for name, r in sorted(stages.items()):
+            calls = ' {:>5} calls'.format(r['calls']) if 'calls' in r else ''
+            print('  {:<28} {:>9.3f}s {:>9.1f}MB{}'.format(
+                name, r['seconds'], r['peak_mb'], calls))
+    return results
+
+
+def compare(results, baseline, factor=REGRESSION_FACTOR):
+    """Stages that are more than `factor` slower than the baseline, or that
+    make more sheets api requests"""
+    regressions = []
+    for n, stages in results.items():
+        for name, r in stages.items():
+            base = baseline.get(n, {}).get(name)
+            if not base:
+                continue
+            if r['seconds'] > base['seconds'] * factor:
+                regressions.append((n, name, 'seconds', base['seconds'],
+                                    r['seconds']))
+            if r.get('calls', 0) > base.get('calls', r.get('calls', 0)):
+                regressions.append((n, name, 'calls', base['calls'],
+                                    r['calls']))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--rules', type=int, default=N_RULES)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='fail if a stage regressed against the baseline')
+    parser.add_argument('--factor', type=float, default=REGRESSION_FACTOR)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = run(args.sizes, args.rules)
+    if args.save:
+        json.dump(results, open(args.baseline, 'w'), indent=2, sort_keys=True)
+        print('baseline saved to {}'.format(args.baseline))
+    if args.compare:
+        baseline = json.load(open(args.baseline, 'r'))
+        regressions = compare(results, baseline, args.factor)
+        for n, name, measure_name, before, after in regressions:
+            print('REGRESSION {} rows {} {}: {:.3f} -> {:.3f}'.format(
+                n, name, measure_name, before, after))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,551 @@
+"""
+A local ingest endpoint for player events, kept as rolling in-memory counts
+so alerts can be checked within seconds of an outage instead of through keen
+queries every few minutes.
+
+    python event_ingest.py --port 8766
+
+Players post events to it as well as to keen, in keen's write api format:
+one event (or a list) to .../events/<collection>, or {collection: [event,
+..]} to .../events, e.g. /3.0/projects/<id>/events/playerload. Counts are
+kept per `resolution` seconds over the last `window` seconds for each
+combination of the tracked properties (program, campaign and refer by
+default), after the FILTERS sheet's filters are applied to each event.
+`EventCounters.count` answers keen count queries over
+previous_N_seconds/minutes timeframes from them, so `get_keen_report` and
+`apply_alert_rules` work on it as on a keen client.
+
+    python event_ingest.py --load http://localhost:8766 --rate 5000
+
+posts synthetic events and reports the rate the server sustained.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+from collections import deque
+from time import sleep, time
+from warnings import warn
+
+import numpy as np
+import pandas as pd
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from httplib import HTTPConnection
+    from urlparse import urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from http.client import HTTPConnection
+    from urllib.parse import urlparse
+
+from keen_queries import EVENTS, string_types, sum_by_groups
+
+
+PROPERTIES = ['program', 'campaign', 'refer']
+WINDOW = 60*60 # seconds of counts kept
+RESOLUTION = 10 # seconds per count slot
+FLUSH_INTERVAL = 0.05 # seconds between applying received events
+INITIAL_KEYS = 1024
+
+_previous = re.compile(r'^previous_(\d+)_(second|minute)s?$')
+_unit_seconds = {'second': 1, 'minute': 60}
+
+
+def _property(event, name):
+    """event['a']['b'] for 'a.b', None if it is missing"""
+    for part in name.split('.'):
+        if not isinstance(event, dict):
+            return None
+        event = event.get(part)
+    return event
+
+
+_operators = ('eq', 'ne', 'in', 'exists', 'contains', 'not_contains', 'gt',
+              'gte', 'lt', 'lte')
+
+
+def _passes(value, f):
+    """Whether a property value passes a keen filter"""
+    op, target = f['operator'], f.get('property_value')
+    if op == 'eq':
+        return value == target
+    if op == 'ne':
+        return value != target
+    if op == 'in':
+        return value in target
+    if op == 'exists':
+        return (value is not None) == bool(target)
+    if op in ('contains', 'not_contains'):
+        contains = value is not None and \
+            u'{}'.format(target) in u'{}'.format(value)
+        return contains if op == 'contains' else not contains
+    if op in ('gt', 'gte', 'lt', 'lte'):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return False
+        return {'gt': value > target, 'gte': value >= target,
+                'lt': value < target, 'lte': value <= target}[op]
+    raise ValueError("unsupported filter operator '{}'".format(op))
+
+
+def _key_value(value):
+    """A property value as part of a count key. Lists and dicts are kept as
+    their json, so they can be hashed"""
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, sort_keys=True, default=str)
+    return value
+
+
+def _filter_key(f):
+    return json.dumps([f['property_name'], f['operator'],
+                       f.get('property_value')], sort_keys=True, default=str)
+
+
+def _filter_mask(keys, filters):
+    """Which rows of the tracked property values pass keen filters on the
+    tracked properties"""
+    mask = np.ones(len(keys), dtype=bool)
+    for f in filters:
+        passes = [_passes(v, f) for v in keys[f['property_name']]]
+        mask &= np.asarray(passes, dtype=bool)
+    return mask
+
+
+class EventCounters(object):
+    """
+    Rolling per-key event counts
+
+    Received events are only appended to a deque, which needs no lock, and
+    one aggregator thread applies them to a (slot x key x event) array of
+    counts in batches. Readers sum the slots of a window without locking,
+    so a read can miss the events being applied at that instant. Slots are
+    reused round-robin, and slots older than the window are ignored, so
+    counts of campaigns that stop sending fall to zero.
+
+    Parameters
+    ----------
+    events : list of str
+        event collections counted, others are ignored
+    properties : list of str
+        event properties counts are kept per combination of. Queries can
+        group by and filter on these only
+    window : int
+        seconds of counts kept
+    resolution : int
+        seconds per slot, the granularity of the windows
+    flush_interval : float
+        seconds between applying received events
+    filters : list of dict
+        keen filters applied to events as they are counted, e.g. the FILTERS
+        sheet. Queries can also filter on untracked properties with these
+        filters, see `set_filters`
+    """
+
+    def __init__(self, events=EVENTS, properties=PROPERTIES, window=WINDOW,
+                 resolution=RESOLUTION, flush_interval=FLUSH_INTERVAL,
+                 filters=None):
+        self.events = list(events)
+        self.properties = list(properties)
+        self.filters = []
+        self._filter_keys = set()
+        self.set_filters(filters)
+        self.window = window
+        self.resolution = resolution
+        self.flush_interval = flush_interval
+        # two spare slots, so the one being cleared is never in a window
+        self.n_slots = -(-window // resolution) + 2
+        self._event_index = dict((e, i) for i, e in enumerate(self.events))
+        self._keys = []
+        self._key_index = {}
+        self._key_frame = None
+        self._counts = np.zeros((self.n_slots, INITIAL_KEYS, len(self.events)),
+                                dtype=np.int64)
+        self._slot_period = np.full(self.n_slots, -1, dtype=np.int64)
+        self._period = -1
+        self._pending = deque()
+        self.counts = {'received': 0, 'counted': 0, 'ignored': 0,
+                       'filtered': 0, 'late': 0, 'errors': 0}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='event-counters')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, collection, events, received=None):
+        """Queue events of a collection to be counted. Safe to call from any
+        thread."""
+        if isinstance(events, dict):
+            events = [events]
+        if not isinstance(events, list):
+            raise ValueError('expected an event or a list of events, not '
+                             '{!r}'.format(events))
+        self._pending.append((received or time(), collection, events))
+
+    def set_filters(self, filters):
+        """Apply keen filters to the events counted from now on. Counts
+        already kept are unchanged, so a query filtering on an untracked
+        property sees events counted under the previous filters for up to a
+        window."""
+        filters = [dict(f) for f in filters or []]
+        for f in filters:
+            if f['operator'] not in _operators:
+                raise ValueError("unsupported filter operator '{}'".format(
+                    f['operator']))
+        self.filters = filters
+        self._filter_keys = set(_filter_key(f) for f in filters)
+
+    def _key(self, key):
+        k = self._key_index.get(key)
+        if k is None:
+            k = len(self._keys)
+            if k == self._counts.shape[1]:
+                counts = np.zeros((self.n_slots, 2 * k, len(self.events)),
+                                  dtype=np.int64)
+                counts[:, :k] = self._counts
+                self._counts = counts
+            self._keys.append(key)
+            self._key_index[key] = k
+        return k
+
+    def _advance(self, period):
+        """Clear the slots of the periods up to `period`"""
+        first = max(self._period + 1, period - self.n_slots + 1)
+        for p in range(first, period + 1):
+            slot = p % self.n_slots
+            self._slot_period[slot] = -1
+            self._counts[slot] = 0
+            self._slot_period[slot] = p
+        self._period = max(self._period, period)
+
+    def _apply(self):
+        batches = []
+        while True:
+            try:
+                batches.append(self._pending.popleft())
+            except IndexError:
+                break
+        slots, keys, events = [], [], []
+        for received, collection, batch in batches:
+            self.counts['received'] += len(batch)
+            e = self._event_index.get(collection)
+            if e is None:
+                self.counts['ignored'] += len(batch)
+                continue
+            period = int(received // self.resolution)
+            if period > self._period:
+                self._advance(period)
+            slot = period % self.n_slots
+            if self._slot_period[slot] != period:
+                self.counts['late'] += len(batch)
+                continue
+            filters = self.filters
+            for event in batch:
+                if filters and not all(
+                        _passes(_property(event, f['property_name']), f)
+                        for f in filters):
+                    self.counts['filtered'] += 1
+                    continue
+                slots.append(slot)
+                keys.append(self._key(tuple(_key_value(_property(event, p))
+                                            for p in self.properties)))
+                events.append(e)
+        if slots:
+            np.add.at(self._counts, (slots, keys, events), 1)
+            self.counts['counted'] += len(slots)
+
+    def _run(self):
+        while True:
+            stopping = self._stop.is_set()
+            try:
+                self._apply()
+            except Exception as e:
+                # a bad batch is dropped, counting goes on
+                self.counts['errors'] += 1
+                warn('could not count events: {!r}'.format(e))
+            if stopping:
+                return
+            self._stop.wait(self.flush_interval)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def stats(self):
+        """events received, counted, ignored (not a counted collection),
+        filtered out and late (older than the window), batches dropped on
+        errors, distinct keys and events waiting to be applied"""
+        stats = dict(self.counts)
+        stats['keys'] = len(self._keys)
+        stats['pending'] = sum(len(b[2]) for b in list(self._pending))
+        return stats
+
+    def _window_seconds(self, timeframe):
+        match = _previous.match(timeframe or '') \
+            if not isinstance(timeframe, dict) else None
+        if not match:
+            raise ValueError("only previous_N_seconds and previous_N_minutes "
+                             "timeframes can be counted, not {}".format(
+                                 timeframe))
+        seconds = int(match.group(1)) * _unit_seconds[match.group(2)]
+        if seconds > self.window:
+            raise ValueError('{} is longer than the {}s kept'.format(
+                timeframe, self.window))
+        return seconds
+
+    def totals(self, seconds, now=None):
+        """
+        Counts over the last `seconds`, including the current slot
+
+        Returns
+        -------
+        pd.DataFrame
+            | *properties | *events |, one row per key seen, in order of
+            first appearance
+        """
+        now = time() if now is None else now
+        counts = self._counts
+        n = min(len(self._keys), counts.shape[1])
+        period = int(now // self.resolution)
+        periods = -(-seconds // self.resolution)
+        in_window = (self._slot_period > period - periods) & \
+            (self._slot_period <= period)
+        totals = counts[in_window, :n].sum(axis=0)
+        if self._key_frame is None or len(self._key_frame) != n:
+            self._key_frame = pd.DataFrame(self._keys[:n],
+                                           columns=self.properties)
+        data = self._key_frame.copy()
+        for i, e in enumerate(self.events):
+            data[e] = totals[:, i]
+        return data
+
+    def count(self, event_collection, timeframe=None, timezone=None,
+              interval=None, filters=None, group_by=None, **kwargs):
+        """keen's KeenClient.count over the in-memory counts. timezone is
+        irrelevant to relative windows and ignored; intervals aren't
+        supported. Filters on tracked properties are applied to the counts;
+        a filter on any other property must be one of the filters applied
+        at ingest."""
+        if interval:
+            raise ValueError('intervals are not supported')
+        if event_collection not in self._event_index:
+            raise ValueError("'{}' is not counted".format(event_collection))
+        tracked = []
+        for f in filters or []:
+            if f['property_name'] in self.properties:
+                tracked.append(f)
+            elif _filter_key(f) not in self._filter_keys:
+                raise ValueError(
+                    "can't filter on '{}', only the tracked properties {} are "
+                    "kept and it isn't one of the ingest filters".format(
+                        f['property_name'], self.properties))
+        data = self.totals(self._window_seconds(timeframe))
+        data = data[_filter_mask(data, tracked)]
+        data = data.rename(columns={event_collection: 'result'})
+        if isinstance(group_by, string_types):
+            group_by = [group_by]
+        by = list(group_by or [])
+        missing = set(by) - set(self.properties)
+        if missing:
+            raise ValueError("can't group by {}, only the tracked properties "
+                             "{} are kept".format(sorted(missing),
+                                                  self.properties))
+        if not by:
+            return int(data['result'].sum())
+        data = sum_by_groups(data[by + ['result']], by, ['result'])
+        records = data[data['result'] > 0].to_dict('records')
+        for r in records:
+            r['result'] = int(r['result'])
+        return records
+
+
+class IngestServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, counters):
+        HTTPServer.__init__(self, address, IngestHandler)
+        self.counters = counters
+
+    @property
+    def base_url(self):
+        return 'http://%s:%s' % self.server_address[:2]
+
+
+class IngestHandler(BaseHTTPRequestHandler):
+    # keep-alive, so a player can send many events over one connection,
+    # without nagle holding back the responses
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/_ingest/stats':
+            return self._send(200, self.server.counters.stats())
+        return self._send(404, {'message': 'not found'})
+
+    def do_POST(self):
+        received = time()
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length).decode('utf8'))
+        except ValueError:
+            return self._send(400, {'message': 'body is not json'})
+        parts = urlparse(self.path).path.rstrip('/').split('/')
+        if 'events' not in parts:
+            return self._send(404, {'message': 'not found'})
+        after = parts[parts.index('events') + 1:]
+        if after:
+            batches = {after[0]: body}
+        elif isinstance(body, dict):
+            batches = body
+        else:
+            return self._send(400, {'message': 'expected {collection: '
+                                               '[events]}'})
+        valid = []
+        for collection, events in batches.items():
+            if isinstance(events, dict):
+                events = [events]
+            if not isinstance(events, list) or \
+                    not all(isinstance(e, dict) for e in events):
+                return self._send(400, {'message': "'{}' is not an event or "
+                                                   "a list of events".format(
+                                                       collection)})
+            valid.append((collection, events))
+        created = 0
+        for collection, events in valid:
+            self.server.counters.add(collection, events, received)
+            created += len(events)
+        return self._send(201, {'created': created})
+
+
+def serve_ingest(counters=None, host='localhost', port=0):
+    """Start an ingest server on a background thread
+
+    Returns
+    -------
+    IngestServer
+        `.counters` are its EventCounters, `.base_url` its url. Call
+        `.shutdown()` to stop it
+    """
+    server = IngestServer((host, port), counters or EventCounters())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _post_events(url, rate, seconds, batch, campaigns, seed, results):
+    rng = random.Random(seed)
+    url = urlparse(url)
+    conn = HTTPConnection(url.hostname, url.port)
+    interval = batch / float(rate)
+    start = time()
+    sent = errors = 0
+    n = 0
+    while time() - start < seconds:
+        events = {}
+        for _ in range(batch):
+            events.setdefault(rng.choice(EVENTS), []).append({
+                'program': 'program-%d' % rng.randrange(3),
+                'campaign': 'campaign-%d' % rng.randrange(campaigns),
+                'refer': rng.choice(['en', 'fb', 'tw', 'go'])})
+        conn.request('POST', url.path.rstrip('/') + '/events',
+                     json.dumps(events), {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        if response.status == 201:
+            sent += batch
+        else:
+            errors += 1
+        n += 1
+        # fixed schedule, so a slow request is caught up on
+        delay = start + n * interval - time()
+        if delay > 0:
+            sleep(delay)
+    conn.close()
+    results.append((sent, errors))
+
+
+def generate_load(url, rate=5000, seconds=10, batch=50, threads=4,
+                  campaigns=500, seed=0):
+    """
+    Post random events to an ingest server
+
+    Parameters
+    ----------
+    url : str
+        e.g. 'http://localhost:8766'
+    rate : float
+        events per second to aim for, over all threads
+    seconds : float
+    batch : int
+        events per request
+    threads : int
+        concurrent connections
+    campaigns : int
+
+    Returns
+    -------
+    dict
+        events sent, failed requests, seconds taken and events per second
+    """
+    results = []
+    workers = [threading.Thread(target=_post_events,
+                                args=(url, rate / float(threads), seconds,
+                                      batch, campaigns, seed + i, results))
+               for i in range(threads)]
+    start = time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    taken = time() - start
+    sent = sum(r[0] for r in results)
+    return {'sent': sent, 'errors': sum(r[1] for r in results),
+            'seconds': round(taken, 2),
+            'events_per_second': round(sent / taken, 1)}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--window', type=int, default=WINDOW)
+    parser.add_argument('--resolution', type=int, default=RESOLUTION)
+    parser.add_argument('--load', metavar='URL',
+                        help='post synthetic events to URL instead')
+    parser.add_argument('--rate', type=float, default=5000)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--batch', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--campaigns', type=int, default=500)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.load:
+        print(generate_load(args.load, args.rate, args.seconds, args.batch,
+                            args.threads, args.campaigns))
+    else:
+        server = serve_ingest(EventCounters(window=args.window,
+                                            resolution=args.resolution),
+                              args.host, args.port)
+        print('ingesting events at {}'.format(server.base_url))
+        while True:
+            sleep(60)
+            print(server.counters.stats())
@@ -43,10 +43,11 @@ def write_encrave_report(gc, data, sheet):
     write_to_sheets(gc, data, title, sheet)
 
 
-def main():
+def main(gc=None):
     keydir = "/home/robertdavidwest/"
-    gc = get_gdrive_client(keydir +
-             'gdrive-keen-buzzworthy-aol.json')
+    if gc is None:
+        gc = get_gdrive_client(keydir +
+                 'gdrive-keen-buzzworthy-aol.json')
     date_yesterday = datetime.strftime(datetime.now() - timedelta(1), '%m-%d-%Y')
     data, report_name  = get_encrave_report(date_yesterday)
     mtd_report, yest_report = aggregate(data, date_yesterday, report_name)
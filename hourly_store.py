@@ -0,0 +1,219 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+from functools import partial
+
+import pandas as pd
+
+from keen_queries import (query_spec, result_to_frame, run_queries,
+                          sum_by_groups)
+
+
+DEFAULT_STORE_PATH = os.path.expanduser('~/keen-hourly-counts.db')
+KEEN_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+# hours are only stored this long after they end, so events keen ingests
+# late are counted
+SETTLE_DELAY = pd.Timedelta(hours=1)
+
+_previous_days = re.compile(r'^previous_(\d+)_days?$')
+
+
+def _local_midnight(ts, tz, days=0):
+    date = (ts.tz_convert(tz) + pd.Timedelta(days=days)).date()
+    return pd.Timestamp(date).tz_localize(tz).tz_convert('UTC')
+
+
+def report_window(timeframe, tz, now=None):
+    """Resolve a relative keen timeframe into an absolute utc window
+
+    Parameters
+    ----------
+    timeframe : str
+        'this_day', 'previous_day', 'previous_N_days', 'this_month' or
+        'previous_month'
+    tz : str
+        timezone the timeframe is relative to e.g. 'US/Pacific'
+    now : pd.Timestamp
+        utc time, defaults to the current time
+
+    Returns
+    -------
+    tuple of pd.Timestamp or None
+        (start, end) in utc, or None if the timeframe is not supported
+    """
+    now = now if now is not None else pd.Timestamp.utcnow()
+    today = _local_midnight(now, tz)
+    if timeframe == 'this_day':
+        return today, now
+    if timeframe == 'previous_day':
+        return _local_midnight(now, tz, -1), today
+    match = _previous_days.match(timeframe)
+    if match:
+        return _local_midnight(now, tz, -int(match.group(1))), today
+    month_start = pd.Timestamp(now.tz_convert(tz).date().replace(day=1))
+    if timeframe == 'this_month':
+        return month_start.tz_localize(tz).tz_convert('UTC'), now
+    if timeframe == 'previous_month':
+        prev = month_start - pd.DateOffset(months=1)
+        return (prev.tz_localize(tz).tz_convert('UTC'),
+                month_start.tz_localize(tz).tz_convert('UTC'))
+    return None
+
+
+def _keen_time(ts):
+    return ts.strftime(KEEN_TIME_FORMAT)
+
+
+def _contiguous(hours):
+    """Group a sorted list of hourly timestamps into [start, end) runs"""
+    runs = []
+    for h in hours:
+        if runs and runs[-1][1] == h:
+            runs[-1][1] = h + pd.Timedelta(hours=1)
+        else:
+            runs.append([h, h + pd.Timedelta(hours=1)])
+    return runs
+
+
+class HourlyCountStore(object):
+    """Local sqlite store of hourly keen counts, partitioned by utc hour.
+
+    Each stored hour is a closed, absolute window, stored once it is
+    SETTLE_DELAY old, so it never needs to be queried again. A report window
+    in any timezone is answered by summing the stored hours and querying keen
+    only for hours that are missing or more recent.
+    """
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS hourly_counts ("
+            "signature TEXT, event TEXT, hour TEXT, groups TEXT, count INTEGER);"
+            "CREATE INDEX IF NOT EXISTS hourly_counts_idx "
+            "ON hourly_counts (signature, event, hour);"
+            "CREATE TABLE IF NOT EXISTS loaded_hours ("
+            "signature TEXT, event TEXT, hour TEXT, "
+            "PRIMARY KEY (signature, event, hour));")
+
+    @staticmethod
+    def signature(by, filters):
+        return json.dumps({'by': list(by), 'filters': filters or []},
+                          sort_keys=True)
+
+    def loaded_hours(self, signature, event, start, end):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT hour FROM loaded_hours WHERE signature = ? "
+                "AND event = ? AND hour >= ? AND hour < ?",
+                (signature, event, _keen_time(start), _keen_time(end)))
+            return set(r[0] for r in rows)
+
+    def add_hours(self, signature, event, by, intervals, hours):
+        """Store the result of an hourly interval count query
+
+        Parameters
+        ----------
+        intervals : list of dict
+            keen result: [{'timeframe': {'start': .., 'end': ..},
+                           'value': [{*by, 'result': n}, ..]}, ..]
+        hours : list of pd.Timestamp
+            every hour the query covered, so that empty hours are recorded
+            as loaded too
+        """
+        rows = []
+        for interval in intervals:
+            hour = _keen_time(pd.Timestamp(interval['timeframe']['start']))
+            for value in interval['value']:
+                groups = json.dumps([value.get(c) for c in by])
+                rows.append((signature, event, hour, groups, value['result']))
+        loaded = [(signature, event, _keen_time(h)) for h in hours]
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM hourly_counts WHERE signature = ? AND event = ? "
+                "AND hour = ?", loaded)
+            self._conn.executemany(
+                "INSERT INTO hourly_counts VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO loaded_hours VALUES (?, ?, ?)", loaded)
+            self._conn.commit()
+
+    def sum_hours(self, signature, event, by, start, end):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT groups, SUM(count) FROM hourly_counts "
+                "WHERE signature = ? AND event = ? AND hour >= ? AND hour < ? "
+                "GROUP BY groups",
+                (signature, event, _keen_time(start),
+                 _keen_time(end))).fetchall()
+        result = []
+        for groups, n in rows:
+            record = dict(zip(by, json.loads(groups)))
+            record['result'] = n
+            result.append(record)
+        return result_to_frame(result, event, by)
+
+
+def _fill_missing(client, store, signature, event, by, filters, runs):
+    for start, end in runs:
+        spec = query_spec({'start': _keen_time(start), 'end': _keen_time(end)},
+                          filters=filters, group_by=by)
+        intervals = client.count(event_collection=event, interval='hourly',
+                                 **spec)
+        hours = list(pd.date_range(start, end, freq='H', closed='left'))
+        store.add_hours(signature, event, by, intervals, hours)
+
+
+def _window_count(client, store, event, start, end, by, filters, now,
+                  settle=SETTLE_DELAY):
+    signature = store.signature(by, filters)
+    closed_end = min(end, (now - settle).floor('H'))
+    frames = []
+    if closed_end > start:
+        wanted = pd.date_range(start, closed_end, freq='H', closed='left')
+        loaded = store.loaded_hours(signature, event, start, closed_end)
+        missing = [h for h in wanted if _keen_time(h) not in loaded]
+        _fill_missing(client, store, signature, event, by, filters,
+                      _contiguous(missing))
+        frames.append(store.sum_hours(signature, event, by,
+                                      start, closed_end))
+    if end > closed_end:
+        # recent hours can still receive late events so they aren't stored
+        open_start = max(start, closed_end)
+        spec = query_spec({'start': _keen_time(open_start),
+                           'end': _keen_time(end)},
+                          filters=filters, group_by=by)
+        result = client.count(event_collection=event, **spec)
+        frames.append(result_to_frame(result, event, by))
+
+    data = pd.concat(frames, ignore_index=True, sort=False)
+    if len(frames) > 1 and len(data):
+        data = sum_by_groups(data, by, [event])
+    return data
+
+
+def count_events_from_store(client, store, events, timeframe, tz,
+                            filters=None, group_by=None, now=None,
+                            max_workers=None, timeout=None,
+                            settle=SETTLE_DELAY):
+    """Same contract as keen_queries.count_events, but built from hourly
+    partitions in `store`. Only hours that are not stored yet, plus the hours
+    that ended less than `settle` (a pd.Timedelta) ago, are queried from
+    keen.
+
+    Returns None if `timeframe` cannot be resolved to an absolute window, in
+    which case the caller should query keen directly.
+    """
+    now = now if now is not None else pd.Timestamp.utcnow()
+    window = report_window(timeframe, tz, now)
+    if window is None:
+        return None
+    start, end = window
+    by = list(group_by or [])
+    queries = [partial(_window_count, client, store, e, start, end, by,
+                       filters, now, settle)
+               for e in events]
+    return run_queries(queries, max_workers, timeout)
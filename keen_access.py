@@ -0,0 +1,173 @@
+import json
+import threading
+from time import sleep, time
+
+import keyring
+import requests
+from requests.adapters import HTTPAdapter
+from keen.client import KeenClient
+
+from keen_cache import CachedKeenClient
+from keen_queries import MAX_CONCURRENT_QUERIES, QUERY_TIMEOUT
+from throttle import (RETRY_STATUSES, TokenBucket, backoff_delay,
+                      current_deadline, retry_after_seconds)
+
+
+QUERIES_PER_SECOND = 5.0 # per keen project, shared by every client
+MAX_RETRIES = 5
+REQUEST_TIMEOUT = QUERY_TIMEOUT # seconds per request, keen's default is 305
+MAX_RETRY_TIME = 60*5 # seconds one call may take over all its attempts
+POOL_SIZE = MAX_CONCURRENT_QUERIES * 2
+
+_lock = threading.Lock()
+_session = None
+_buckets = {}
+metrics = {'requests': 0, 'retries': 0, 'rate_limited': 0,
+           'errors': 0, 'throttled_seconds': 0.0, 'backoff_seconds': 0.0}
+
+
+def _bump(name, value=1):
+    with _lock:
+        metrics[name] += value
+
+
+def get_metrics():
+    """Request, retry and throttling counters for every keen client in this
+    process"""
+    with _lock:
+        return dict(metrics)
+
+
+def get_session():
+    """One keep-alive session with a connection pool, shared by every keen
+    client in this process"""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def get_bucket(project_id, rate=None):
+    """The token bucket shared by all clients of one keen project"""
+    with _lock:
+        if project_id not in _buckets:
+            _buckets[project_id] = TokenBucket(rate or QUERIES_PER_SECOND)
+        return _buckets[project_id]
+
+
+def _retrying_fulfill(session, bucket, max_retries, max_retry_time):
+    def fulfill(method, *args, **kwargs):
+        give_up = time() + max_retry_time
+        if current_deadline() is not None:
+            # e.g. a scheduled run's deadline, see throttle.deadline
+            give_up = min(give_up, current_deadline())
+        timeout = kwargs.get('timeout')
+        attempt = 0
+        while True:
+            _bump('throttled_seconds', bucket.acquire())
+            remaining = give_up - time()
+            if remaining <= 0:
+                raise requests.Timeout('keen request out of time')
+            kwargs['timeout'] = min(timeout or remaining, remaining)
+            _bump('requests')
+            try:
+                response = getattr(session, method)(*args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= max_retries or time() >= give_up:
+                    raise
+                response = None
+
+            if response is not None and \
+                    response.status_code not in RETRY_STATUSES:
+                return response
+            if attempt >= max_retries:
+                return response
+
+            delay = None
+            if response is not None:
+                if response.status_code == 429:
+                    _bump('rate_limited')
+                else:
+                    _bump('errors')
+                delay = retry_after_seconds(
+                    response.headers.get('Retry-After'))
+            else:
+                _bump('errors')
+            if time() + (delay or 0) >= give_up:
+                if response is None:
+                    raise requests.Timeout('keen request out of time')
+                return response
+            _bump('retries')
+            if delay is not None:
+                # the whole project has to back off, not just this query. The
+                # wait happens in the next bucket.acquire(), and is counted in
+                # throttled_seconds there
+                bucket.drain(delay)
+            else:
+                delay = min(backoff_delay(attempt), give_up - time())
+                sleep(max(delay, 0))
+                _bump('backoff_seconds', delay)
+            attempt += 1
+    return fulfill
+
+
+def get_keen_client(credentials_key, cache_path=None, base_url=None,
+                    rate=None, max_retries=MAX_RETRIES,
+                    timeout=REQUEST_TIMEOUT, max_retry_time=MAX_RETRY_TIME):
+    """ Get KeenCLient
+
+    The client shares one pooled keep-alive session and one per-project
+    token bucket with every other client in the process. 429s, 5xxs and
+    connection errors are retried with exponential backoff and jitter,
+    honoring Retry-After, for at most `max_retry_time` seconds in all and
+    not past the calling thread's throttle.deadline. See `get_metrics`.
+
+    Parameters
+    ----------
+    credentials_key : str
+        either a path to a json file containing 'project_id' and 'read_key'
+        or a service_name for keyring entries containing 'project_id' and
+        'read_key'
+    cache_path : str
+        optional path to a sqlite file. If given, count results are cached
+        there (see keen_cache.CachedKeenClient)
+    base_url : str
+        optional keen api url, e.g. a local keen_standin server. A json
+        credentials file may also set 'base_url'
+    rate : float
+        queries per second for the project, defaults to QUERIES_PER_SECOND.
+        Only used by the first client created for a project
+    max_retries : int
+    timeout : float
+        seconds to wait for one request
+    max_retry_time : float
+        seconds one call may take over all its attempts and waits
+
+    Returns
+    -------
+    KeenClient
+    """
+    if credentials_key.endswith('.json'):
+        credentials = open(credentials_key, 'r').read()
+        credentials = json.loads(credentials)
+        project_id = credentials['project_id']
+        read_key = credentials['read_key']
+        base_url = base_url or credentials.get('base_url')
+    else:
+        project_id=keyring.get_password(credentials_key, 'project_id')
+        read_key=keyring.get_password(credentials_key, 'read_key')
+
+    client = KeenClient(project_id=project_id, read_key=read_key,
+                        base_url=base_url, get_timeout=timeout)
+    session = get_session()
+    client.api.session = session
+    client.api.fulfill = _retrying_fulfill(session,
+                                           get_bucket(project_id, rate),
+                                           max_retries, max_retry_time)
+    if cache_path:
+        client = CachedKeenClient(client, cache_path)
+    return client
@@ -0,0 +1,195 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from time import time
+
+import pandas as pd
+from pytz import timezone as pytz_timezone
+
+from keen_queries import string_types
+
+
+DEFAULT_CACHE_PATH = os.path.expanduser('~/keen-query-cache.db')
+OPEN_WINDOW_TTL = 60*5 # seconds
+# windows are only cached permanently this long after they end, so events
+# keen ingests late are counted
+SETTLE_DELAY = 60*60 # seconds
+MAX_OPEN_ENTRIES = 2000
+
+_relative = re.compile(r'^(this|previous)(_\d+)?_(\w+?)s?$')
+
+
+def is_closed_window(timeframe, now=None, timezone=None,
+                     settle=SETTLE_DELAY):
+    """Whether a keen timeframe ended at least `settle` seconds ago, so its
+    counts can no longer change
+
+    Parameters
+    ----------
+    timeframe : str or dict
+        relative timeframe e.g. 'previous_day', 'this_day',
+        'previous_60_minutes' or an absolute {'start': .., 'end': ..}
+    now : pd.Timestamp
+        utc time, defaults to the current time
+    timezone : str
+        timezone of a relative timeframe, utc if not given
+    settle : float
+        seconds
+
+    Returns
+    -------
+    bool
+    """
+    now = now if now is not None else pd.Timestamp.utcnow()
+    settle = pd.Timedelta(seconds=settle)
+    if isinstance(timeframe, dict):
+        end = pd.Timestamp(timeframe['end'])
+        if end.tzinfo is None:
+            end = end.tz_localize('UTC')
+        return end + settle <= now
+    match = _relative.match(timeframe)
+    if not match:
+        return False
+    when, _, unit = match.groups()
+    # previous_N_minutes/hours slide every minute, this_* is still filling
+    if when != 'previous' or unit in ('minute', 'hour'):
+        return False
+    # previous days, weeks, months and years end at a local midnight, at
+    # the latest today's
+    if timezone and not isinstance(timezone, int):
+        local = now.tz_convert(pytz_timezone(timezone))
+    else:
+        local = now.tz_convert('UTC')
+    return local - local.normalize() >= settle
+
+
+def cache_key(event_collection, timeframe, timezone=None, filters=None,
+              group_by=None, interval=None):
+    """Stable string key for a count query. Relative timeframes are anchored
+    to the current date in the query timezone, since e.g. 'previous_day'
+    means a different day tomorrow."""
+    anchor = None
+    if not isinstance(timeframe, dict):
+        tz = None
+        if timezone and not isinstance(timezone, int):
+            tz = pytz_timezone(timezone)
+        anchor = datetime.now(tz).strftime('%Y-%m-%d')
+    if isinstance(group_by, string_types):
+        group_by = [group_by]
+    key = {'event_collection': event_collection,
+           'timeframe': timeframe,
+           'anchor': anchor,
+           'timezone': timezone,
+           'filters': filters,
+           'group_by': group_by,
+           'interval': interval}
+    return json.dumps(key, sort_keys=True)
+
+
+class CachedKeenClient(object):
+    """Wrap a KeenClient so that `count` results are kept in a local sqlite
+    file.
+
+    Windows that ended at least `settle` seconds ago are stored permanently.
+    Open windows, including ones ending at the time of the query, expire
+    after `ttl` seconds and the least recently used ones are evicted once
+    there are more than `max_open_entries`. All other attributes are passed
+    through to the wrapped client.
+    """
+
+    def __init__(self, client, path=DEFAULT_CACHE_PATH, ttl=OPEN_WINDOW_TTL,
+                 max_open_entries=MAX_OPEN_ENTRIES, settle=SETTLE_DELAY):
+        self.client = client
+        self.path = path
+        self.ttl = ttl
+        self.settle = settle
+        self.max_open_entries = max_open_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS counts ("
+            "key TEXT PRIMARY KEY, result TEXT, "
+            "expires REAL, last_used REAL)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS counts_expires ON counts (expires)")
+        self._conn.commit()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _get(self, key, now):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result, expires FROM counts WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            result, expires = row
+            if expires is not None and expires < now:
+                self._conn.execute("DELETE FROM counts WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute(
+                "UPDATE counts SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return json.loads(result)
+
+    def _put(self, key, result, closed, now):
+        expires = None if closed else now + self.ttl
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO counts VALUES (?, ?, ?, ?)",
+                (key, json.dumps(result), expires, now))
+            if not closed:
+                self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        self._conn.execute(
+            "DELETE FROM counts WHERE expires IS NOT NULL AND expires < ?",
+            (now,))
+        self._conn.execute(
+            "DELETE FROM counts WHERE key IN ("
+            "SELECT key FROM counts WHERE expires IS NOT NULL "
+            "ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_open_entries,))
+
+    def count(self, event_collection, timeframe=None, timezone=None,
+              interval=None, filters=None, group_by=None, **kwargs):
+        if kwargs:
+            # order_by/limit/max_age queries are not cached
+            return self.client.count(event_collection, timeframe=timeframe,
+                                     timezone=timezone, interval=interval,
+                                     filters=filters, group_by=group_by,
+                                     **kwargs)
+        now = time()
+        key = cache_key(event_collection, timeframe, timezone, filters,
+                        group_by, interval)
+        result = self._get(key, now)
+        if result is not None:
+            with self._lock:
+                self.hits += 1
+            return result
+
+        with self._lock:
+            self.misses += 1
+        result = self.client.count(event_collection, timeframe=timeframe,
+                                   timezone=timezone, interval=interval,
+                                   filters=filters, group_by=group_by)
+        closed = is_closed_window(timeframe, pd.Timestamp(now, unit='s',
+                                                          tz='UTC'),
+                                  timezone, self.settle)
+        self._put(key, result, closed, now)
+        return result
+
+    def stats(self):
+        """Hit/miss counters since this client was created"""
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / total if total else None}
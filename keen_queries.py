@@ -0,0 +1,197 @@
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from time import time
+import pandas as pd
+
+from throttle import carry_deadline
+
+try:
+    string_types = basestring # a group_by from json or a sheet is unicode
+except NameError:
+    string_types = str
+
+EVENTS = ['pageviewevent', 'playerload', 'prerollplay', 'prerollend',
+          'contentplay', 'cookiesdisabled', 'errorpage', 'halfevent',
+          'rewardevent']
+
+MAX_CONCURRENT_QUERIES = 5
+QUERY_TIMEOUT = 120 # seconds
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+def _track_start(func, started, i):
+    func = carry_deadline(func)
+
+    def call():
+        started[i] = time()
+        return func()
+    return call
+
+
+def run_queries(queries, max_workers=None, timeout=None):
+    """Run keen queries on a bounded thread pool
+
+    Parameters
+    ----------
+    queries : list of callable
+        each takes no arguments and returns a keen result
+    max_workers : int
+        maximum number of queries in flight at once. Defaults to
+        MAX_CONCURRENT_QUERIES
+    timeout : float
+        seconds a single query may run once it has started. Defaults to
+        QUERY_TIMEOUT. The queries also run under the calling thread's
+        throttle.deadline
+
+    Returns
+    -------
+    list
+        results in the same order as `queries`
+    """
+    if not queries:
+        return []
+    max_workers = max_workers or MAX_CONCURRENT_QUERIES
+    timeout = timeout or QUERY_TIMEOUT
+    if max_workers == 1 or len(queries) == 1:
+        return [q() for q in queries]
+
+    started = {}
+    pool = ThreadPool(min(max_workers, len(queries)))
+    try:
+        pending = [pool.apply_async(_track_start(q, started, i))
+                   for i, q in enumerate(queries)]
+        for i, res in enumerate(pending):
+            while not res.ready():
+                res.wait(0.1)
+                if i in started and time() - started[i] > timeout:
+                    raise QueryTimeout(
+                        "keen query {} exceeded {}s".format(i, timeout))
+        return [res.get() for res in pending]
+    finally:
+        pool.terminate()
+
+
+def query_spec(timeframe, timezone=None, filters=None, group_by=None):
+    """Build the keyword arguments shared by every count query in a batch
+
+    Parameters
+    ----------
+    timeframe : str or dict
+        keen timeframe e.g. 'previous_day' or {'start': .., 'end': ..}
+    timezone : str
+        e.g. 'US/Pacific'
+    filters : list of dict
+    group_by : list of str
+
+    Returns
+    -------
+    dict
+    """
+    spec = {'timeframe': timeframe}
+    if timezone:
+        spec['timezone'] = timezone
+    if filters:
+        spec['filters'] = filters
+    if group_by:
+        spec['group_by'] = list(group_by)
+    return spec
+
+
+def result_to_frame(result, event, by):
+    """Convert a grouped keen count result into a frame with one column named
+    after the event. An empty result gives an empty frame with the same
+    columns."""
+    if not result:
+        empty = {c: [] for c in by}
+        empty.update({event: []})
+        return pd.DataFrame(empty, columns=list(by) + [event])
+    return pd.DataFrame(result).rename(columns={'result': event})
+
+
+def sum_by_groups(data, by, columns):
+    """groupby-sum that keeps groups whose keys are missing (keen reports
+    e.g. a None campaign), which a plain pandas groupby would drop"""
+    if data.empty:
+        return data[list(by) + list(columns)]
+    null = '__keen_null__'
+    keys = data[by].astype(object).where(data[by].notnull(), null)
+    summed = data[list(columns)].groupby(
+        [keys[c] for c in by]).sum(min_count=1).reset_index()
+    summed[by] = summed[by].where(summed[by] != null, None)
+    return summed
+
+
+def assemble_wide(frames, by):
+    """Combine per-event count frames into one wide frame in a single pass
+
+    Each frame holds `by` plus one count column named after its event. The
+    frames are stacked into one long frame and pivoted once on the group
+    keys, so every key appears on exactly one row.
+
+    Parameters
+    ----------
+    frames : list of pd.DataFrame
+        | *by | event |
+    by : list of str
+
+    Returns
+    -------
+    pd.DataFrame
+        | *by | event_1 | .. | event_n |, events missing for a key are NaN
+    """
+    by = list(by)
+    events = [f.columns.drop(by)[0] for f in frames]
+    null = '__keen_null__'
+    long = pd.concat(
+        [pd.DataFrame({'event': e, 'count': f[e].values},
+                      columns=['event', 'count']).join(
+                          f[by].reset_index(drop=True))
+         for f, e in zip(frames, events)],
+        ignore_index=True, sort=False)
+    long[by] = long[by].astype(object).where(long[by].notnull(), null)
+    wide = long.groupby(by + ['event'], sort=False)['count'].sum() \
+        .unstack('event').reindex(columns=events).reset_index()
+    wide.columns.name = None
+    wide[by] = wide[by].where(wide[by] != null, None)
+    return wide
+
+
+def count_events(client, events, timeframe, timezone=None, filters=None,
+                 group_by=None, max_workers=None, timeout=None):
+    """Count several event collections over the same timeframe, timezone,
+    filters and group_by
+
+    Keen's multi_analysis endpoint only runs several analyses against a single
+    event collection, so each collection is still its own request. All of them
+    are built from one shared query spec here and split back into one frame
+    per event. The requests run concurrently through `run_queries`.
+
+    Parameters
+    ----------
+    client : keen.client.KeenClient
+    events : list of str
+        event collections to count
+    timeframe : str or dict
+    timezone : str
+    filters : list of dict
+    group_by : list of str
+    max_workers : int
+        see `run_queries`
+    timeout : float
+        see `run_queries`
+
+    Returns
+    -------
+    list of pd.DataFrame
+        one frame per event, in the same order as `events`:
+        | *group_by | event |
+    """
+    by = list(group_by or [])
+    spec = query_spec(timeframe, timezone, filters, by)
+    queries = [partial(client.count, event_collection=e, **spec)
+               for e in events]
+    results = run_queries(queries, max_workers, timeout)
+    return [result_to_frame(r, e, by) for r, e in zip(results, events)]
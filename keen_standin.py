@@ -0,0 +1,367 @@
+"""
+A local stand-in for the keen query API, for load testing the reports and the
+alert loop without keen credentials.
+
+    python keen_standin.py --port 8765 --campaigns 500 --latency 0.5
+
+then point a client at it with `get_keen_client(path, base_url=...)` or
+`get_standin_client('http://localhost:8765')`.
+
+Queries are answered from a replay file of recorded responses when one
+matches, otherwise counts are synthesized from a fixed universe of
+program/campaign/refer/vidid rows. Latency, server errors and 429 rate-limit
+responses can be injected.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import zlib
+from datetime import datetime, timedelta
+from time import sleep, time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+from keen.client import KeenClient
+
+from keen_queries import string_types
+
+
+KEEN_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+
+# events per row per minute
+EVENT_RATES = {
+    'pageviewevent': 8.0,
+    'playerload': 5.0,
+    'prerollplay': 1.5,
+    'prerollend': 1.2,
+    'contentplay': 4.0,
+    'cookiesdisabled': 0.1,
+    'errorpage': 0.05,
+    'halfevent': 2.0,
+    'rewardevent': 0.5}
+
+UNIT_MINUTES = {'minute': 1, 'hour': 60, 'day': 60*24, 'week': 60*24*7,
+                'month': 60*24*30, 'year': 60*24*365}
+INTERVAL_MINUTES = {'minutely': 1, 'hourly': 60, 'daily': 60*24,
+                    'weekly': 60*24*7}
+
+_relative = re.compile(r'^(this|previous)(?:_(\d+))?_(\w+?)s?$')
+
+
+class StandInConfig(object):
+    """Behaviour of the stand-in server
+
+    Parameters
+    ----------
+    programs, campaigns, refers, vidids : int
+        cardinality of each group_by property
+    latency : float
+        seconds added to every query
+    jitter : float
+        up to this many extra seconds are added at random
+    error_rate : float
+        fraction of queries answered with a 500
+    throttle_rate : float
+        fraction of queries answered with a 429
+    max_qps : float
+        queries per second above which a 429 is returned
+    retry_after : int
+        Retry-After seconds sent with a 429
+    replay_path : str
+        json file of recorded responses keyed by `query_key`
+    record_path, upstream : str
+        when both are set, queries that are not in the replay file are
+        forwarded to `upstream` (e.g. https://api.keen.io) and the responses
+        are saved to `record_path`
+    seed : int
+    """
+
+    def __init__(self, programs=3, campaigns=100, refers=6, vidids=1000,
+                 latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                 max_qps=None, retry_after=1, replay_path=None,
+                 record_path=None, upstream=None, seed=0):
+        self.programs = programs
+        self.campaigns = campaigns
+        self.refers = refers
+        self.vidids = vidids
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_qps = max_qps
+        self.retry_after = retry_after
+        self.replay_path = replay_path
+        self.record_path = record_path
+        self.upstream = upstream
+        self.seed = seed
+
+
+def query_key(params):
+    """Canonical key for a query, used to look up recorded responses"""
+    return json.dumps(sorted((k, v) for k, v in params.items()
+                             if k != 'api_key'))
+
+
+def _rows(config):
+    """The universe of synthetic group rows. Every campaign runs on each
+    refer and belongs to one program."""
+    rows = []
+    for c in range(config.campaigns):
+        for r in range(config.refers):
+            i = c*config.refers + r
+            rows.append({'program': 'program-%d' % (c % config.programs),
+                         'campaign': 'campaign-%d' % c,
+                         'refer': 'refer-%d' % r,
+                         'vidid': 'vid-%d' % (i % config.vidids)})
+    return rows
+
+
+def _window(timeframe, timezone, now):
+    """Absolute (start, end) utc datetimes for a timeframe. Relative
+    timeframes ignore the timezone, which is fine for synthetic data."""
+    if isinstance(timeframe, dict):
+        parse = lambda s: datetime.strptime(s[:19], '%Y-%m-%dT%H:%M:%S')
+        return parse(timeframe['start']), parse(timeframe['end'])
+    match = _relative.match(timeframe or 'this_day')
+    when, n, unit = match.groups() if match else ('this', None, 'day')
+    minutes = UNIT_MINUTES.get(unit, UNIT_MINUTES['day']) * int(n or 1)
+    end = now.replace(second=0, microsecond=0)
+    if when == 'this':
+        return end - timedelta(minutes=minutes), now
+    return end - timedelta(minutes=minutes), end
+
+
+def _count(config, event, row_index, minutes):
+    rate = EVENT_RATES.get(event, 1.0) * minutes
+    key = '%s|%s|%s' % (config.seed, event, row_index)
+    factor = 0.5 + (zlib.crc32(key.encode('utf8')) & 0xffff) / 65535.0
+    return int(rate * factor)
+
+
+def synthesize_count(config, params, now=None):
+    """Answer a count query from the synthetic universe
+
+    Parameters
+    ----------
+    params : dict
+        decoded keen query parameters: event_collection, timeframe, timezone,
+        interval, group_by. Filters are accepted and ignored.
+
+    Returns
+    -------
+    int, list of dict or list of interval dicts, like keen
+    """
+    now = now or datetime.utcnow()
+    event = params['event_collection']
+    start, end = _window(params.get('timeframe'), params.get('timezone'), now)
+    group_by = params.get('group_by')
+    if isinstance(group_by, string_types):
+        group_by = [group_by]
+
+    rows = _rows(config)
+
+    def grouped(minutes):
+        if not group_by:
+            return sum(_count(config, event, i, minutes)
+                       for i in range(len(rows)))
+        totals = {}
+        for i, row in enumerate(rows):
+            key = tuple(row.get(c) for c in group_by)
+            totals[key] = totals.get(key, 0) + _count(config, event, i,
+                                                      minutes)
+        result = []
+        for key, n in totals.items():
+            record = dict(zip(group_by, key))
+            record['result'] = n
+            result.append(record)
+        return result
+
+    interval = params.get('interval')
+    if not interval:
+        return grouped((end - start).total_seconds() / 60.0)
+
+    step = timedelta(minutes=INTERVAL_MINUTES.get(interval, 60))
+    result = []
+    bucket = start
+    while bucket < end:
+        bucket_end = min(bucket + step, end)
+        result.append({
+            'timeframe': {'start': bucket.strftime(KEEN_TIME_FORMAT),
+                          'end': bucket_end.strftime(KEEN_TIME_FORMAT)},
+            'value': grouped((bucket_end - bucket).total_seconds() / 60.0)})
+        bucket = bucket_end
+    return result
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        HTTPServer.__init__(self, address, StandInHandler)
+        self.config = config
+        self.lock = threading.Lock()
+        self.recorded = {}
+        if config.replay_path:
+            self.recorded = json.load(open(config.replay_path, 'r'))
+        self.stats = {'queries': 0, 'replayed': 0, 'synthesized': 0,
+                      'recorded': 0, 'errors': 0, 'throttled': 0}
+        self._second = None
+        self._in_second = 0
+
+    @property
+    def base_url(self):
+        return 'http://%s:%s' % self.server_address[:2]
+
+    def over_qps(self):
+        if not self.config.max_qps:
+            return False
+        with self.lock:
+            second = int(time())
+            if second != self._second:
+                self._second = second
+                self._in_second = 0
+            self._in_second += 1
+            return self._in_second > self.config.max_qps
+
+    def record(self, key, response):
+        with self.lock:
+            self.recorded[key] = response
+            self.stats['recorded'] += 1
+            json.dump(self.recorded, open(self.config.record_path, 'w'))
+
+    def bump(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        config = server.config
+        url = urlparse(self.path)
+        if url.path == '/_standin/stats':
+            return self._send(200, server.stats)
+        if '/queries/' not in url.path:
+            return self._send(404, {'message': 'not found',
+                                    'error_code': 'ResourceNotFoundError'})
+
+        server.bump('queries')
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        sleep(config.latency + random.random()*config.jitter)
+
+        if server.over_qps() or random.random() < config.throttle_rate:
+            server.bump('throttled')
+            return self._send(
+                429, {'message': 'rate limit exceeded',
+                      'error_code': 'TooManyRequestsError'},
+                {'Retry-After': str(config.retry_after)})
+        if random.random() < config.error_rate:
+            server.bump('errors')
+            return self._send(500, {'message': 'injected error',
+                                    'error_code': 'InternalServerError'})
+
+        key = query_key(params)
+        if key in server.recorded:
+            server.bump('replayed')
+            return self._send(200, server.recorded[key])
+        if config.upstream and config.record_path:
+            return self._record(key)
+
+        analysis = url.path.rsplit('/', 1)[-1]
+        if analysis != 'count':
+            return self._send(400, {'message': 'only count is synthesized',
+                                    'error_code': 'InvalidParameterError'})
+        for k in ('timeframe', 'group_by', 'filters'):
+            if params.get(k, '').startswith(('{', '[')):
+                params[k] = json.loads(params[k])
+        server.bump('synthesized')
+        return self._send(200, {'result': synthesize_count(config, params)})
+
+    def _record(self, key):
+        import requests
+        res = requests.get(self.server.config.upstream + self.path,
+                           headers={'Authorization':
+                                    self.headers.get('Authorization')})
+        body = res.json()
+        if res.status_code == 200:
+            self.server.record(key, body)
+        return self._send(res.status_code, body)
+
+
+def serve(config=None, host='localhost', port=0):
+    """Start a stand-in server on a background thread
+
+    Returns
+    -------
+    StandInServer
+        call `.shutdown()` to stop it; `.base_url` is the url to point a
+        KeenClient at
+    """
+    server = StandInServer((host, port), config or StandInConfig())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def get_standin_client(base_url):
+    return KeenClient(project_id='standin', read_key='standin',
+                      base_url=base_url)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--programs', type=int, default=3)
+    parser.add_argument('--campaigns', type=int, default=100)
+    parser.add_argument('--refers', type=int, default=6)
+    parser.add_argument('--vidids', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--max-qps', type=float, default=None)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--replay')
+    parser.add_argument('--record')
+    parser.add_argument('--upstream')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    config = StandInConfig(
+        programs=args.programs, campaigns=args.campaigns, refers=args.refers,
+        vidids=args.vidids, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+        max_qps=args.max_qps, retry_after=args.retry_after,
+        replay_path=args.replay, record_path=args.record,
+        upstream=args.upstream, seed=args.seed)
+    server = StandInServer((args.host, args.port), config)
+    print('keen stand-in listening on {}'.format(server.base_url))
+    server.serve_forever()
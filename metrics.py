@@ -0,0 +1,307 @@
+"""
+The columns of the keen report and the metrics computed from them, declared
+in one place.
+
+`REPORT_METRICS` lists every report column in order. Input columns (group
+keys, event counts, reference rates) are only named; metrics have a formula
+over other columns in the ALERT-RULES syntax, e.g.
+
+    data["prerollplay"] / data["playerload"]
+
+compiled once with alert_engine.compile_formula. `lookup(data["col"])`
+takes, on each row, the value of the column that row's `col` names, as one
+indexed gather over the named columns. Metrics are computed in dependency
+order, each as one vectorized operation over numpy arrays, and added to the
+report together. The report's column order is the registry's order.
+
+Metrics can also be declared without code changes, in an optional METRICS
+sheet of BW-Video-Keen-Key with 'name', 'formula' and optional 'after'
+columns, see `MetricRegistry.extended`.
+"""
+from warnings import warn
+
+import numpy as np
+import pandas as pd
+
+from alert_engine import AlertRuleError, SharedResults, compile_formula
+
+
+class MetricError(ValueError):
+    pass
+
+
+def lookup(columns, names):
+    """
+    For each row, the value in the column the row names
+
+    Parameters
+    ----------
+    columns : mapping
+        {column name: np.ndarray}
+    names : np.ndarray
+        a column name per row. Missing names give NaN
+
+    Returns
+    -------
+    np.ndarray of float
+    """
+    names = np.asarray(names, dtype=object)
+    n = len(names)
+    codes, uniques = pd.factorize(names)
+    result = np.full(n, np.nan)
+    if not len(uniques):
+        return result
+    unknown = [u for u in uniques if u not in columns]
+    if unknown:
+        warn("lookup of columns missing from the report: {}".format(unknown))
+    # one row per distinct name, then one gather of each row's own name
+    stacked = np.vstack([
+        np.asarray(columns[u], dtype=float) if u in columns
+        else np.full(n, np.nan) for u in uniques])
+    rows = np.flatnonzero(codes >= 0)
+    result[rows] = stacked[codes[rows], rows]
+    return result
+
+
+FUNCTIONS = {'lookup': lookup}
+
+
+class _Columns(dict):
+    """Arrays of a frame's columns, taken from the frame as they are first
+    used, plus the metrics computed so far"""
+
+    def __init__(self, data):
+        dict.__init__(self)
+        self.data = data
+
+    def __missing__(self, name):
+        if name not in self.data.columns:
+            raise KeyError(name)
+        values = self[name] = self.data[name].values
+        return values
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in self.data.columns
+
+
+class Column(object):
+    """
+    A report column, computed by `formula` if it has one
+
+    Parameters
+    ----------
+    name : str
+    formula : str
+        None for an input column
+    optional : bool
+        an input left out of the report when missing, or a metric skipped
+        with a warning when the columns it reads are missing or it can't be
+        computed from them. Otherwise a missing column is a KeyError
+    """
+
+    def __init__(self, name, formula=None, optional=False):
+        self.name = name
+        self.formula = formula
+        self.optional = optional
+        self.columns = set()
+        if formula:
+            try:
+                self._evaluate, self.columns, _ = compile_formula(formula,
+                                                                  FUNCTIONS)
+            except AlertRuleError as e:
+                raise MetricError("metric '{}': {}".format(name, e))
+
+    def __repr__(self):
+        return '<Column {}{}>'.format(
+            self.name, ': ' + self.formula if self.formula else '')
+
+    def evaluate(self, columns, n):
+        with np.errstate(all='ignore'):
+            result = np.asarray(self._evaluate(columns, SharedResults()))
+        if result.ndim == 0:
+            result = np.repeat(result, n)
+        return result
+
+
+class MetricRegistry(object):
+    """
+    The report's columns in order, see the module docstring
+
+    Parameters
+    ----------
+    columns : list of Column
+    """
+
+    def __init__(self, columns=()):
+        self.columns = []
+        for column in columns:
+            self.add(column)
+
+    def __repr__(self):
+        return '<MetricRegistry {}>'.format([c.name for c in self.columns])
+
+    def names(self):
+        return [c.name for c in self.columns]
+
+    def add(self, column, after=None):
+        """Add a Column, at the end or after the column named `after`. A
+        column of the same name is replaced in place."""
+        names = self.names()
+        if column.name in names:
+            if after is None:
+                self.columns[names.index(column.name)] = column
+                return
+            self.columns.pop(names.index(column.name))
+            names.remove(column.name)
+        if after is None:
+            self.columns.append(column)
+        elif after in names:
+            self.columns.insert(names.index(after) + 1, column)
+        else:
+            raise MetricError("can't add '{}' after missing column '{}'".format(
+                column.name, after))
+
+    def extended(self, sheet):
+        """
+        A copy with the metrics of a METRICS sheet added
+
+        Parameters
+        ----------
+        sheet : pd.DataFrame
+            'name', 'formula' and optional 'after' columns. A metric with the
+            name of an existing column replaces it. Sheet metrics are
+            optional, so one whose columns are missing is skipped, and rows
+            that can't be added (a bad formula, a missing `after` column or a
+            dependency cycle) are skipped with a warning, as alert rules are
+
+        Returns
+        -------
+        MetricRegistry
+        """
+        registry = MetricRegistry(self.columns)
+        sheet = sheet.replace('', np.nan)
+        for row in sheet.to_dict('records'):
+            if pd.isnull(row.get('name')) or pd.isnull(row.get('formula')):
+                continue
+            after = row.get('after')
+            extended = MetricRegistry(registry.columns)
+            try:
+                extended.add(Column(row['name'], row['formula'],
+                                    optional=True),
+                             None if pd.isnull(after) else after)
+                extended.metrics()
+            except MetricError as e:
+                warn('skipping METRICS row: {}'.format(e))
+                continue
+            registry = extended
+        return registry
+
+    def metrics(self):
+        """The columns with formulas, each after the metrics it reads"""
+        metrics = [c for c in self.columns if c.formula]
+        by_name = dict((c.name, c) for c in metrics)
+        ordered = []
+        state = {}
+
+        def visit(metric, path):
+            if state.get(metric.name) == 'done':
+                return
+            if state.get(metric.name) == 'visiting':
+                raise MetricError('metrics depend on each other: {}'.format(
+                    ' -> '.join(path + [metric.name])))
+            state[metric.name] = 'visiting'
+            for name in sorted(metric.columns):
+                if name in by_name and name != metric.name:
+                    visit(by_name[name], path + [metric.name])
+            state[metric.name] = 'done'
+            ordered.append(metric)
+
+        for metric in metrics:
+            visit(metric, [])
+        return ordered
+
+    def compute(self, data):
+        """
+        Add the metrics to a report
+
+        Parameters
+        ----------
+        data : pd.DataFrame
+
+        Returns
+        -------
+        pd.DataFrame
+            a copy with a column per metric, replacing existing columns of
+            the same name
+
+        Raises
+        ------
+        KeyError
+            if a metric that isn't optional reads a missing column
+        """
+        columns = _Columns(data)
+        new = {}
+        for metric in self.metrics():
+            missing = [c for c in metric.columns if c not in columns]
+            if missing:
+                if metric.optional:
+                    warn("skipping metric '{}': missing columns {}".format(
+                        metric.name, sorted(missing)))
+                    continue
+                raise KeyError("metric '{}' needs missing columns {}".format(
+                    metric.name, missing))
+            try:
+                values = metric.evaluate(columns, len(data))
+            except Exception as e:
+                if not metric.optional:
+                    raise
+                warn("skipping metric '{}': {!r}".format(metric.name, e))
+                continue
+            new[metric.name] = columns[metric.name] = values
+        if not new:
+            return data.copy()
+        kept = data[[c for c in data.columns if c not in new]]
+        computed = pd.DataFrame(new, index=data.index,
+                                columns=[m for m in self.names() if m in new])
+        return pd.concat([kept, computed], axis=1)
+
+    def order(self, data):
+        """The registered columns of a report, in registry order. Missing
+        optional columns are left out; a missing column that isn't optional
+        is a KeyError."""
+        return data[[c.name for c in self.columns
+                     if not c.optional or c.name in data.columns]]
+
+
+REPORT_METRICS = MetricRegistry([
+    Column('program'),
+    Column('campaign'),
+    Column('refer'),
+    Column('pageviewevent'),
+    Column('playerload'),
+    Column('prerollplay'),
+    Column('preroll/playerload', 'data["prerollplay"] / data["playerload"]'),
+    Column('prerollend'),
+    Column('preroll_complete_rate',
+           'data["prerollplay"] / data["prerollend"]'),
+    Column('contentplay'),
+    Column('preroll/content', 'data["prerollplay"] / data["contentplay"]'),
+    Column('cookiesdisabled'),
+    Column('errorpage'),
+    Column('error_rate', 'data["errorpage"] / data["playerload"]'),
+    Column('halfevent'),
+    Column('halfevent_rate', 'data["halfevent"] / data["playerload"]'),
+    Column('rewardevent'),
+    Column('rewardevent_rate', 'data["rewardevent"] / data["playerload"]'),
+    Column('revenue_rate'),
+    Column('cost_rate'),
+    Column('cost_multiplier'),
+    Column('cost_event_variable'),
+    Column('keen_rev', 'data["revenue_rate"] * data["prerollplay"]'),
+    # the count of the event named by the row's cost_event_variable
+    Column('keen_cost', 'lookup(data["cost_event_variable"]) * '
+                        'data["cost_rate"] * data["cost_multiplier"]'),
+    Column('encrave_cost', optional=True),
+    Column('encrave_source', optional=True),
+    Column('keen_profit', 'data["keen_rev"] - data["keen_cost"]'),
+    Column('keen_margin', 'data["keen_profit"] / data["keen_cost"]')])
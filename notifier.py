@@ -0,0 +1,298 @@
+"""
+Texts a cycle's alerts to on-call as one digest per recipient.
+
+All alert messages of a cycle are joined into as few texts as the SMS length
+limit allows, and the texts to every recipient are sent concurrently on a
+thread pool through one twilio client (whose http session pools its
+connections), with 429s and server errors retried with backoff.
+
+    python notifier.py --alerts 50 --recipients 3 --latency 0.2
+
+sends synthetic alerts through `StandInTransport`, a local stand-in for the
+twilio client, and prints the throughput of one-text-per-alert sequential
+sending against digests sent concurrently.
+"""
+import argparse
+import random
+import re
+import threading
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
+from warnings import warn
+
+from throttle import RETRY_STATUSES, backoff_delay
+
+
+MAX_SMS_LENGTH = 1600 # twilio's limit on a message body
+MAX_CONCURRENT_SMS = 8
+MAX_RETRIES = 4
+PART_RESERVE = len('(99/99) ')
+
+_part_number = re.compile(r'^\(\d+/\d+\) ')
+
+
+def _number(n):
+    return n.replace("-", "").replace(" ", "")
+
+
+def _status(error):
+    """http status of a twilio (or stand-in) api error, or None"""
+    status = getattr(error, 'status', None)
+    if status is None:
+        status = getattr(error, 'code', None)
+    return status
+
+
+def _lines(alert, limit):
+    """An alert message as the lines of at most `limit` characters it is
+    sent as"""
+    return [alert[i:i + limit] for i in range(0, len(alert), limit)]
+
+
+def build_digests(alerts, max_length=MAX_SMS_LENGTH):
+    """
+    Join alert messages, one per line, into as few texts as fit
+
+    Parameters
+    ----------
+    alerts : list of str
+        repeated messages are sent once
+    max_length : int
+
+    Returns
+    -------
+    list of str
+        texts of at most `max_length` characters, numbered '(1/n) ' when
+        there is more than one. A message too long for one text is split
+    """
+    limit = max_length - PART_RESERVE
+    lines = []
+    seen = set()
+    for alert in alerts:
+        if alert in seen:
+            continue
+        seen.add(alert)
+        lines.extend(_lines(alert, limit))
+
+    texts = []
+    current = ''
+    for line in lines:
+        if current and len(current) + 1 + len(line) > limit:
+            texts.append(current)
+            current = line
+        else:
+            current = current + '\n' + line if current else line
+    if current:
+        texts.append(current)
+    if len(texts) > 1:
+        texts = ['({}/{}) {}'.format(i + 1, len(texts), t)
+                 for i, t in enumerate(texts)]
+    return texts
+
+
+def undelivered(alerts, failures, max_length=MAX_SMS_LENGTH):
+    """
+    The alerts that are, in whole or in part, in a text that couldn't be
+    sent to at least one recipient
+
+    Parameters
+    ----------
+    alerts : list of str
+        as passed to `build_digests`
+    failures : list of (str, str, Exception)
+        as returned by `SmsNotifier.send`
+
+    Returns
+    -------
+    list of str
+    """
+    failed = set()
+    for to, body, error in failures:
+        failed.update(_part_number.sub('', body, count=1).split('\n'))
+    limit = max_length - PART_RESERVE
+    return [a for a in alerts if any(line in failed
+                                     for line in _lines(a, limit))]
+
+
+class SmsNotifier(object):
+    """
+    Sends digests of alerts to every 'to' number
+
+    Parameters
+    ----------
+    client : twilio.rest.Client or StandInTransport
+        shared by all sends, keep one for the life of the process
+    twilio_numbers : dict
+        {'from': number, 'to': [numbers]}, see run_alerts.get_twilio_numbers
+    max_length : int
+        characters per text
+    max_workers : int
+        texts in flight at once
+    max_retries : int
+        retries of one text on 429s and 5xxs
+    """
+
+    def __init__(self, client, twilio_numbers, max_length=MAX_SMS_LENGTH,
+                 max_workers=MAX_CONCURRENT_SMS, max_retries=MAX_RETRIES):
+        self.client = client
+        self.from_ = _number(twilio_numbers['from'])
+        self.to = [_number(n) for n in twilio_numbers['to']]
+        self.max_length = max_length
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self.counts = {'alerts': 0, 'texts': 0, 'sent': 0, 'failed': 0,
+                       'retries': 0}
+
+    def _bump(self, name, value=1):
+        with self._lock:
+            self.counts[name] += value
+
+    def _deliver(self, task):
+        to, body = task
+        attempt = 0
+        while True:
+            try:
+                self.client.messages.create(body=body, to=to, from_=self.from_)
+                self._bump('sent')
+                return None
+            except Exception as e:
+                if _status(e) not in RETRY_STATUSES or \
+                        attempt >= self.max_retries:
+                    self._bump('failed')
+                    warn("could not text {}: {}".format(to, e))
+                    return (to, body, e)
+            self._bump('retries')
+            sleep(backoff_delay(attempt))
+            attempt += 1
+
+    def send(self, alerts):
+        """
+        Text the alerts of one cycle. Failed texts are warned about and
+        returned rather than raised, so one bad number doesn't stop the rest
+
+        Returns
+        -------
+        list of (str, str, Exception)
+            (to, body, error) of the texts that could not be sent
+        """
+        texts = build_digests(alerts, self.max_length)
+        self._bump('alerts', len(alerts))
+        tasks = [(to, body) for to in self.to for body in texts]
+        self._bump('texts', len(tasks))
+        if tasks:
+            print("sending {} alerts as {} texts each to {}".format(
+                len(alerts), len(texts), self.to))
+        if len(tasks) <= 1 or self.max_workers == 1:
+            results = [self._deliver(t) for t in tasks]
+        else:
+            pool = ThreadPool(min(self.max_workers, len(tasks)))
+            try:
+                results = pool.map(self._deliver, tasks)
+            finally:
+                pool.terminate()
+        return [r for r in results if r is not None]
+
+    def stats(self):
+        """alerts passed to `send`, texts tried, sent and failed, and
+        retries"""
+        with self._lock:
+            return dict(self.counts)
+
+
+class StandInError(Exception):
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class _StandInMessages(object):
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def create(self, body, to, from_):
+        t = self.transport
+        sleep(t.latency + t._random() * t.jitter)
+        if t._random() < t.throttle_rate:
+            t._record('throttled')
+            raise StandInError(429, 'too many requests')
+        if t._random() < t.error_rate:
+            t._record('errors')
+            raise StandInError(503, 'injected error')
+        if len(body) > MAX_SMS_LENGTH:
+            t._record('errors')
+            raise StandInError(400, 'body longer than {}'.format(
+                MAX_SMS_LENGTH))
+        t._record('sent', (to, from_, body))
+
+
+class StandInTransport(object):
+    """
+    Offline stand-in for twilio.rest.Client: `messages.create` sleeps for
+    `latency` plus up to `jitter` seconds, fails with a 429 or 503 at the
+    given rates and otherwise records the message in `sent`
+
+    Parameters
+    ----------
+    latency, jitter : float
+    error_rate, throttle_rate : float
+    seed : int
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.messages = _StandInMessages(self)
+        self.sent = []
+        self.stats = {'sent': 0, 'errors': 0, 'throttled': 0}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _random(self):
+        with self._lock:
+            return self._rng.random()
+
+    def _record(self, stat, message=None):
+        with self._lock:
+            self.stats[stat] += 1
+            if message is not None:
+                self.sent.append(message)
+
+
+def _compare(n_alerts, n_recipients, latency):
+    alerts = ["'alert-%d': check campaigns: '['campaign-%d']'" % (i, i)
+              for i in range(n_alerts)]
+    numbers = {'from': '555-0100',
+               'to': ['555-01%02d' % (i + 1) for i in range(n_recipients)]}
+
+    transport = StandInTransport(latency)
+    start = time()
+    for alert in alerts:
+        for to in numbers['to']:
+            transport.messages.create(body=alert, to=_number(to),
+                                      from_=_number(numbers['from']))
+    sequential = time() - start
+    print('one text per alert, sequential: {} texts in {:.2f}s'.format(
+        len(transport.sent), sequential))
+
+    transport = StandInTransport(latency)
+    notifier = SmsNotifier(transport, numbers)
+    start = time()
+    notifier.send(alerts)
+    digests = time() - start
+    print('digests, concurrent: {} texts in {:.2f}s'.format(
+        len(transport.sent), digests))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--alerts', type=int, default=50)
+    parser.add_argument('--recipients', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.2)
+    args = parser.parse_args()
+    _compare(args.alerts, args.recipients, args.latency)
@@ -1,3 +1,11 @@
+import json
+import os
+import random
+import re
+import threading
+from collections import deque
+from time import sleep, strftime, gmtime, time
+
 import pandas as pd
 
 
@@ -56,3 +64,456 @@ def read_sheets(title, sheet=None):
         return sheet_to_function_map[sheet]
     else:
         return sheet_to_function_map
+
+
+# A file-backed stand-in for the parts of gspread the reports use, so the
+# publishing paths in sheets.py can run, be benchmarked and have their api
+# calls counted without a google account:
+#
+#     gc = get_offline_client('/tmp/sheets', latency=0.2)
+#     write_to_sheets(gc, report, 'BW-Video-Keen', sheetname)
+#     gc.stats()
+
+
+DEFAULT_OFFLINE_DIR = os.path.expanduser('~/offline-sheets')
+
+# google's per-user sheets api limits, in requests per QUOTA_WINDOW seconds
+READ_QUOTA = 60
+WRITE_QUOTA = 60
+QUOTA_WINDOW = 60
+MAX_CELLS = 5000000 # per spreadsheet
+
+_text = (str, type(u''))
+_a1_cell = re.compile(r'^([A-Z]*)(\d*)$')
+
+
+class OfflineSheetsError(Exception):
+    """An error the sheets api would have returned, with its http `code`"""
+
+    def __init__(self, code, message):
+        Exception.__init__(self, '{}: {}'.format(code, message))
+        self.code = code
+
+
+class SpreadsheetNotFound(OfflineSheetsError):
+    def __init__(self, title):
+        OfflineSheetsError.__init__(self, 404, title)
+
+
+class WorksheetNotFound(OfflineSheetsError):
+    def __init__(self, title):
+        OfflineSheetsError.__init__(self, 404, title)
+
+
+class QuotaExceeded(OfflineSheetsError):
+    def __init__(self, kind):
+        OfflineSheetsError.__init__(
+            self, 429, "Quota exceeded for '{} requests per minute per "
+                       "user'".format(kind))
+
+
+def _col_number(letters):
+    n = 0
+    for c in letters:
+        n = n*26 + ord(c) - 64
+    return n
+
+
+def parse_range(label):
+    """Split an A1 range like "'Sheet 1'!A1:C3" into the worksheet title
+    (None if there is none) and 1-indexed (top, left, bottom, right). Open
+    ended bounds are None."""
+    title = None
+    if '!' in label:
+        title, label = label.rsplit('!', 1)
+    elif not all(_a1_cell.match(p) for p in label.upper().split(':')):
+        # a whole worksheet
+        title, label = label, ''
+    if title and title.startswith("'"):
+        title = title[1:-1].replace("''", "'")
+    if not label:
+        return title, (None, None, None, None)
+    parts = label.upper().split(':')
+    start = _a1_cell.match(parts[0]).groups()
+    end = _a1_cell.match(parts[-1]).groups()
+    to_int = lambda s, f: f(s) if s else None
+    return title, (to_int(start[1], int), to_int(start[0], _col_number),
+                   to_int(end[1], int), to_int(end[0], _col_number))
+
+
+def _stored(value):
+    """Cell value as the api hands it back: a formatted string"""
+    if value is None:
+        return ''
+    if value is True or value is False:
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and value == int(value):
+        return str(int(value))
+    return value if isinstance(value, _text) else str(value)
+
+
+def _trim(values):
+    """Drop trailing blank rows and columns, as the api does"""
+    rows = [list(r) for r in values]
+    for row in rows:
+        while row and row[-1] == '':
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+class OfflineCell(object):
+
+    def __init__(self, row, col, value=''):
+        self.row = row
+        self.col = col
+        self.value = value
+
+    def __repr__(self):
+        return '<OfflineCell R{}C{} {!r}>'.format(self.row, self.col,
+                                                  self.value)
+
+
+class OfflineWorksheet(object):
+
+    def __init__(self, spreadsheet, id, title, rows, cols, values=None):
+        self.spreadsheet = spreadsheet
+        self.id = id
+        self.title = title
+        self.row_count = rows
+        self.col_count = cols
+        self._values = values or []
+
+    def __repr__(self):
+        return '<OfflineWorksheet {!r}>'.format(self.title)
+
+    def _get(self, row, col):
+        if row <= len(self._values) and col <= len(self._values[row - 1]):
+            return self._values[row - 1][col - 1]
+        return ''
+
+    def _set(self, row, col, value):
+        if row > self.row_count or col > self.col_count:
+            raise OfflineSheetsError(
+                400, "Range ('{}'!R{}C{}) exceeds grid limits. Max rows: {}, "
+                     "max columns: {}".format(self.title, row, col,
+                                              self.row_count, self.col_count))
+        while len(self._values) < row:
+            self._values.append([])
+        cells = self._values[row - 1]
+        while len(cells) < col:
+            cells.append('')
+        cells[col - 1] = _stored(value)
+
+    def _bounds(self, bounds):
+        top, left, bottom, right = bounds
+        return (top or 1, left or 1, bottom or self.row_count,
+                right or self.col_count)
+
+    def _read(self, bounds):
+        top, left, bottom, right = self._bounds(bounds)
+        return _trim([[self._get(r, c) for c in range(left, right + 1)]
+                      for r in range(top, bottom + 1)])
+
+    def _write(self, bounds, values):
+        top, left = self._bounds(bounds)[:2]
+        for i, row in enumerate(values):
+            for j, value in enumerate(row):
+                self._set(top + i, left + j, value)
+
+    def get_all_values(self):
+        self.spreadsheet.client._call('get_all_values', 'read')
+        return self._read((None, None, None, None))
+
+    def get_all_records(self):
+        values = self.get_all_values()
+        if not values:
+            return []
+        return [dict(zip(values[0], row + [''] * (len(values[0]) - len(row))))
+                for row in values[1:]]
+
+    def range(self, label):
+        self.spreadsheet.client._call('range', 'read')
+        top, left, bottom, right = self._bounds(parse_range(label)[1])
+        return [OfflineCell(r, c, self._get(r, c))
+                for r in range(top, bottom + 1)
+                for c in range(left, right + 1)]
+
+    def update_cells(self, cells):
+        self.spreadsheet.client._call('update_cells', 'write')
+        for cell in cells:
+            self._set(cell.row, cell.col, cell.value)
+        self.spreadsheet._save(self)
+
+    def update_cell(self, row, col, value):
+        self.spreadsheet.client._call('update_cell', 'write')
+        self._set(row, col, value)
+        self.spreadsheet._save(self)
+
+    def insert_row(self, values, index=1):
+        # gspread inserts the row and then writes its values: two requests
+        self.spreadsheet.client._call('insert_row', 'write', requests=2)
+        self.spreadsheet._check_size(self.col_count)
+        self.row_count += 1
+        while len(self._values) < index - 1:
+            self._values.append([])
+        self._values.insert(index - 1, [])
+        for j, value in enumerate(values):
+            self._set(index, j + 1, value)
+        self.spreadsheet._save(self)
+
+    def resize(self, rows=None, cols=None):
+        self.spreadsheet.client._call('resize', 'write')
+        self.row_count = rows or self.row_count
+        self.col_count = cols or self.col_count
+        self._values = [r[:self.col_count]
+                        for r in self._values[:self.row_count]]
+        self.spreadsheet._save(self)
+
+
+def _dump(obj, path):
+    tmp = path + '.tmp'
+    json.dump(obj, open(tmp, 'w'))
+    os.rename(tmp, path)
+
+
+class OfflineSpreadsheet(object):
+    """A spreadsheet stored as a directory with an index file and one json
+    file of values per worksheet, so a request only rewrites the worksheet
+    it touched"""
+
+    def __init__(self, client, title, path):
+        self.client = client
+        self.title = title
+        self.path = path
+        self.updated = None
+        self._worksheets = []
+        self._next_id = 0
+        index = os.path.join(path, 'spreadsheet.json')
+        if os.path.exists(index):
+            stored = json.load(open(index, 'r'))
+            self.updated = stored['updated']
+            self._next_id = stored['next_id']
+            self._worksheets = [
+                OfflineWorksheet(self, w['id'], w['title'], w['rows'],
+                                 w['cols'],
+                                 json.load(open(self._values_path(w['id']))))
+                for w in stored['worksheets']]
+
+    def __repr__(self):
+        return '<OfflineSpreadsheet {!r}>'.format(self.title)
+
+    def _values_path(self, id):
+        return os.path.join(self.path, 'sheet-{}.json'.format(id))
+
+    def _save(self, worksheet=None):
+        """Store the index and the values of `worksheet`"""
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.updated = strftime('%Y-%m-%dT%H:%M:%S.000Z', gmtime())
+        if worksheet is not None:
+            _dump(worksheet._values, self._values_path(worksheet.id))
+        _dump({'title': self.title, 'updated': self.updated,
+               'next_id': self._next_id,
+               'worksheets': [{'id': w.id, 'title': w.title,
+                               'rows': w.row_count, 'cols': w.col_count}
+                              for w in self._worksheets]},
+              os.path.join(self.path, 'spreadsheet.json'))
+
+    def _check_size(self, new_cells):
+        cells = sum(w.row_count * w.col_count for w in self._worksheets)
+        if cells + new_cells > MAX_CELLS:
+            raise OfflineSheetsError(
+                400, 'This action would increase the number of cells in the '
+                     'workbook above the limit of {} cells.'.format(MAX_CELLS))
+
+    def _find(self, title):
+        for w in self._worksheets:
+            if w.title == title:
+                return w
+        raise WorksheetNotFound(title)
+
+    @property
+    def lastUpdateTime(self):
+        self.client._call('lastUpdateTime', 'read')
+        return self.updated
+
+    def worksheets(self):
+        self.client._call('worksheets', 'read')
+        return list(self._worksheets)
+
+    def worksheet(self, title):
+        self.client._call('worksheet', 'read')
+        return self._find(title)
+
+    def add_worksheet(self, title, rows, cols):
+        self.client._call('add_worksheet', 'write')
+        if any(w.title == title for w in self._worksheets):
+            raise OfflineSheetsError(
+                400, 'A sheet with the name "{}" already exists.'.format(title))
+        self._check_size(rows * cols)
+        wks = OfflineWorksheet(self, self._next_id, title, rows, cols)
+        self._next_id += 1
+        self._worksheets.append(wks)
+        self._save(wks)
+        return wks
+
+    def del_worksheet(self, worksheet):
+        self.client._call('del_worksheet', 'write')
+        wks = self._find(worksheet.title)
+        self._worksheets.remove(wks)
+        self._save()
+        os.remove(self._values_path(wks.id))
+
+    def values_update(self, range, params=None, body=None):
+        self.client._call('values_update', 'write')
+        title, bounds = parse_range(range)
+        wks = self._find(title)
+        wks._write(bounds, body['values'])
+        self._save(wks)
+        return {'updatedRange': range}
+
+    def values_batch_update(self, body=None):
+        self.client._call('values_batch_update', 'write')
+        touched = []
+        for value_range in body['data']:
+            title, bounds = parse_range(value_range['range'])
+            wks = self._find(title)
+            wks._write(bounds, value_range['values'])
+            if wks not in touched:
+                touched.append(wks)
+        for wks in touched:
+            self._save(wks)
+        return {'totalUpdatedRanges': len(body['data'])}
+
+    def values_batch_get(self, ranges, params=None):
+        self.client._call('values_batch_get', 'read')
+        value_ranges = []
+        for label in ranges:
+            title, bounds = parse_range(label)
+            value_range = {'range': label}
+            values = self._find(title)._read(bounds)
+            if values:
+                value_range['values'] = values
+            value_ranges.append(value_range)
+        return {'spreadsheetId': self.title, 'valueRanges': value_ranges}
+
+
+class OfflineSheetsClient(object):
+    """
+    Local, file-backed stand-in for a gspread client. Each spreadsheet is a
+    directory of json files in `directory`. Every api request is counted (see `stats`),
+    delayed by `latency` plus up to `jitter` seconds and checked against
+    google's per-user read and write quotas.
+
+    Parameters
+    ----------
+    directory : str
+    latency, jitter : float
+        seconds added to every request
+    read_quota, write_quota : int
+        requests allowed per `quota_window` seconds. None for no limit
+    quota_window : float
+    wait_for_quota : bool
+        if False requests over quota raise QuotaExceeded (a 429) like the
+        api does, otherwise they block until the quota allows them
+    create_missing : bool
+        open() creates spreadsheets that don't exist yet instead of raising
+        SpreadsheetNotFound
+    """
+
+    def __init__(self, directory=DEFAULT_OFFLINE_DIR, latency=0.0, jitter=0.0,
+                 read_quota=READ_QUOTA, write_quota=WRITE_QUOTA,
+                 quota_window=QUOTA_WINDOW, wait_for_quota=False,
+                 create_missing=True):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.latency = latency
+        self.jitter = jitter
+        self.quota = {'read': read_quota, 'write': write_quota}
+        self.quota_window = quota_window
+        self.wait_for_quota = wait_for_quota
+        self.create_missing = create_missing
+        self.calls = {}
+        self._recent = {'read': deque(), 'write': deque()}
+        self._lock = threading.Lock()
+
+    def _path(self, title):
+        name = re.sub(r'[^\w-]+', '_', title)
+        return os.path.join(self.directory, name)
+
+    def _call(self, method, kind, requests=1):
+        for _ in range(requests):
+            self._use_quota(kind)
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + requests
+        sleep(self.latency + random.random()*self.jitter)
+
+    def _use_quota(self, kind):
+        limit = self.quota[kind]
+        recent = self._recent[kind]
+        while True:
+            with self._lock:
+                now = time()
+                while recent and recent[0] <= now - self.quota_window:
+                    recent.popleft()
+                if limit is None or len(recent) < limit:
+                    recent.append(now)
+                    return
+                if not self.wait_for_quota:
+                    self.calls['rejected'] = self.calls.get('rejected', 0) + 1
+                    raise QuotaExceeded(kind)
+                wait = recent[0] + self.quota_window - now
+            sleep(wait)
+
+    def stats(self):
+        """Requests made so far by method, with the 'total'. Requests
+        rejected for quota are counted under 'rejected'."""
+        with self._lock:
+            calls = dict(self.calls)
+        calls['total'] = sum(n for k, n in calls.items() if k != 'rejected')
+        return calls
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = {}
+
+    def open(self, title):
+        self._call('open', 'read')
+        path = self._path(title)
+        if not os.path.exists(path):
+            if not self.create_missing:
+                raise SpreadsheetNotFound(title)
+            return self.create(title, count=False)
+        return OfflineSpreadsheet(self, title, path)
+
+    def create(self, title, count=True):
+        if count:
+            self._call('create', 'write')
+        wb = OfflineSpreadsheet(self, title, self._path(title))
+        wb._save()
+        return wb
+
+
+def get_offline_client(directory=DEFAULT_OFFLINE_DIR, **kwargs):
+    """An OfflineSheetsClient, usable wherever sheets.py expects the client
+    from get_gdrive_client. See OfflineSheetsClient for the options."""
+    return OfflineSheetsClient(directory, **kwargs)
+
+
+def load_samples(gc, title='BW-Video-Keen-Key'):
+    """Write the sample reference sheets above into an offline spreadsheet,
+    replacing any existing worksheets of the same name"""
+    from sheets import frame_to_values, update_values
+    wb = gc.open(title)
+    existing = dict((w.title, w) for w in wb.worksheets())
+    for name, df in sheet_to_function_map.items():
+        if name in existing:
+            wb.del_worksheet(existing[name])
+        values = frame_to_values(df)
+        wks = wb.add_worksheet(title=name, rows=len(values),
+                               cols=len(values[0]))
+        update_values(wb, wks, values)
+    return wb
@@ -0,0 +1,108 @@
+import json
+import threading
+
+from keen_queries import result_to_frame, string_types, sum_by_groups
+
+
+def _ordered_union(group_bys):
+    union = []
+    for by in group_bys:
+        union.extend(c for c in by if c not in union)
+    return union
+
+
+class RollupPlanner(object):
+    """Wrap a KeenClient so that count queries at several group_by
+    granularities over the same timeframe are answered from one server side
+    query at the finest granularity.
+
+    Declare every group_by a run needs with `need` before querying. A later
+    `count` for a declared group_by is served by querying the finest declared
+    group_by that contains it (once per event) and summing it down locally.
+    With `combine=True` group_bys that don't nest, e.g. ['vidid', 'campaign']
+    and ['campaign', 'refer'], are all served from their union.
+
+    Interval queries and undeclared group_bys go straight to the wrapped
+    client. All other attributes are passed through too.
+    """
+
+    def __init__(self, client, combine=False):
+        self.client = client
+        self.combine = combine
+        self.needs = {}
+        self.fetched = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    @staticmethod
+    def _window(timeframe, timezone, filters):
+        return json.dumps([timeframe, timezone, filters or []],
+                          sort_keys=True)
+
+    def need(self, timeframe, timezone, group_by, filters=None):
+        """Declare a group_by that will be queried over a timeframe"""
+        window = self._window(timeframe, timezone, filters)
+        self.needs.setdefault(window, [])
+        if list(group_by) not in self.needs[window]:
+            self.needs[window].append(list(group_by))
+
+    def finest(self, timeframe, timezone, group_by, filters=None):
+        """The group_by that will actually be sent to keen for `group_by`, or
+        None if it was not declared"""
+        window = self._window(timeframe, timezone, filters)
+        declared = self.needs.get(window, [])
+        if list(group_by) not in declared:
+            return None
+        if self.combine:
+            return _ordered_union(declared)
+        supersets = [by for by in declared if set(group_by) <= set(by)]
+        return max(supersets, key=len)
+
+    def plan(self):
+        """Queries per window: {window: [group_by sent to keen, ..]}"""
+        plan = {}
+        for window, declared in self.needs.items():
+            tf, tz, filters = json.loads(window)
+            finest = [self.finest(tf, tz, by, filters) for by in declared]
+            plan[window] = [by for i, by in enumerate(finest)
+                            if by not in finest[:i]]
+        return plan
+
+    def _fetch(self, event_collection, timeframe, timezone, filters, by):
+        key = (event_collection,
+               self._window(timeframe, timezone, filters), tuple(by))
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # concurrent requests for the same event wait for one query
+        with key_lock:
+            if key not in self.fetched:
+                result = self.client.count(event_collection,
+                                           timeframe=timeframe,
+                                           timezone=timezone, filters=filters,
+                                           group_by=by)
+                self.fetched[key] = result_to_frame(result, 'result', by)
+            return self.fetched[key]
+
+    def count(self, event_collection, timeframe=None, timezone=None,
+              interval=None, filters=None, group_by=None, **kwargs):
+        by = [group_by] if isinstance(group_by, string_types) else group_by
+        finest = None
+        if by and not interval and not kwargs:
+            finest = self.finest(timeframe, timezone, by, filters)
+        if finest is None:
+            return self.client.count(event_collection, timeframe=timeframe,
+                                     timezone=timezone, interval=interval,
+                                     filters=filters, group_by=group_by,
+                                     **kwargs)
+
+        data = self._fetch(event_collection, timeframe, timezone, filters,
+                           finest)
+        if list(by) != list(finest):
+            data = sum_by_groups(data, list(by), ['result'])
+        records = data[list(by) + ['result']].to_dict('records')
+        for r in records:
+            r['result'] = int(r['result'])
+        return records
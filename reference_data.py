@@ -0,0 +1,134 @@
+import os
+import pickle
+import re
+import threading
+import weakref
+from time import ctime, time
+from warnings import warn
+
+from sheets import read_sheets
+
+
+REFERENCE_TITLE = "BW-Video-Keen-Key"
+CACHE_DIR = os.path.expanduser('~')
+CHECK_INTERVAL = 60 # seconds between modified time checks
+TTL = 60*60 # seconds, used when the modified time is not available
+
+
+def _modified_time(gc, title):
+    """The spreadsheet's last modified time, or None if this gspread version
+    doesn't expose it. The spreadsheet is opened again rather than through
+    sheets.open_workbook, whose handle keeps the modified time it was opened
+    with."""
+    wb = gc.open(title)
+    for attr in ('lastUpdateTime', 'updated'):
+        value = getattr(wb, attr, None)
+        if value:
+            return str(value)
+    return None
+
+
+class ReferenceData(object):
+    """
+    Cache of every worksheet of a reference workbook (FILTERS, COST RATE,
+    REVENUE RATE, ALERT-RULES, ALERT-EXCLUSIONS in BW-Video-Keen-Key).
+
+    The whole workbook is loaded in one batch read and kept in memory and in
+    a pickle on disk. It is reloaded only when the spreadsheet's modified time
+    changes, checked at most every `check_interval` seconds, or after `ttl`
+    seconds if the modified time is not available. If Sheets can't be
+    reached the cached frames are served.
+    """
+
+    def __init__(self, gc, title=REFERENCE_TITLE, cache_dir=CACHE_DIR,
+                 check_interval=CHECK_INTERVAL, ttl=TTL):
+        self.gc = gc
+        self.title = title
+        self.check_interval = check_interval
+        self.ttl = ttl
+        name = re.sub(r'[^\w-]+', '_', title)
+        self.path = os.path.join(cache_dir, 'keen-reference-{}.pkl'.format(name))
+        self.frames = None
+        self.modified = None
+        self.loaded = 0
+        self.checked = 0
+        self._lock = threading.Lock()
+        self._load_disk()
+
+    def _load_disk(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            cached = pickle.load(open(self.path, 'rb'))
+        except Exception as e:
+            warn("ignoring unreadable reference cache {}: {}".format(
+                self.path, e))
+            return
+        self.frames = cached['frames']
+        self.modified = cached['modified']
+        self.loaded = cached['loaded']
+
+    def _save_disk(self):
+        tmp = self.path + '.tmp'
+        pickle.dump({'frames': self.frames, 'modified': self.modified,
+                     'loaded': self.loaded},
+                    open(tmp, 'wb'), pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path)
+
+    def _stale(self, now):
+        """(whether the workbook needs to be reloaded, its modified time if
+        it was fetched). May call the api."""
+        if self.frames is None:
+            return True, None
+        if now - self.checked < self.check_interval:
+            return False, None
+        self.checked = now
+        modified = _modified_time(self.gc, self.title)
+        if modified is None:
+            return now - self.loaded > self.ttl, None
+        return modified != self.modified, modified
+
+    def refresh(self, force=False):
+        """Reload the workbook if it changed. Keeps the cached frames if
+        Sheets can't be reached."""
+        now = time()
+        with self._lock:
+            try:
+                stale, modified = (True, None) if force else self._stale(now)
+                if not stale:
+                    return
+                if modified is None:
+                    modified = _modified_time(self.gc, self.title)
+                frames = read_sheets(self.gc, self.title)
+            except Exception as e:
+                if self.frames is None:
+                    raise
+                warn("could not refresh '{}', using cached copy from {}: "
+                     "{}".format(self.title, ctime(self.loaded), e))
+                return
+            self.frames = frames
+            self.modified = modified
+            self.loaded = now
+            self.checked = now
+            self._save_disk()
+
+    def get(self, sheet=None):
+        """Same contract as sheets.read_sheets(gc, title, sheet). Copies are
+        returned so callers can modify them."""
+        self.refresh()
+        if sheet:
+            df = self.frames.get(sheet)
+            return None if df is None else df.copy()
+        return {k: df.copy() for k, df in self.frames.items()}
+
+
+_caches = weakref.WeakKeyDictionary()
+
+
+def read_reference_sheets(gc, sheet=None, title=REFERENCE_TITLE):
+    """read_sheets for the reference workbook, served from a ReferenceData
+    cache shared by everything using the same client"""
+    caches = _caches.setdefault(gc, {})
+    if title not in caches:
+        caches[title] = ReferenceData(gc, title)
+    return caches[title].get(sheet)
@@ -0,0 +1,207 @@
+"""
+A local archive of every published report, for trend analysis and as a
+fallback when google sheets is slow or down.
+
+Snapshots are stored as parquet files partitioned by report name and run
+date,
+
+    ~/keen-report-archive/report=<name>/run_date=<YYYY-MM-DD>/<run time>.parquet
+
+so `load_reports` only opens the files of the requested reports and dates,
+and only reads the requested columns. Without pyarrow snapshots are pickled
+into the same layout instead.
+"""
+import os
+import re
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+DEFAULT_ARCHIVE_DIR = os.path.expanduser('~/keen-report-archive')
+RUN_TIME_FORMAT = '%Y%m%dT%H%M%S'
+MAX_CATEGORY_FRACTION = 0.5 # string columns with fewer distinct values are categorical
+MISSING = ('', '-', 'NULL')
+# names, never turned into numbers, so ids like '00123' keep their zeros
+KEY_COLUMNS = ('program', 'campaign', 'refer', 'cost_event_variable')
+_text = (str, type(u''))
+# pandas' own string dtype, where this pandas version has one
+_string_dtypes = tuple(t for t in [getattr(pd, 'StringDtype', None)] if t)
+
+
+def _safe_name(name):
+    return re.sub(r'[^\w-]+', '_', name).strip('_')
+
+
+def _as_text(value):
+    """Text values as they are, so py2 unicode isn't encoded, others as
+    text"""
+    if isinstance(value, _text) or value is None or \
+            (isinstance(value, float) and np.isnan(value)):
+        return value
+    return type(u'')(value)
+
+
+def _compact_column(s, key=False):
+    """Smallest dtype that holds a column's values. Object columns whose
+    values are numbers apart from blank, '-' or 'NULL' placeholders become
+    numeric, unless they are `key` columns, other object columns strings or
+    categoricals. Integers, and floats holding only whole numbers, are
+    downcast to the smallest integer type; other floats are left alone so
+    rates and costs keep their precision."""
+    if s.dtype == object or isinstance(s.dtype, _string_dtypes):
+        non_missing = s[s.notnull() & ~s.isin(MISSING)]
+        numeric = None if key else pd.to_numeric(non_missing, errors='coerce')
+        if not key and len(non_missing) and numeric.notnull().all():
+            s = pd.to_numeric(s.where(~s.isin(MISSING)), errors='coerce')
+        else:
+            s = s.map(_as_text).astype(object)
+            if s.nunique() <= MAX_CATEGORY_FRACTION * max(len(s), 1):
+                return s.astype('category')
+            return s
+    if s.dtype.kind in 'iu':
+        return pd.to_numeric(s, downcast='integer')
+    if s.dtype.kind == 'f' and s.notnull().all() and \
+            (s == s.round()).all() and len(s):
+        # counts that went through a merge and came out as floats
+        return pd.to_numeric(s.astype(np.int64), downcast='integer')
+    return s
+
+
+def compact_frame(data):
+    """A copy of `data` with compact dtypes (see `_compact_column`), a
+    default index and string column names"""
+    data = data.reset_index(drop=True)
+    return pd.DataFrame(dict((str(c), _compact_column(data[c],
+                                                      c in KEY_COLUMNS))
+                             for c in data.columns),
+                        columns=[str(c) for c in data.columns])
+
+
+def archive_report(data, report_name, run_time=None,
+                   directory=DEFAULT_ARCHIVE_DIR):
+    """
+    Store one report snapshot in the archive
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+    report_name : str
+        e.g. 'bw-video-keen-yesterday'
+    run_time : datetime
+        when the report ran, defaults to now. Its date is the partition
+    directory : str
+
+    Returns
+    -------
+    str
+        path of the snapshot file
+    """
+    run_time = run_time or datetime.now()
+    partition = os.path.join(
+        directory, 'report={}'.format(_safe_name(report_name)),
+        'run_date={}'.format(run_time.strftime('%Y-%m-%d')))
+    if not os.path.isdir(partition):
+        os.makedirs(partition)
+
+    data = compact_frame(data)
+    data['run_time'] = pd.Timestamp(run_time.replace(tzinfo=None))
+    name = run_time.strftime(RUN_TIME_FORMAT)
+    if pa is not None:
+        path = os.path.join(partition, name + '.parquet')
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        pq.write_table(table, path + '.tmp', compression='snappy')
+    else:
+        path = os.path.join(partition, name + '.pkl')
+        data.to_pickle(path + '.tmp')
+    os.rename(path + '.tmp', path)
+    return path
+
+
+def _partition_values(path, key):
+    prefix = key + '='
+    if not os.path.isdir(path):
+        return []
+    return sorted(d[len(prefix):] for d in os.listdir(path)
+                  if d.startswith(prefix))
+
+
+def list_reports(directory=DEFAULT_ARCHIVE_DIR):
+    """Names of the archived reports"""
+    return _partition_values(directory, 'report')
+
+
+def _snapshot_paths(report_name, start, end, directory):
+    report_dir = os.path.join(directory,
+                              'report={}'.format(_safe_name(report_name)))
+    start = pd.Timestamp(start).strftime('%Y-%m-%d') if start else None
+    end = pd.Timestamp(end).strftime('%Y-%m-%d') if end else None
+    paths = []
+    for run_date in _partition_values(report_dir, 'run_date'):
+        if (start and run_date < start) or (end and run_date > end):
+            continue
+        partition = os.path.join(report_dir, 'run_date=' + run_date)
+        paths.extend(os.path.join(partition, f)
+                     for f in sorted(os.listdir(partition))
+                     if f.endswith(('.parquet', '.pkl')))
+    return paths
+
+
+def _read_snapshot(path, columns):
+    if path.endswith('.parquet'):
+        if pa is None:
+            raise ImportError('pyarrow is needed to read {}'.format(path))
+        if columns is not None:
+            available = pq.read_schema(path).names
+            columns = [c for c in columns if c in available]
+        return pq.read_table(path, columns=columns).to_pandas()
+    data = pd.read_pickle(path)
+    if columns is not None:
+        data = data[[c for c in columns if c in data.columns]]
+    return data
+
+
+def load_reports(report_name, start=None, end=None, columns=None,
+                 directory=DEFAULT_ARCHIVE_DIR):
+    """
+    Read archived snapshots of a report back
+
+    Parameters
+    ----------
+    report_name : str
+    start, end : str or datetime
+        first and last run date to read, inclusive. Other dates' files are
+        not opened
+    columns : list of str
+        columns to read, e.g. ['campaign', 'refer', 'prerollplay']. The
+        'run_time' column identifying the snapshot is always included
+    directory : str
+
+    Returns
+    -------
+    pd.DataFrame
+        the snapshots one below the other, empty if there are none
+    """
+    if columns is not None and 'run_time' not in columns:
+        columns = list(columns) + ['run_time']
+    frames = [_read_snapshot(p, columns)
+              for p in _snapshot_paths(report_name, start, end, directory)]
+    if not frames:
+        return pd.DataFrame({}, columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+
+def latest_report(report_name, directory=DEFAULT_ARCHIVE_DIR):
+    """The most recent snapshot of a report, without its run_time column, or
+    None if there isn't one"""
+    paths = _snapshot_paths(report_name, None, None, directory)
+    if not paths:
+        return None
+    return _read_snapshot(paths[-1], None).drop('run_time', axis=1)
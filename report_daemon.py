@@ -0,0 +1,315 @@
+"""
+One long-lived process that runs every scheduled report, in place of a cron
+entry per script.
+
+    python report_daemon.py                     # run the reports on schedule
+    python report_daemon.py --status            # ask a running daemon
+    python report_daemon.py --run bw-hourly     # start a report now
+
+Credentials are read and the keen and google clients created once and kept
+for every run, so the keen client's pooled session and query cache, the
+hourly count store and the reference workbook cache stay warm between
+reports, and reports over the same windows share cached keen counts. The
+google client is re-authorized every GDRIVE_MAX_AGE seconds, before its
+token expires, and a report's paced sheets client authorizes again if it
+gets a 401 mid-run. Each report checks its run between steps, so a run past
+its deadline stops there. The reports run with scheduler.Scheduler on the
+times in `report_jobs`. A small http control interface listens on localhost:
+
+    GET  /jobs              each job's schedule, run counts and last run
+    POST /jobs/<name>/run   start a run of a job now
+    POST /reload            create the clients again on their next use
+"""
+import argparse
+import json
+import threading
+import warnings
+from functools import partial
+from time import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import Request, urlopen, HTTPError
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+
+import run
+import run_bw_hourly
+import run_bw_video_keen
+import run_update_exclusions_list
+from hourly_store import HourlyCountStore
+from keen_access import get_keen_client
+from keen_cache import DEFAULT_CACHE_PATH
+from scheduler import DailyJob, Job, Scheduler
+from sheets import GDRIVE_MAX_AGE, get_gdrive_client
+
+
+KEYDIR = "/home/robertdavidwest/"
+KEEN_CREDENTIALS = 'keen-buzzworthy-aol.json'
+GDRIVE_CREDENTIALS = 'gdrive-keen-buzzworthy-aol.json'
+CONTROL_PORT = 8767
+
+
+class Clients(object):
+    """
+    The keen client, google client and hourly count store shared by every
+    report, created on first use
+
+    Parameters
+    ----------
+    keydir : str
+        directory of the credentials files
+    gdrive_max_age : float
+        seconds after which the google client is authorized again
+    """
+
+    def __init__(self, keydir=KEYDIR, gdrive_max_age=GDRIVE_MAX_AGE):
+        self.keydir = keydir
+        self.gdrive_max_age = gdrive_max_age
+        self._keen = None
+        self._gdrive = None
+        self._gdrive_created = 0
+        self._store = None
+        self._lock = threading.Lock()
+
+    def keen(self):
+        with self._lock:
+            if self._keen is None:
+                self._keen = get_keen_client(self.keydir + KEEN_CREDENTIALS,
+                                             cache_path=DEFAULT_CACHE_PATH)
+            return self._keen
+
+    def gdrive(self):
+        with self._lock:
+            now = time()
+            if self._gdrive is None or \
+                    now - self._gdrive_created > self.gdrive_max_age:
+                self._gdrive = get_gdrive_client(self.keydir +
+                                                 GDRIVE_CREDENTIALS)
+                self._gdrive_created = now
+            return self._gdrive
+
+    def store(self):
+        with self._lock:
+            if self._store is None:
+                self._store = HourlyCountStore()
+            return self._store
+
+    def reset(self):
+        """Create the clients again on their next use, e.g. after the
+        credentials changed"""
+        with self._lock:
+            self._keen = None
+            self._gdrive = None
+
+    def warm(self):
+        """Create every client now, so the first reports don't pay for it"""
+        for get in (self.keen, self.gdrive, self.store):
+            try:
+                get()
+            except Exception as e:
+                warnings.warn('could not create {} client: {}'.format(
+                    get.__name__, e))
+
+
+def _bw_hourly(clients, job_run):
+    run_bw_hourly.main(clients.keen(), clients.gdrive(), clients.store(),
+                       job_run)
+
+
+def _bw_video_keen(clients, job_run):
+    run_bw_video_keen.main(clients.keen(), clients.gdrive(), clients.store(),
+                           job_run)
+
+
+def _keen_aol_datafeed(clients, job_run):
+    run.main(clients.keen(), clients.gdrive(), job_run)
+
+
+def _update_exclusions(clients, job_run):
+    run_update_exclusions_list.main(clients.keen(), clients.gdrive())
+
+
+def _encrave(clients, job_run):
+    # needs the gmail api package, only imported when the job runs
+    import get_latest_encrave_report
+    get_latest_encrave_report.main(clients.gdrive())
+
+
+def report_jobs(clients):
+    """
+    The scheduled reports. Encrave costs are fetched before the snapshots
+    that merge them.
+
+    Parameters
+    ----------
+    clients : Clients
+
+    Returns
+    -------
+    list of scheduler.Job
+    """
+    return [
+        Job('bw-hourly', partial(_bw_hourly, clients), every=60*60,
+            offset=5*60, deadline=50*60),
+        DailyJob('update-exclusions', partial(_update_exclusions, clients),
+                 at='05:45', timezone='US/Eastern'),
+        DailyJob('encrave', partial(_encrave, clients),
+                 at='06:00', timezone='US/Eastern'),
+        DailyJob('keen-aol-datafeed', partial(_keen_aol_datafeed, clients),
+                 at='06:15', timezone='US/Eastern'),
+        DailyJob('bw-video-keen', partial(_bw_video_keen, clients),
+                 at='06:30', timezone='US/Eastern')]
+
+
+def _schedule(job):
+    if isinstance(job, DailyJob):
+        return 'daily at {:02d}:{:02d} {}'.format(job.at[0], job.at[1],
+                                                  job.timezone.zone)
+    return 'every {:g}s, offset {:g}s'.format(job.every, job.offset)
+
+
+class ReportDaemon(object):
+    """
+    Runs the report jobs and serves the control interface
+
+    Parameters
+    ----------
+    clients : Clients
+    jobs : list of scheduler.Job
+        defaults to report_jobs(clients)
+    host, port : str, int
+        address of the control interface
+    """
+
+    def __init__(self, clients=None, jobs=None, host='localhost',
+                 port=CONTROL_PORT):
+        self.clients = clients or Clients()
+        self.scheduler = Scheduler(jobs or report_jobs(self.clients))
+        self.host = host
+        self.port = port
+        self.server = None
+
+    def status(self):
+        """{job name: schedule, next run, whether it is running and the
+        scheduler's stats}"""
+        now = time()
+        stats = self.scheduler.stats()
+        running = self.scheduler.running()
+        status = {}
+        for job in self.scheduler.jobs:
+            status[job.name] = dict(stats[job.name],
+                                    schedule=_schedule(job),
+                                    next_tick=job.next_tick(now),
+                                    running=job.name in running)
+        return status
+
+    def trigger(self, name):
+        """Start a job now. Returns whether a run was started."""
+        return self.scheduler.trigger(name) is not None
+
+    def serve(self):
+        """Start the control interface on a background thread"""
+        self.server = ControlServer((self.host, self.port), self)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.server
+
+    def run_forever(self):
+        self.clients.warm()
+        self.serve()
+        print('report daemon control at http://{}:{}'.format(
+            *self.server.server_address[:2]))
+        try:
+            self.scheduler.run_forever()
+        finally:
+            self.server.shutdown()
+
+    def stop(self):
+        self.scheduler.stop()
+
+
+class ControlServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, report_daemon):
+        HTTPServer.__init__(self, address, ControlHandler)
+        self.report_daemon = report_daemon
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body, sort_keys=True).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _parts(self):
+        return [p for p in self.path.split('?')[0].split('/') if p]
+
+    def do_GET(self):
+        parts = self._parts()
+        status = self.server.report_daemon.status()
+        if parts == ['jobs']:
+            return self._send(200, status)
+        if len(parts) == 2 and parts[0] == 'jobs' and parts[1] in status:
+            return self._send(200, status[parts[1]])
+        return self._send(404, {'message': 'not found'})
+
+    def do_POST(self):
+        parts = self._parts()
+        daemon = self.server.report_daemon
+        if parts == ['reload']:
+            daemon.clients.reset()
+            return self._send(200, {'reloaded': True})
+        if len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'run':
+            try:
+                started = daemon.trigger(parts[1])
+            except KeyError as e:
+                return self._send(404, {'message': e.args[0]})
+            return self._send(202 if started else 409, {'started': started})
+        return self._send(404, {'message': 'not found'})
+
+
+def _request(url, method='GET'):
+    request = Request(url, data=b'' if method == 'POST' else None)
+    try:
+        response = urlopen(request)
+    except HTTPError as e:
+        response = e
+    return json.loads(response.read().decode('utf8'))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=CONTROL_PORT)
+    parser.add_argument('--keydir', default=KEYDIR)
+    parser.add_argument('--status', action='store_true',
+                        help="print a running daemon's jobs")
+    parser.add_argument('--run', metavar='JOB',
+                        help='start a job of a running daemon now')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    url = 'http://{}:{}'.format(args.host, args.port)
+    if args.status:
+        print(json.dumps(_request(url + '/jobs'), indent=2, sort_keys=True))
+    elif args.run:
+        print(_request('{}/jobs/{}/run'.format(url, args.run), 'POST'))
+    else:
+        ReportDaemon(Clients(args.keydir), host=args.host,
+                     port=args.port).run_forever()
@@ -1,39 +1,13 @@
-import keyring
 import json
 import pandas as pd
 from datetime import datetime
 from pytz import timezone
 
-from keen.client import KeenClient
+from keen_access import get_keen_client
+from keen_queries import assemble_wide, count_events
 #from selenium_aol import get_aol_data
 from sheets import get_gdrive_client, write_to_sheets, clean_sheets
-
-
-def get_keen_client(credentials_key):
-    """ Get KeenCLient
-
-    Parameters
-    ----------
-    credentials_key : str
-        either a path to a json file containing 'project_id' and 'read_key'
-        or a service_name for keyring entries containing 'project_id' and
-        'read_key'
-
-    Returns
-    -------
-    KeenClient
-    """
-    if credentials_key.endswith('.json'):
-        credentials = open(credentials_key, 'r').read()
-        credentials = json.loads(credentials)
-        project_id = credentials['project_id']
-        read_key = credentials['read_key']
-    else:
-        project_id=keyring.get_password(credentials_key, 'project_id')
-        read_key=keyring.get_password(credentials_key, 'read_key')
-
-    client = KeenClient(project_id=project_id, read_key=read_key)
-    return client
+from report_archive import archive_report
 
 
 def get_keen_data(client, timeframe):
@@ -56,38 +30,31 @@ im
     """
     print 'reading: {}'.format(timeframe)
 
-    prerolls = client.count(event_collection='prerollplay',
-                            timeframe=timeframe,
-                            group_by=['campaign', 'refer'])
-    prerolls = pd.DataFrame(prerolls)
-    prerolls.rename(columns={'result': 'prerollplay'}, inplace=True)
-
-    content = client.count(event_collection='contentplay',
-                            timeframe=timeframe,
-                            group_by=['campaign', 'refer'])
-    content = pd.DataFrame(content)
-    content.rename(columns={'result': 'contentplay'}, inplace=True)
-
-    results = pd.merge(prerolls,
-                       content,
-                       on=['campaign', 'refer'],
-                       how='outer')
+    prerolls, content = count_events(client, ['prerollplay', 'contentplay'],
+                                     timeframe,
+                                     group_by=['campaign', 'refer'])
+
+    results = assemble_wide([prerolls, content], ['campaign', 'refer'])
     results = results.sort_values(['campaign', 'refer'], ascending=False)
     results.reset_index(inplace=True, drop=True)
     results.fillna(0, inplace=True)
     return results
 
 
-if __name__ == '__main__':
-
-
+def main(keen_client=None, gdrive_client=None, job_run=None):
+    """Write yesterday's and this month's counts to the datafeed workbook.
+    Clients are created when they aren't passed in. A scheduler.Run
+    `job_run` that is cancelled or past its deadline stops the run after
+    yesterday's counts."""
     title = "Buzzworthy - Keen - AOL - Datafeed"
 
-    keen_client = get_keen_client(
-        '/home/robertdavidwest/keen-buzzworthy-aol.json')
+    if keen_client is None:
+        keen_client = get_keen_client(
+            '/home/robertdavidwest/keen-buzzworthy-aol.json')
 
-    gdrive_client = get_gdrive_client(
-        '/home/robertdavidwest/gdrive-keen-buzzworthy-aol.json')
+    if gdrive_client is None:
+        gdrive_client = get_gdrive_client(
+            '/home/robertdavidwest/gdrive-keen-buzzworthy-aol.json')
 
     '''
     aol_portal_json = '/home/robertdavidwest/aol-portal.json'
@@ -112,11 +79,19 @@ if __name__ == '__main__':
     sheetname = '{} {}'.format(display_now, 'Yesterday')
     results = get_keen_data(keen_client, timeframe=timeframe)
     write_to_sheets(gdrive_client, results, title, sheetname)
+    archive_report(results, '{} {}'.format(title, 'Yesterday'), eastern_now)
+    if job_run is not None:
+        job_run.check()
 
     timeframe = 'this_month'
     sheetname = '{} {}'.format(display_now, timeframe)
     results = get_keen_data(keen_client, timeframe=timeframe)
     write_to_sheets(gdrive_client, results, title, sheetname)
+    archive_report(results, '{} {}'.format(title, timeframe), eastern_now)
 
     # No more than 20 sheets in workbook. Older results are deleted.
     clean_sheets(gdrive_client, title, max_sheets=20)
+
+
+if __name__ == '__main__':
+    main()
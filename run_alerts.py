@@ -1,23 +1,41 @@
-from copy import deepcopy
 import json
-import pandas as pd
-import numpy as np
+from time import time
 from twilio.rest import Client
 import warnings
-from time import time
 
 import offline_sheets
-from sheets import get_gdrive_client, read_sheets
+from sheets import GDRIVE_MAX_AGE, get_gdrive_client
+from reference_data import read_reference_sheets
 from run import get_keen_client
-from run_bw_video_keen import get_keen_report
+from keen_cache import DEFAULT_CACHE_PATH
+from run_bw_video_keen import get_filters, get_keen_report
+from alert_engine import evaluate_rules
+from alert_log import AlertLog
+from notifier import SmsNotifier, undelivered
 
 
-KEEP_ALERT_TIME = 60*60 # seconds
+_twilio_clients = {}
+_gdrive_clients = {}
 
 
 def get_twilio_client(path):
-    d = json.load(open(path, 'r'))
-    return Client(d['account_sid'], d['auth_token'])
+    """One client per credentials file for the life of the process, so its
+    http connections are reused between alert cycles"""
+    if path not in _twilio_clients:
+        d = json.load(open(path, 'r'))
+        _twilio_clients[path] = Client(d['account_sid'], d['auth_token'])
+    return _twilio_clients[path]
+
+
+def get_shared_gdrive_client(path):
+    """One google client per credentials file, kept between alert cycles so
+    the reference sheets stay cached, and authorized again once it is
+    GDRIVE_MAX_AGE seconds old"""
+    client, created = _gdrive_clients.get(path, (None, 0))
+    if client is None or time() - created > GDRIVE_MAX_AGE:
+        client, created = get_gdrive_client(path), time()
+        _gdrive_clients[path] = (client, created)
+    return client
 
 
 def get_twilio_numbers(path):
@@ -25,13 +43,8 @@ def get_twilio_numbers(path):
 
 
 def send_sms(client, msg, twilio_numbers):
-    from_ = twilio_numbers['from'].replace("-","").replace(" ", "")
-    for to in twilio_numbers['to']:
-        print("sending alert msg {} to {}". format(msg, to))
-        client.messages.create(
-                body=msg,
-                to=to.replace("-","").replace(" ", ""),
-                from_=from_)
+    """Text one message to every 'to' number, see notifier.SmsNotifier"""
+    return SmsNotifier(client, twilio_numbers).send([msg])
 
 
 def get_alert_rules(gc, offline=None):
@@ -39,7 +52,7 @@ def get_alert_rules(gc, offline=None):
     sheet = "ALERT-RULES"
     if offline:
         return offline_sheets.read_sheets(filters_title, sheet)
-    return read_sheets(gc, filters_title, sheet)
+    return read_reference_sheets(gc, sheet, filters_title)
 
 
 def get_alert_exclusions(gc, offline=None):
@@ -48,7 +61,7 @@ def get_alert_exclusions(gc, offline=None):
     if offline:
         exclusions = offline_sheets.read_sheets(filters_title, sheet)
     else:
-        exclusions = read_sheets(gc, filters_title, sheet)
+        exclusions = read_reference_sheets(gc, sheet, filters_title)
     
     alertNames = exclusions.columns.tolist()
     alertNames.remove("campaign")
@@ -63,67 +76,60 @@ def make_alert_msg(alertName, campaigns):
     return "'%s': check campaigns: '%s'" % (alertName, campaigns)
 
 
-def _check_rule(data, rule):
-    data = deepcopy(data)
-    exclude_column = 'exclude-' + rule['alertName']
-    idx = data[exclude_column] != True
-    data = data[idx]
-
-    check = pd.eval(rule['formula'])
-    if check.any():
-        campaigns = list(set(data[check].campaign))
-        msg = make_alert_msg(rule['alertName'], campaigns)
-        return msg
-
-
 def apply_alert_rules(data, rules, exclusions):
-    data = data.merge(exclusions, on='campaign', how='left', validate='m:1')
-    alerts = [_check_rule(data, rule) for _, rule in rules.iterrows()]
-    alerts = [x for x in alerts if x]
+    """(alertName, campaigns) for the rules that fire on the report, ignoring
+    the campaigns excluded from each rule. See alert_engine.evaluate_rules."""
+    alerts = evaluate_rules(data, rules, exclusions)
     warn_msg = "minimum preroll/playerload is: %s" % data['preroll/playerload'].min()
     warnings.warn(warn_msg)
     return alerts
 
 
-def check_alert_log(alerts, alert_log):
-    t = time()
-    if alert_log is None:
-        alert_log = pd.DataFrame({"msg": [], "time": []})
-
-    alerts = pd.DataFrame([{"msg": a} for a in alerts])
-    alerts['send'] = True
-    alerts['time'] = t
-
-    alert_check = pd.merge(
-        alert_log,
-        alerts,
-        on='msg',
-        how='outer',
-        suffixes=['Prev', 'Now'])
-
-    alert_check['time_passed'] = alert_check['timeNow'] - alert_check['timePrev']
-    idx = alert_check['time_passed'] < KEEP_ALERT_TIME
-    alert_check.loc[idx, 'send'] = False
-    alert_check["time"] = np.where(alert_check["send"],
-        alert_check["timeNow"], alert_check["timePrev"])
-    idx2 = alert_check['send']==True
-    alerts_to_send = alert_check.loc[idx2, 'msg'].tolist()
-    alert_log = alert_check[["msg", "time"]]
-    return alerts_to_send, alert_log
-
-
-def main(alert_log=None):
+def main(alert_log=None, keen_window=None, timeframe="previous_60_minutes",
+         rule_pattern=None, run=None, counters=None):
+    """Check the alert rules against the previous 60 minutes and text any
+    new alerts.
+
+    alert_log : alert_log.AlertLog
+        alerts already sent, defaults to the log at
+        alert_log.DEFAULT_ALERT_LOG_PATH. Returned for the next call
+    keen_window : alert_window.MinuteWindowClient
+        optional rolling per-minute counts kept between calls, so that only
+        the minutes since the previous call are queried from keen
+    timeframe : str
+        keen timeframe the rules are checked against
+    rule_pattern : str
+        only check the rules whose alertName matches this regex
+    run : scheduler.Run
+        when run by the scheduler; nothing is sent once it is cancelled, and
+        keen requests stop at its deadline
+    counters : event_ingest.EventCounters
+        counts of the events the players post to the ingest server, used
+        instead of keen. The timeframe must be within their window
+    """
     offline = False
+    if alert_log is None:
+        alert_log = AlertLog()
 
     keydir = "/home/robertdavidwest/"
     #keydir = "/Users/rwest/"
-    keen_client = get_keen_client(keydir +
-        'keen-buzzworthy-aol.json')
+    if counters is not None:
+        keen_client = counters
+    elif keen_window is not None:
+        # the window re-reads its newest minutes, so it must not sit behind
+        # the query cache. Its client is kept for every later call
+        if keen_window.client is None:
+            keen_window.client = get_keen_client(keydir +
+                'keen-buzzworthy-aol.json')
+        keen_client = keen_window
+    else:
+        keen_client = get_keen_client(keydir +
+            'keen-buzzworthy-aol.json', cache_path=DEFAULT_CACHE_PATH)
 
     if offline:
         gdrive_client = None
     else:
-        gdrive_client = get_gdrive_client(keydir +
+        gdrive_client = get_shared_gdrive_client(keydir +
              'gdrive-keen-buzzworthy-aol.json')
     twilio_client = get_twilio_client(keydir +
         'twilio.json')
@@ -131,25 +137,46 @@ def main(alert_log=None):
         'twilioNumbers.json')
 
 
-    # Check previous 60 minutes
+    if counters is not None:
+        # the ingest server applies the FILTERS sheet to events as they
+        # arrive, it doesn't keep the properties filtered on
+        counters.set_filters(get_filters(gdrive_client, offline))
+
     tz_str = "US/Pacific"
-    timeframe = "previous_60_minutes"
     rules = get_alert_rules(gdrive_client, offline)
+    if rule_pattern:
+        rules = rules[rules['alertName'].str.contains(rule_pattern)]
     exclusions = get_alert_exclusions(gdrive_client, offline)
     report = get_keen_report(keen_client, gdrive_client, timeframe, tz_str,
             offline=offline)
     idx = [c is None for c in report.campaign.tolist()]
     report.loc[idx, 'campaign'] = 'None'
     alerts = apply_alert_rules(report, rules, exclusions)
+    if run is not None:
+        # too late to be worth sending, and the next run will catch them
+        run.check()
     if alerts:
-        alerts_to_send, alert_log = check_alert_log(alerts, alert_log)
+        new_alerts = alert_log.new_alerts(alerts)
+        alerts_to_send = [make_alert_msg(name, campaigns) for name, campaigns
+                          in new_alerts]
+        new_alerts = dict(zip(alerts_to_send, new_alerts))
     else:
         print("no alerts")
         alerts_to_send = []
 
-    for a in alerts_to_send:
-        send_sms(twilio_client, a, twilNumbers)
-
+    if alerts_to_send:
+        # one digest per recipient, sent concurrently
+        notifier = SmsNotifier(twilio_client, twilNumbers)
+        failures = notifier.send(alerts_to_send)
+        # the log has them as sent, let the next run try them again
+        for msg in undelivered(alerts_to_send, failures, notifier.max_length):
+            name, campaigns = new_alerts[msg]
+            for campaign in campaigns:
+                alert_log.forget(name, campaign)
+        print('sms: {}'.format(notifier.stats()))
+
+    if hasattr(keen_client, 'stats'):
+        print('{}: {}'.format(type(keen_client).__name__, keen_client.stats()))
     return alert_log
 
 
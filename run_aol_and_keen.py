@@ -1,41 +1,16 @@
-import keyring
 from copy import deepcopy
 import json
 import pandas as pd
 from datetime import datetime
 from pytz import timezone
 import itertools
-from keen.client import KeenClient
+from keen_access import get_keen_client
+from keen_queries import assemble_wide, count_events
+from query_planner import RollupPlanner
 from selenium_aol import get_aol_data
 import selenium
 from sheets import get_gdrive_client, clean_sheets, create_compare_report
-
-
-def get_keen_client(credentials_key):
-    """ Get KeenCLient
-
-    Parameters
-    ----------
-    credentials_key : str
-        either a path to a json file containing 'project_id' and 'read_key'
-        or a service_name for keyring entries containing 'project_id' and
-        'read_key'
-
-    Returns
-    -------
-    KeenClient
-    """
-    if credentials_key.endswith('.json'):
-        credentials = open(credentials_key, 'r').read()
-        credentials = json.loads(credentials)
-        project_id = credentials['project_id']
-        read_key = credentials['read_key']
-    else:
-        project_id=keyring.get_password(credentials_key, 'project_id')
-        read_key=keyring.get_password(credentials_key, 'read_key')
-
-    client = KeenClient(project_id=project_id, read_key=read_key)
-    return client
+from report_archive import archive_report
 
 
 def get_keen_data(client, timeframe, timezone, index):
@@ -64,24 +39,11 @@ def get_keen_data(client, timeframe, timezone, index):
     """
     print 'reading: {}'.format(timeframe)
 
-    prerolls = client.count(event_collection='prerollplay',
-                            timezone=timezone,
-                            timeframe=timeframe,
-                            group_by=index)
-    prerolls = pd.DataFrame(prerolls)
-    prerolls.rename(columns={'result': 'prerollplay'}, inplace=True)
-
-    content = client.count(event_collection='contentplay',
-                           timezone=timezone,
-                           timeframe=timeframe,
-                            group_by=index)
-    content = pd.DataFrame(content)
-    content.rename(columns={'result': 'contentplay'}, inplace=True)
-
-    results = pd.merge(prerolls,
-                       content,
-                       on=index,
-                       how='outer')
+    prerolls, content = count_events(client, ['prerollplay', 'contentplay'],
+                                     timeframe, timezone=timezone,
+                                     group_by=index)
+
+    results = assemble_wide([prerolls, content], index)
     results = results.sort_values(index, ascending=False)
     results.reset_index(inplace=True, drop=True)
     results.fillna(0, inplace=True)
@@ -96,6 +58,93 @@ def get_keen_data(client, timeframe, timezone, index):
     return results
 
 
+def merge_keen_and_aol(keen_df, keen_vendor_df, aol_df):
+    """
+    Merge keen and AOL play counts into the campaign summary and the video
+    detail tables of the compare report
+
+    keen_df : pd.DataFrame
+        | vidid | campaign | prerollplay | contentplay |
+    keen_vendor_df : pd.DataFrame
+        | campaign | refer | prerollplay | contentplay |
+    aol_df : pd.DataFrame
+        return value of get_aol_data()
+
+    Returns
+    -------
+    (pd.DataFrame, pd.DataFrame)
+        campaign summary, video details
+    """
+    keen_vendor_df = keen_vendor_df.rename(columns={
+        'campaign': 'Campaign',
+        'refer': 'Referer',
+        'prerollplay': 'Keen Preroll',
+        'contentplay': 'Keen Content',
+    })
+    # make referer uppercase
+    keen_vendor_df['Referer'] = keen_vendor_df['Referer'].str.upper()
+
+    df = pd.merge(keen_df, aol_df,
+                  on='vidid', how='outer', suffixes=('keen', 'aol'))
+
+    df['Referer'] = 'All'
+    df['AOL Performance'] = df['prerollplayaol']/df['contentplayaol']
+    df['Keen Performance'] = df['prerollplaykeen']/df['contentplaykeen']
+
+    df = df[[
+        'vidid', 'Video title', 'campaign', 'Referer',
+        'prerollplayaol', 'contentplayaol', 'AOL Performance',
+        'prerollplaykeen', 'contentplaykeen', 'Keen Performance'
+    ]]
+
+    df = df.rename(columns={
+        'vidid': 'Video ID',
+        'Video title': 'Video Title',
+        'campaign': 'Campaign',
+        'prerollplayaol': 'AOL Preroll',
+        'contentplayaol': 'AOL Content',
+        'prerollplaykeen': 'Keen Preroll',
+        'contentplaykeen': 'Keen Content'
+    })
+
+    # drop total row before aggregation up
+    msk = df['Video Title'] != "Total"
+    df = df[msk]
+    df['Variance Preroll'] = df['AOL Preroll']/df['Keen Preroll']
+    df['Variance Content'] = df['AOL Content']/df['Keen Content']
+
+
+    df_campaign_sum = df.groupby('Campaign', as_index=False).agg({
+        'AOL Preroll': 'sum',
+        'AOL Content': 'sum',
+        'Keen Preroll': 'sum',
+        'Keen Content': 'sum'
+    })
+
+    df_campaign_sum['Referer'] = 'All'
+    df_campaign_sum = df_campaign_sum.append(keen_vendor_df)
+    df_campaign_sum['AOL Performance'] = df_campaign_sum['AOL Preroll']/df_campaign_sum['AOL Content']
+    df_campaign_sum['Keen Performance'] = df_campaign_sum['Keen Preroll']/df_campaign_sum['Keen Content']
+
+    df_campaign_sum = df_campaign_sum[[
+        'Campaign', 'Referer',
+        'AOL Preroll',
+        'AOL Content',
+        'AOL Performance',
+        'Keen Preroll',
+        'Keen Content',
+        'Keen Performance'
+    ]]
+
+    df_campaign_sum['Variance Preroll'] = df_campaign_sum['AOL Preroll']/df_campaign_sum['Keen Preroll']
+    df_campaign_sum['Variance Content'] = df_campaign_sum['AOL Content']/df_campaign_sum['Keen Content']
+
+    df_campaign_sum = df_campaign_sum.fillna('-')
+    df = df.fillna('-')
+
+    return df_campaign_sum, df
+
+
 def get_data(keen_client, gdrive_client, keen_timeframe, aol_timeframe):
     """
     Get data from keen api and from AOL then merge the datasets
@@ -131,76 +180,13 @@ def get_data(keen_client, gdrive_client, keen_timeframe, aol_timeframe):
         try_ += 1
 
     if successful:
-        keen_df = get_keen_data(keen_client, timeframe=keen_timeframe, timezone=timezone_str, index=['vidid', 'campaign'])
-        keen_vendor_df = get_keen_data(keen_client, timeframe=keen_timeframe, timezone=timezone_str, index=['campaign', 'refer'])
-        keen_vendor_df = keen_vendor_df.rename(columns={
-            'campaign': 'Campaign',
-            'refer': 'Referer',
-            'prerollplay': 'Keen Preroll',
-            'contentplay': 'Keen Content',
-        })
-        # make referer uppercase
-        keen_vendor_df['Referer'] = keen_vendor_df['Referer'].str.upper()
-
-        df = pd.merge(keen_df, aol_df,
-                      on='vidid', how='outer', suffixes=('keen', 'aol'))
-
-        df['Referer'] = 'All'
-        df['AOL Performance'] = df['prerollplayaol']/df['contentplayaol']
-        df['Keen Performance'] = df['prerollplaykeen']/df['contentplaykeen']
-
-        df = df[[
-            'vidid', 'Video title', 'campaign', 'Referer',
-            'prerollplayaol', 'contentplayaol', 'AOL Performance',
-            'prerollplaykeen', 'contentplaykeen', 'Keen Performance'
-        ]]
-
-        df = df.rename(columns={
-            'vidid': 'Video ID',
-            'Video title': 'Video Title',
-            'campaign': 'Campaign',
-            'prerollplayaol': 'AOL Preroll',
-            'contentplayaol': 'AOL Content',
-            'prerollplaykeen': 'Keen Preroll',
-            'contentplaykeen': 'Keen Content'
-        })
-
-        # drop total row before aggregation up
-        msk = df['Video Title'] != "Total"
-        df = df[msk]
-        df['Variance Preroll'] = df['AOL Preroll']/df['Keen Preroll']
-        df['Variance Content'] = df['AOL Content']/df['Keen Content']
-
-
-        df_campaign_sum = df.groupby('Campaign', as_index=False).agg({
-            'AOL Preroll': 'sum',
-            'AOL Content': 'sum',
-            'Keen Preroll': 'sum',
-            'Keen Content': 'sum'
-        })
-
-        df_campaign_sum['Referer'] = 'All'
-        df_campaign_sum = df_campaign_sum.append(keen_vendor_df)
-        df_campaign_sum['AOL Performance'] = df_campaign_sum['AOL Preroll']/df_campaign_sum['AOL Content']
-        df_campaign_sum['Keen Performance'] = df_campaign_sum['Keen Preroll']/df_campaign_sum['Keen Content']
-
-        df_campaign_sum = df_campaign_sum[[
-            'Campaign', 'Referer',
-            'AOL Preroll',
-            'AOL Content',
-            'AOL Performance',
-            'Keen Preroll',
-            'Keen Content',
-            'Keen Performance'
-        ]]
-
-        df_campaign_sum['Variance Preroll'] = df_campaign_sum['AOL Preroll']/df_campaign_sum['Keen Preroll']
-        df_campaign_sum['Variance Content'] = df_campaign_sum['AOL Content']/df_campaign_sum['Keen Content']
-
-        df_campaign_sum = df_campaign_sum.fillna('-')
-        df = df.fillna('-')
-
-        return df_campaign_sum, df
+        # both granularities are summed down from one ['vidid', 'campaign', 'refer'] query per event
+        planner = RollupPlanner(keen_client, combine=True)
+        planner.need(keen_timeframe, timezone_str, ['vidid', 'campaign'])
+        planner.need(keen_timeframe, timezone_str, ['campaign', 'refer'])
+        keen_df = get_keen_data(planner, timeframe=keen_timeframe, timezone=timezone_str, index=['vidid', 'campaign'])
+        keen_vendor_df = get_keen_data(planner, timeframe=keen_timeframe, timezone=timezone_str, index=['campaign', 'refer'])
+        return merge_keen_and_aol(keen_df, keen_vendor_df, aol_df)
 
         #create_compare_report(gdrive_client, [df_campaign_sum, df],
         #                      title, sheetname, blank_cols=[2, 0])
@@ -218,6 +204,18 @@ def get_data(keen_client, gdrive_client, keen_timeframe, aol_timeframe):
         #                      title, sheetname, blank_cols=[0])
 
 
+def archive_data(title, keen_timeframe, data, run_time):
+    """Archive the campaign summary and video details returned by get_data,
+    unless the AOL scrape failed"""
+    df_campaign_sum, df_details = data
+    if isinstance(df_details, str):
+        return
+    archive_report(df_campaign_sum,
+                   '{} campaigns {}'.format(title, keen_timeframe), run_time)
+    archive_report(df_details,
+                   '{} videos {}'.format(title, keen_timeframe), run_time)
+
+
 if __name__ == '__main__':
 
     # Both the AOL Portal and the keen api are pulling data by the time frame
@@ -250,12 +248,14 @@ if __name__ == '__main__':
     keen_timeframe = 'previous_1_days'
     aol_timeframe = 'Yesterday'
     df_campaign_sum_yest, df_details_yest = get_data(keen_client, gdrive_client, keen_timeframe, aol_timeframe)
+    archive_data(title, keen_timeframe, (df_campaign_sum_yest, df_details_yest), eastern_now)
 
     # results this month
     # results from this month
     keen_timeframe = 'this_month'
     aol_timeframe = eastern_now.strftime("%B")
     df_campaign_sum_mtd, df_details_mtd = get_data(keen_client, gdrive_client,  keen_timeframe, aol_timeframe)
+    archive_data(title, keen_timeframe, (df_campaign_sum_mtd, df_details_mtd), eastern_now)
 
     if ((def_details_yest != 'err') and (def_details_mtd != 'err')):
 
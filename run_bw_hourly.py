@@ -3,17 +3,29 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 
-from sheets import get_gdrive_client, write_to_sheets, clean_sheets, read_sheets
+from sheets import get_gdrive_client, update_sheet, clean_sheets, read_sheets
 from run import get_keen_client
+from keen_cache import DEFAULT_CACHE_PATH
+from hourly_store import HourlyCountStore
 from run_bw_video_keen import get_keen_report
+from report_archive import archive_report
 
 
-def main():
+def main(keen_client=None, gdrive_client=None, store=None, job_run=None):
+    """Update today's report in place. Clients and the hourly store are
+    created when they aren't passed in. A scheduler.Run `job_run` that is
+    cancelled or past its deadline stops the run before the sheet is
+    updated, so a late run doesn't overwrite the next one's report."""
     title = 'BW-Video-Keen-Hourly'
-    keen_client = get_keen_client(
-        '/home/robertdavidwest/keen-buzzworthy-aol.json')
-    gdrive_client = get_gdrive_client(
+    if keen_client is None:
+        keen_client = get_keen_client(
+            '/home/robertdavidwest/keen-buzzworthy-aol.json',
+            cache_path=DEFAULT_CACHE_PATH)
+    if gdrive_client is None:
+        gdrive_client = get_gdrive_client(
                  '/home/robertdavidwest/gdrive-keen-buzzworthy-aol.json')
+    if store is None:
+        store = HourlyCountStore()
 
     tz_str = "US/Pacific"
     timezone_short = "PT"
@@ -31,11 +43,22 @@ def main():
     # Yesterday report
     report_name = "Today"
     timeframe = "this_day"
-    sheetname = 'runtime: {} {} report: {}'.format(display_now, timezone_short, report_name)
-    report = get_keen_report(keen_client, gdrive_client, timeframe, tz_str)
-    write_to_sheets(gdrive_client, report, title, sheetname)
+    # one worksheet updated in place each run, only changed cells are sent
+    sheetname = 'report: {}'.format(report_name)
+    report = get_keen_report(keen_client, gdrive_client, timeframe, tz_str,
+                             store=store)
+    if job_run is not None:
+        job_run.check()
+    changes = update_sheet(gdrive_client, report, title, sheetname,
+                           keys=['program', 'campaign', 'refer'])
+    archive_report(report, '{} {}'.format(title, report_name), this_now)
+    print('runtime: {} {} report: {} {}'.format(display_now, timezone_short,
+                                                report_name, changes))
 
+    # removes the timestamped sheets written by earlier versions
     clean_sheets(gdrive_client, title, max_sheets=1)
+    if hasattr(keen_client, 'stats'):
+        print('keen cache: {}'.format(keen_client.stats()))
 
 if __name__ == '__main__':
     main()
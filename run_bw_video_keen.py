@@ -3,38 +3,29 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 import offline_sheets
-from sheets import get_gdrive_client, write_to_sheets, clean_sheets, read_sheets
+from sheets import get_gdrive_client, read_sheets
 from run import get_keen_client
+from keen_cache import DEFAULT_CACHE_PATH
+from keen_queries import EVENTS, assemble_wide, count_events
+from hourly_store import HourlyCountStore, count_events_from_store
+from reference_data import read_reference_sheets
+from sheets_queue import SheetsWriteQueue
+from report_archive import archive_report
+from metrics import REPORT_METRICS
 from warnings import warn
 
 
-def get_keen_table(client, timeframe, timezone, by, event, filters):
-    result = client.count(event_collection=event,
-                          timeframe=timeframe,
-                          timezone=timezone,
-                          filters=filters,
-                          group_by=by)
-    if not result:
-        empty = {c: [] for c in by}
-        empty.update({event: []})
-        return pd.DataFrame(empty)
-    else:
-        return pd.DataFrame(result).rename(columns={'result': event})
-
-
-def get_all_keen_data(client, timeframe, tz, filters=None, by=None):
+def get_all_keen_data(client, timeframe, tz, filters=None, by=None,
+                      store=None):
     if not by:
         by = ['program', 'campaign', 'refer']
-    events = ['pageviewevent', 'playerload', 'prerollplay', 'prerollend',
-              'contentplay', 'cookiesdisabled', 'errorpage', 'halfevent',
-              'rewardevent']
-    datas = [get_keen_table(client, timeframe, tz, by, e, filters) for e in events]
-    merge = lambda x, y: pd.merge(x, y,
-                                  on=by,
-                                  how='outer')
-                                  #validate='1:1')
-
-    data = reduce(merge, datas)
+    datas = None
+    if store is not None:
+        datas = count_events_from_store(client, store, EVENTS, timeframe, tz,
+                                        filters, by)
+    if datas is None:
+        datas = count_events(client, EVENTS, timeframe, tz, filters, by)
+    data = assemble_wide(datas, by)
 
     data = data.sort_values(by)
     return data
@@ -55,8 +46,11 @@ def add_reference_rates(gc, data, offline=None):
     if offline:
         ref_rates = offline_sheets.read_sheets(ref_rate_title)
     else:
-        ref_rates = read_sheets(gc, ref_rate_title)
+        ref_rates = read_reference_sheets(gc, title=ref_rate_title)
+    return merge_reference_rates(data, ref_rates)
+
 
+def merge_reference_rates(data, ref_rates):
     ref_rates = {k: df.replace("NULL", np.nan)
                  for k, df in ref_rates.iteritems()}
     ref_rates = {k: df.dropna(axis=0, how='all')
@@ -71,10 +65,11 @@ def add_reference_rates(gc, data, offline=None):
     if cost_rates.cost_rate.dtype == np.object:
         cost_rates['cost_rate'] = cost_rates['cost_rate'].apply(remove_dollar)
 
-    data = data.merge(rev_rates,
+    # duplicate rate rows would duplicate report rows
+    data = data.merge(rev_rates.drop_duplicates(),
                       on='program', how='left')
 
-    data = data.merge(cost_rates,
+    data = data.merge(cost_rates.drop_duplicates(),
                      on=['campaign', 'refer'],
                      how='left')
     return data
@@ -83,6 +78,10 @@ def add_reference_rates(gc, data, offline=None):
 def add_encrave_costs(gc, data, report_type):
     title = "Encrave Report Summaries"
     encrave_costs = read_sheets(gc, title, report_type)
+    return merge_encrave_costs(data, encrave_costs)
+
+
+def merge_encrave_costs(data, encrave_costs):
     encrave_costs = encrave_costs[['campaign', 'Cost', 'ReportName']]
     encrave_costs['refer'] = 'en'
     encrave_costs = encrave_costs.rename(
@@ -119,7 +118,7 @@ def get_filters(gc, offline=None):
     if offline:
         df_filter = offline_sheets.read_sheets(filters_title, sheet)
     else:
-        df_filter = read_sheets(gc, filters_title, sheet)
+        df_filter = read_reference_sheets(gc, sheet, filters_title)
 
     df_filter = df_filter.rename(columns={
         "FilterVariable": "property_name",
@@ -129,125 +128,108 @@ def get_filters(gc, offline=None):
     return df_filter.to_dict("records")
 
 
-def add_metrics(df):
-    df['preroll/playerload'] = df['prerollplay']/df['playerload']
-    df['preroll_complete_rate'] = df['prerollplay']/df['prerollend']
-    df['preroll/content'] = df['prerollplay']/df['contentplay']
-    df['error_rate'] = df['errorpage']/df['playerload']
-    df['halfevent_rate'] = df['halfevent']/df['playerload']
-    df['rewardevent_rate'] = df['rewardevent']/df['playerload']
-
-    df['keen_rev'] = df['revenue_rate'] * df['prerollplay']
-
-    notnull = df.cost_event_variable.notnull()
-    cost_event_variables = list(set(
-        df.loc[notnull, 'cost_event_variable']))
-    df['keen_cost'] = np.nan
-    for v in cost_event_variables:
-        idx = df['cost_event_variable'] == v
-        df.loc[idx, 'keen_cost'] = df.loc[idx, v] * df['cost_rate'] * df['cost_multiplier']
-
-    df['keen_profit'] = df['keen_rev'] - df['keen_cost']
-    df['keen_margin'] = df['keen_profit']/df['keen_cost']
-    return df
-
-
-def reorder_cols(df):
-    final_order = [
-         'program',
-         'campaign',
-         'refer',
-         'pageviewevent',
-         'playerload',
-         'prerollplay',
-         'preroll/playerload',
-         'prerollend',
-         'preroll_complete_rate',
-         'contentplay',
-         'preroll/content',
-         'cookiesdisabled',
-         'errorpage',
-         'error_rate',
-         'halfevent',
-         'halfevent_rate',
-         'rewardevent',
-         'rewardevent_rate',
-         'revenue_rate',
-         'cost_rate',
-         'cost_multiplier',
-         'cost_event_variable',
-         'keen_rev',
-         'keen_cost',
-         'encrave_cost',
-         'encrave_source',
-         'keen_profit',
-         'keen_margin']
-    if 'encrave_cost' not in df.columns.tolist():
-        final_order.remove('encrave_cost')
-    if 'encrave_source' not in df.columns.tolist():
-        final_order.remove('encrave_source')
-
-    #if set(df.columns) != set(final_order):
-    #    print('extra cols: %s' % (set(df.columns) - set(final_order)))
-    #    print('missing cols: %s' % (set(final_order) - set(df.columns)))
-    #    raise AssertionError("cols not accounted for")
-    return df[final_order]
-
-
-def get_keen_report(kc, gc, timeframe, tz, enclave_report_type=None, by=None, offline=None):
+def get_report_metrics(gc, offline=None):
+    """The report's columns and metrics, with any declared in the optional
+    METRICS sheet of BW-Video-Keen-Key"""
+    title = "BW-Video-Keen-Key"
+    if offline:
+        sheets = offline_sheets.read_sheets(title)
+    else:
+        sheets = read_reference_sheets(gc, title=title)
+    if sheets.get('METRICS') is None:
+        return REPORT_METRICS
+    return REPORT_METRICS.extended(sheets['METRICS'])
+
+
+def add_metrics(df, registry=REPORT_METRICS):
+    return registry.compute(df)
+
+
+def reorder_cols(df, registry=REPORT_METRICS):
+    return registry.order(df)
+
+
+def get_keen_report(kc, gc, timeframe, tz, enclave_report_type=None, by=None, offline=None,
+                    store=None):
     filters = get_filters(gc, offline)
-    data = get_all_keen_data(kc, timeframe, tz, filters, by=by)
+    data = get_all_keen_data(kc, timeframe, tz, filters, by=by, store=store)
     data = add_reference_rates(gc, data, offline)
-    data = add_metrics(data)
-    data = data.drop_duplicates()
+    registry = get_report_metrics(gc, offline)
+    data = add_metrics(data, registry)
     if enclave_report_type:
         data = add_encrave_costs(gc, data, enclave_report_type)
-    data = reorder_cols(data)
+    data = reorder_cols(data, registry)
     return data
 
 
-def main():
+def main(keen_client=None, gdrive_client=None, store=None, job_run=None):
+    """Publish the Yesterday and MTD(not-today) snapshots. Clients and the
+    hourly store are created when they aren't passed in. A scheduler.Run
+    `job_run` that is cancelled or past its deadline stops the run before
+    the MTD report, once Yesterday's is published."""
     title = 'BW-Video-Keen-Data-Snapshots'
-    keen_client = get_keen_client(
-        '/home/robertdavidwest/keen-buzzworthy-aol.json')
-    gdrive_client = get_gdrive_client(
+    if keen_client is None:
+        keen_client = get_keen_client(
+            '/home/robertdavidwest/keen-buzzworthy-aol.json',
+            cache_path=DEFAULT_CACHE_PATH)
+    if store is None:
+        store = HourlyCountStore()
+    if gdrive_client is None:
+        gdrive_client = get_gdrive_client(
                  '/home/robertdavidwest/gdrive-keen-buzzworthy-aol.json')
-
-    tz_str = "US/Pacific"
-    timezone_short = "PT"
-    tz = timezone(tz_str)
-
-    this_now = datetime.now(tz)
-    local_now =  datetime.now()
-    pacific_now = datetime.now(
-            timezone("US/Pacific")) # keen reports are pacific
-    display_now = this_now.ctime()
-
-    if this_now.day != local_now.day:
-        raise AssertionError("Changing timezone " \
-                "in sheetname will show incorrect day")
-    
-    # Yesterday report
-    report_name = "Yesterday"
-    timeframe = "previous_day"
-    sheetname = 'runtime: {} {} report: {}'.format(display_now, timezone_short, report_name)
-    report = get_keen_report(keen_client, gdrive_client, timeframe, tz_str, enclave_report_type=report_name)
-    write_to_sheets(gdrive_client, report, title, sheetname)
-    
-    # Report Month to date excluding today
-    report_name =  'MTD(not-today)'
-    day = pacific_now.day
-    n = day - 1
-    if n == 0:
-        timeframe = 'previous_month'
-    else:
-        timeframe = 'previous_{}_days'.format(n)
-    sheetname = 'runtime: {} {} report: {}'.format(display_now, timezone_short, report_name)
-    report = get_keen_report(keen_client, gdrive_client, timeframe, tz_str, enclave_report_type=report_name)
-    write_to_sheets(gdrive_client, report, title, sheetname)
-
-    # No more than 20 sheets in workbook. Older results are deleted.
-    clean_sheets(gdrive_client, title, max_sheets=20)
+    # reports are published in the background while the next one is computed.
+    # The reports read sheets through its paced client too, so reads and
+    # writes share the quota
+    publisher = SheetsWriteQueue(gdrive_client)
+    sheets_client = publisher.gc
+
+    try:
+        tz_str = "US/Pacific"
+        timezone_short = "PT"
+        tz = timezone(tz_str)
+
+        this_now = datetime.now(tz)
+        local_now =  datetime.now()
+        pacific_now = datetime.now(
+                timezone("US/Pacific")) # keen reports are pacific
+        display_now = this_now.ctime()
+
+        if this_now.day != local_now.day:
+            raise AssertionError("Changing timezone " \
+                    "in sheetname will show incorrect day")
+
+        # Yesterday report
+        report_name = "Yesterday"
+        timeframe = "previous_day"
+        sheetname = 'runtime: {} {} report: {}'.format(display_now, timezone_short, report_name)
+        report = get_keen_report(keen_client, sheets_client, timeframe, tz_str, enclave_report_type=report_name,
+                                 store=store)
+        publisher.write(report, title, sheetname)
+        archive_report(report, '{} {}'.format(title, report_name), this_now)
+        if job_run is not None:
+            job_run.check()
+
+        # Report Month to date excluding today
+        report_name =  'MTD(not-today)'
+        day = pacific_now.day
+        n = day - 1
+        if n == 0:
+            timeframe = 'previous_month'
+        else:
+            timeframe = 'previous_{}_days'.format(n)
+        sheetname = 'runtime: {} {} report: {}'.format(display_now, timezone_short, report_name)
+        report = get_keen_report(keen_client, sheets_client, timeframe, tz_str, enclave_report_type=report_name,
+                                 store=store)
+        publisher.write(report, title, sheetname)
+        archive_report(report, '{} {}'.format(title, report_name), this_now)
+
+        # No more than 20 sheets in workbook. Older results are deleted.
+        publisher.clean(title, max_sheets=20)
+    finally:
+        publisher.close()
+    print('sheets publishing: {}'.format(publisher.stats()))
+    if hasattr(keen_client, 'stats'):
+        print('keen cache: {}'.format(keen_client.stats()))
 
 
 if __name__ == '__main__':
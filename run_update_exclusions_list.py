@@ -28,12 +28,14 @@ def update_exclusions_in_sheets(gc, exclusions):
     write_to_sheets(gc, exclusions, title, sheet)
 
 
-def main():
+def main(keen_client=None, gdrive_client=None):
     keydir = "/home/robertdavidwest/"
-    keen_client = get_keen_client(keydir + 
-        'keen-buzzworthy-aol.json')
-    gdrive_client = get_gdrive_client(keydir +
-             'gdrive-keen-buzzworthy-aol.json')
+    if keen_client is None:
+        keen_client = get_keen_client(keydir +
+            'keen-buzzworthy-aol.json')
+    if gdrive_client is None:
+        gdrive_client = get_gdrive_client(keydir +
+                 'gdrive-keen-buzzworthy-aol.json')
 
     tz_str = "US/Pacific"
     timeframe = "previous_48_hours"
@@ -0,0 +1,370 @@
+"""
+Runs jobs on fixed wall-clock ticks, e.g. every minute on the minute, however
+long each run takes.
+
+    scheduler = Scheduler([Job('alerts', check_alerts, every=60*5)])
+    scheduler.run_forever()
+
+Each run gets its own thread, so a slow job doesn't delay the others. A run
+still going at its job's next tick is either left to finish, and the tick
+skipped, or cancelled so the new run can start. Every run also has a deadline,
+after which it is cancelled. Python threads can't be killed, so cancelling
+sets a flag the job checks with `Run.check()` before doing anything that
+can't be undone, like texting an alert. The deadline is also set as the
+run thread's throttle.deadline, so keen requests (see keen_access) time out
+and stop retrying at it. Tick lag (how late a run started)
+and run duration are kept per job.
+"""
+import threading
+import traceback
+import warnings
+from datetime import datetime, timedelta
+from time import time, strftime, localtime
+
+from pytz import timezone as pytz_timezone, utc
+
+from throttle import deadline
+
+
+SKIP = 'skip'
+CANCEL = 'cancel'
+MAX_ABANDONED = 2 # cancelled runs of a job still running before ticks are skipped
+
+
+class RunCancelled(Exception):
+    pass
+
+
+class Run(object):
+    """One run of a job, passed to the job's function
+
+    Attributes
+    ----------
+    job : Job
+    tick : float
+        unix time the run was scheduled for
+    deadline : float
+        unix time the run is cancelled at
+    """
+
+    def __init__(self, job, tick, deadline):
+        self.job = job
+        self.tick = tick
+        self.deadline = deadline
+        self.started = None
+        self.finished = None
+        self.thread = None
+        self._cancelled = threading.Event()
+
+    def __repr__(self):
+        return '<Run {} at {}>'.format(self.job.name, _clock(self.tick))
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set() or time() > self.deadline
+
+    def remaining(self):
+        """Seconds left before the deadline"""
+        return max(self.deadline - time(), 0.0)
+
+    def check(self):
+        """Raise RunCancelled if the run was cancelled or is past its
+        deadline"""
+        if self.cancelled():
+            raise RunCancelled('{} cancelled after {:.1f}s'.format(
+                self, time() - (self.started or self.tick)))
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+class Job(object):
+    """
+    A function to run on a fixed cadence
+
+    Parameters
+    ----------
+    name : str
+    func : callable
+        called with the Run
+    every : float
+        seconds between runs. Ticks are multiples of `every` in unix time,
+        plus `offset`, so every=60 runs on the minute
+    deadline : float
+        seconds after its tick a run is cancelled, defaults to `every`
+    offset : float
+    overlap : str
+        at a tick where the previous run is still going, SKIP the tick or
+        CANCEL the previous run
+    """
+
+    def __init__(self, name, func, every, deadline=None, offset=0,
+                 overlap=SKIP):
+        if overlap not in (SKIP, CANCEL):
+            raise ValueError("overlap must be '{}' or '{}'".format(SKIP,
+                                                                   CANCEL))
+        self.name = name
+        self.func = func
+        self.every = float(every)
+        self.deadline = float(deadline or every)
+        self.offset = float(offset)
+        self.overlap = overlap
+
+    def __repr__(self):
+        return '<Job {} every {}s>'.format(self.name, self.every)
+
+    def next_tick(self, now):
+        """The first tick after `now`"""
+        ticks = (now - self.offset) // self.every + 1
+        return ticks * self.every + self.offset
+
+
+class DailyJob(Job):
+    """
+    A Job run once a day at a local time, e.g. at='06:30' in 'US/Eastern',
+    following daylight saving changes
+
+    Parameters
+    ----------
+    name : str
+    func : callable
+    at : str
+        'HH:MM'
+    timezone : str
+    deadline : float
+        seconds, defaults to an hour
+    overlap : str
+    """
+
+    def __init__(self, name, func, at, timezone='US/Eastern', deadline=60*60,
+                 overlap=SKIP):
+        Job.__init__(self, name, func, every=24*60*60, deadline=deadline,
+                     overlap=overlap)
+        hour, minute = at.split(':')
+        self.at = (int(hour), int(minute))
+        self.timezone = pytz_timezone(timezone)
+
+    def __repr__(self):
+        return '<DailyJob {} at {:02d}:{:02d} {}>'.format(
+            self.name, self.at[0], self.at[1], self.timezone.zone)
+
+    def next_tick(self, now):
+        local = datetime.fromtimestamp(now, utc).astimezone(self.timezone)
+        day = local.date()
+        while True:
+            naive = datetime(day.year, day.month, day.day, *self.at)
+            tick = self.timezone.localize(naive)
+            tick = (tick - datetime(1970, 1, 1, tzinfo=utc)).total_seconds()
+            if tick > now:
+                return tick
+            day += timedelta(days=1)
+
+
+def _clock(t):
+    return strftime('%H:%M:%S', localtime(t))
+
+
+class JobMetrics(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'runs': 0, 'ok': 0, 'failed': 0, 'cancelled': 0,
+                       'skipped': 0, 'timed_out': 0}
+        self.lag = {'last': None, 'max': 0.0}
+        self.duration = {'last': None, 'max': 0.0, 'total': 0.0}
+        self.last_tick = None
+        self.last_outcome = None
+        self.last_error = None
+
+    def bump(self, name, value=1):
+        with self._lock:
+            self.counts[name] += value
+
+    def started(self, tick, lag):
+        with self._lock:
+            self.last_tick = tick
+            self.counts['runs'] += 1
+            self.lag['last'] = lag
+            self.lag['max'] = max(self.lag['max'], lag)
+
+    def finished(self, outcome, duration, error=None):
+        with self._lock:
+            self.last_outcome = outcome
+            self.last_error = error
+            self.counts[outcome] += 1
+            self.duration['last'] = duration
+            self.duration['max'] = max(self.duration['max'], duration)
+            self.duration['total'] += duration
+
+    def get(self):
+        with self._lock:
+            stats = dict(self.counts)
+            finished = stats['ok'] + stats['failed'] + stats['cancelled']
+            stats['lag_last'] = self.lag['last']
+            stats['lag_max'] = self.lag['max']
+            stats['duration_last'] = self.duration['last']
+            stats['duration_max'] = self.duration['max']
+            stats['duration_mean'] = (self.duration['total'] / finished
+                                      if finished else None)
+            stats['last_tick'] = self.last_tick
+            stats['last_outcome'] = self.last_outcome
+            stats['last_error'] = self.last_error
+            return stats
+
+
+class Scheduler(object):
+    """
+    Runs jobs on their ticks until `stop` is called
+
+    Parameters
+    ----------
+    jobs : list of Job
+    """
+
+    def __init__(self, jobs):
+        names = [job.name for job in jobs]
+        if len(set(names)) != len(names):
+            raise ValueError('job names must be unique: {}'.format(names))
+        self.jobs = list(jobs)
+        self.metrics = dict((job.name, JobMetrics()) for job in self.jobs)
+        self._active = {}
+        self._abandoned = dict((job.name, []) for job in self.jobs)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def _reap(self, now):
+        """Cancel runs past their deadline. Returns the earliest deadline of
+        the runs still going."""
+        earliest = None
+        for name, run in list(self._active.items()):
+            if not run.running():
+                del self._active[name]
+            elif now >= run.deadline:
+                run.cancel()
+                self.metrics[name].bump('timed_out')
+                warnings.warn('{} passed its deadline, cancelled'.format(run))
+                self._abandoned[name].append(run)
+                del self._active[name]
+            elif earliest is None or run.deadline < earliest:
+                earliest = run.deadline
+        for name, runs in self._abandoned.items():
+            self._abandoned[name] = [r for r in runs if r.running()]
+        return earliest
+
+    def _fire(self, job, tick):
+        metrics = self.metrics[job.name]
+        active = self._active.get(job.name)
+        if active is not None and active.running():
+            if job.overlap == SKIP:
+                metrics.bump('skipped')
+                warnings.warn('{} still running at {}, skipping'.format(
+                    active, _clock(tick)))
+                return
+            active.cancel()
+            self._abandoned[job.name].append(active)
+            warnings.warn('{} still running at {}, cancelled'.format(
+                active, _clock(tick)))
+        if len(self._abandoned[job.name]) >= MAX_ABANDONED:
+            metrics.bump('skipped')
+            warnings.warn('{} cancelled runs of {} are still going, skipping '
+                          '{}'.format(len(self._abandoned[job.name]), job.name,
+                                      _clock(tick)))
+            return
+        run = Run(job, tick, tick + job.deadline)
+        run.thread = threading.Thread(target=self._execute, args=(run,),
+                                      name='{}-{}'.format(job.name,
+                                                          _clock(tick)))
+        run.thread.daemon = True
+        self._active[job.name] = run
+        run.thread.start()
+
+    def _execute(self, run):
+        metrics = self.metrics[run.job.name]
+        run.started = time()
+        lag = run.started - run.tick
+        metrics.started(run.tick, lag)
+        error = None
+        try:
+            with deadline(run.deadline):
+                run.job.func(run)
+            outcome = 'cancelled' if run.cancelled() else 'ok'
+        except RunCancelled:
+            outcome = 'cancelled'
+        except Exception as e:
+            # e.g. a request that timed out at the deadline
+            outcome = 'cancelled' if run.cancelled() else 'failed'
+            error = '{}: {}'.format(type(e).__name__, e)
+            warnings.warn('{} failed:\n{}'.format(run, traceback.format_exc()))
+        run.finished = time()
+        duration = run.finished - run.started
+        metrics.finished(outcome, duration, error)
+        warnings.warn('{} {}: started {:.2f}s late, took {:.1f}s'.format(
+            run, outcome, lag, duration))
+
+    def run_forever(self):
+        """Run the jobs until `stop` is called"""
+        now = time()
+        ticks = dict((job.name, job.next_tick(now)) for job in self.jobs)
+        while not self._stop.is_set():
+            now = time()
+            with self._lock:
+                deadline = self._reap(now)
+                for job in self.jobs:
+                    tick = ticks[job.name]
+                    if tick > now:
+                        continue
+                    self._fire(job, tick)
+                    ticks[job.name] = job.next_tick(now)
+                    missed = int((ticks[job.name] - tick) // job.every) - 1
+                    if missed > 0:
+                        # the scheduler itself was held up, e.g. by a suspend
+                        self.metrics[job.name].bump('skipped', missed)
+            wake = min(ticks.values())
+            if deadline is not None:
+                wake = min(wake, deadline)
+            self._stop.wait(max(wake - time(), 0))
+
+    def trigger(self, name):
+        """Start a run of the named job now, outside its schedule. The
+        job's overlap rule applies as at a tick.
+
+        Returns
+        -------
+        Run
+            the run started, or None if it was skipped
+        """
+        jobs = [job for job in self.jobs if job.name == name]
+        if not jobs:
+            raise KeyError("no job named '{}'".format(name))
+        with self._lock:
+            now = time()
+            self._reap(now)
+            before = self._active.get(name)
+            self._fire(jobs[0], now)
+            run = self._active.get(name)
+            return run if run is not before else None
+
+    def running(self):
+        """{job name: Run} of the runs going now, not counting cancelled
+        ones"""
+        with self._lock:
+            return dict((name, run) for name, run in self._active.items()
+                        if run.running())
+
+    def start(self):
+        """Run the jobs on a background thread, returns the thread"""
+        thread = threading.Thread(target=self.run_forever, name='scheduler')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        """{job name: runs, ok, failed, cancelled, skipped, timed_out,
+        last/max tick lag and last/max/mean run duration in seconds, and the
+        last run's tick, outcome and error}"""
+        return dict((name, m.get()) for name, m in self.metrics.items())
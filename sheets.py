@@ -4,9 +4,12 @@ import pandas as pd
 import numpy as np
 import json
 import keyring
+import weakref
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
+GDRIVE_MAX_AGE = 45*60 # seconds, google access tokens last an hour
+
 def get_gdrive_client(credentials_key):
     """ Get gspread client
 
@@ -36,11 +39,81 @@ def get_gdrive_client(credentials_key):
     return gc
 
 
+MAX_CELLS_PER_UPDATE = 40000 # keeps each request well under the api payload limit
+
+
+def _cell_value(value):
+    """Plain python value for a sheet cell. numpy scalars are unwrapped and
+    NaN/None become blank cells."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    return value
+
+
+def frame_to_values(data, header=True):
+    """A pd.DataFrame as a list of rows of cell values"""
+    values = [[_cell_value(v) for v in row]
+              for row in data.itertuples(index=False)]
+    if header:
+        values.insert(0, data.columns.tolist())
+    return values
+
+
+def _a1(row, col):
+    """A1 notation for a 1-indexed row and col"""
+    letters = ''
+    while col:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(65 + rem) + letters
+    return '{}{}'.format(letters, row)
+
+
+def update_values(wb, wks, values, row=1, col=1):
+    """
+    Write a block of values to a worksheet in as few requests as possible:
+    one range update per MAX_CELLS_PER_UPDATE cells.
+
+    Parameters
+    ----------
+    wb : gspread spreadsheet
+    wks : gspread worksheet
+    values : list of list
+        rows of cell values
+    row : int
+        row of the top left cell (indexed from 1)
+    col : int
+        col of the top left cell (indexed from 1)
+    """
+    if not values:
+        return
+    ncols = max(len(r) for r in values)
+    values = [list(r) + [''] * (ncols - len(r)) for r in values]
+    rows_per_update = max(1, MAX_CELLS_PER_UPDATE // ncols)
+    for i in range(0, len(values), rows_per_update):
+        chunk = values[i:i + rows_per_update]
+        top, bottom = row + i, row + i + len(chunk) - 1
+        label = '{}:{}'.format(_a1(top, col), _a1(bottom, col + ncols - 1))
+        if hasattr(wb, 'values_update'):
+            wb.values_update(
+                "'{}'!{}".format(wks.title.replace("'", "''"), label),
+                params={'valueInputOption': 'RAW'},
+                body={'values': chunk})
+        else:
+            cells = wks.range(label)
+            for cell in cells:
+                cell.value = chunk[cell.row - top][cell.col - col]
+            wks.update_cells(cells)
+
+
 def write_to_sheets(gc, data, title, sheetname):
     """
-    Add a timestamp in the first row then:
     Write the data in "data" to a google sheet named "title" on a new sheet
-    "sheetname". If "sheetname" exists an error will be thrown.
+    "sheetname". If "sheetname" exists an error will be thrown. The sheet is
+    created at its final size and the header and data are written with
+    `update_values`.
+
     Parameters
     ----------
     gc : gspread.authorize
@@ -53,46 +126,335 @@ def write_to_sheets(gc, data, title, sheetname):
     """
     print 'writing to sheet: {}'.format(sheetname)
 
-    wb = gc.open(title)
-    wb.add_worksheet(title=sheetname, rows=1, cols=1)
+    wb = open_workbook(gc, title)
+    wb.add_worksheet(title=sheetname, rows=len(data) + 1,
+                     cols=max(len(data.columns), 1))
     wks = wb.worksheet(sheetname)
+    update_values(wb, wks, frame_to_values(data))
 
-    # add data
-    data = data.iloc[::-1]
-    for i, row in data.iterrows():
-        wks.insert_row(values=row.tolist(), index=1)
 
-    # add header row
-    wks.insert_row(data.columns.tolist(), index=1)
+_workbooks = weakref.WeakKeyDictionary()
 
 
-def sheet_to_frame(s):
-    records = s.get_all_records()
-    columns = s.get_all_values()[0]
-    if records:
-        df = pd.DataFrame(records)
-        df = df[columns]
+def open_workbook(gc, title):
+    """gc.open(title), reusing the spreadsheet handle already opened by the
+    same client. Worksheet lists and values are still fetched fresh on each
+    call that needs them."""
+    opened = _workbooks.setdefault(gc, {})
+    if title not in opened:
+        opened[title] = gc.open(title)
+    return opened[title]
+
+
+def _numericise(value):
+    """Same conversion get_all_records applies: ints, then floats, blank
+    cells stay ''"""
+    if value == '':
+        return value
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def values_to_frame(values):
+    """Build a pd.DataFrame from a sheet's values, first row as the header"""
+    if not values:
+        return pd.DataFrame({})
+    columns = values[0]
+    rows = [[_numericise(v) for v in row] + [''] * (len(columns) - len(row))
+            for row in values[1:]]
+    if rows:
+        df = pd.DataFrame([row[:len(columns)] for row in rows],
+                          columns=columns)
     else:
         df = pd.DataFrame({}, columns=columns)
     return df
 
 
+def sheet_to_frame(s):
+    return values_to_frame(s.get_all_values())
+
+
+def _sheet_range(sheetname):
+    return "'{}'".format(sheetname.replace("'", "''"))
+
+
+def batch_get_values(wb, sheetnames, params=None):
+    """Values of several worksheets with a single batch request where gspread
+    provides one
+
+    Parameters
+    ----------
+    wb : gspread spreadsheet
+    sheetnames : list of str
+    params : dict
+        extra query parameters for the batch request, e.g.
+        {'valueRenderOption': 'UNFORMATTED_VALUE'}
+
+    Returns
+    -------
+    dict
+        {sheetname: list of rows}
+    """
+    if not sheetnames:
+        return {}
+    if hasattr(wb, 'values_batch_get'):
+        response = wb.values_batch_get([_sheet_range(n) for n in sheetnames],
+                                       params=params)
+        return {n: r.get('values', [])
+                for n, r in zip(sheetnames, response['valueRanges'])}
+    worksheets = dict((ws.title, ws) for ws in wb.worksheets())
+    return {n: worksheets[n].get_all_values() for n in sheetnames}
+
+
+def error_status(error):
+    """http status of a gspread (or offline_sheets) api error, or None"""
+    code = getattr(error, 'code', None)
+    if code is None:
+        response = getattr(error, 'response', None)
+        code = getattr(response, 'status_code', None)
+    return code
+
+
 def read_sheets(gc, title, sheet=None):
-    sheets = gc.open(title).worksheets()
+    """
+    Read worksheets of a google sheet into pd.DataFrames, downloading all the
+    requested worksheets in one batch request. A single `sheet` is read with
+    that one request, without listing the worksheets first.
+
+    Parameters
+    ----------
+    gc : gspread.authorize
+        google drive client
+    title : str
+        sheets title
+    sheet : str
+        a single sheetname to read. If None all sheets are read
+
+    Returns
+    -------
+    pd.DataFrame, None if `sheet` does not exist, or a dict of
+    {sheetname: pd.DataFrame} if no `sheet` is given
+    """
+    wb = open_workbook(gc, title)
+    if sheet and hasattr(wb, 'values_batch_get'):
+        try:
+            values = batch_get_values(wb, [sheet])
+        except Exception as e:
+            # the api can't parse a range on a sheet that doesn't exist
+            if error_status(e) not in (400, 404):
+                raise
+            return None
+        return values_to_frame(values[sheet])
+
+    names = [s.title for s in wb.worksheets()]
     if sheet:
-        result = [sheet_to_frame(s)
-                for s in sheets if s.title == sheet]
-        if len(result) > 0:
-            return result[0]
-        else:
+        if sheet not in names:
             return None
+        return values_to_frame(batch_get_values(wb, [sheet])[sheet])
+
+    values = batch_get_values(wb, names)
+    return {n: values_to_frame(values[n]) for n in names}
+
 
-    return {s.title: sheet_to_frame(s)
-           for s in sheets}
+def batch_update_values(wb, wks, blocks):
+    """
+    Write several blocks of values to a worksheet in one batch request (one
+    per MAX_CELLS_PER_UPDATE cells) where gspread provides one, otherwise
+    with `update_values` per block.
+
+    Parameters
+    ----------
+    wb : gspread spreadsheet
+    wks : gspread worksheet
+    blocks : list of tuple
+        (row, col, values) with the 1-indexed top left cell of each block
+    """
+    if not hasattr(wb, 'values_batch_update'):
+        for row, col, values in blocks:
+            update_values(wb, wks, values, row, col)
+        return
+
+    data, cells = [], 0
+    for row, col, values in blocks:
+        ncols = max(len(r) for r in values)
+        label = '{}:{}'.format(_a1(row, col),
+                               _a1(row + len(values) - 1, col + ncols - 1))
+        data.append({'range': '{}!{}'.format(_sheet_range(wks.title), label),
+                     'values': values})
+        cells += len(values) * ncols
+        if cells >= MAX_CELLS_PER_UPDATE:
+            wb.values_batch_update(body={'valueInputOption': 'RAW',
+                                         'data': data})
+            data, cells = [], 0
+    if data:
+        wb.values_batch_update(body={'valueInputOption': 'RAW',
+                                     'data': data})
+
+
+def _same_cell(old, new):
+    """Whether a cell read back from a sheet already holds `new`"""
+    if isinstance(new, bool) or isinstance(old, bool):
+        return str(old).upper() == str(new).upper()
+    if isinstance(new, (int, long, float)):
+        try:
+            old = float(old)
+        except ValueError:
+            return False
+        return abs(old - new) <= 1e-9 * max(1.0, abs(new))
+    return u'{}'.format(old) == u'{}'.format(new)
+
+
+def _row_key(row, positions):
+    return tuple(u'{}'.format(row[i]) if i < len(row) else u''
+                 for i in positions)
+
+
+def _diff_blocks(old_row, new_row, row):
+    """(row, col, [values]) blocks for the runs of changed cells in a row"""
+    blocks = []
+    run = None
+    width = max(len(old_row), len(new_row))
+    for j in range(width):
+        old = old_row[j] if j < len(old_row) else ''
+        new = new_row[j] if j < len(new_row) else ''
+        if _same_cell(old, new):
+            run = None
+        elif run is None:
+            run = [row, j + 1, [[new]]]
+            blocks.append(run)
+        else:
+            run[2][0].append(new)
+    return [tuple(b) for b in blocks]
+
+
+def update_sheet(gc, data, title, sheetname, keys):
+    """
+    Keep a worksheet in sync with `data` by rewriting only the cells that
+    changed. Rows are matched on the `keys` columns, so a row keeps its place
+    in the sheet from one run to the next. Rows whose keys disappeared are
+    filled with new rows or with rows moved up from the bottom of the sheet,
+    remaining new rows are appended, and the sheet is resized to fit. All the
+    changed cells go out in one batch update.
+
+    If the worksheet doesn't exist, or its header differs from the columns
+    of `data`, it is (re)written in full with `write_to_sheets`.
+
+    Parameters
+    ----------
+    gc : gspread.authorize
+        google drive client
+    data : pd.DataFrame
+        must be unique on `keys`
+    title : str
+        sheets title
+    sheetname : str
+        the sheetname in the google sheet
+    keys : list of str
+        columns identifying a row, e.g. ['program', 'campaign', 'refer']
+
+    Returns
+    -------
+    dict
+        number of report rows 'added' and 'removed', of sheet 'rows' that
+        were rewritten and of 'cells' written
+    """
+    if data.duplicated(keys).any():
+        raise ValueError('data is not unique on {}'.format(keys))
+    new_values = frame_to_values(data)
+    header = new_values[0]
+    positions = [header.index(k) for k in keys]
+
+    wb = open_workbook(gc, title)
+    worksheets = dict((ws.title, ws) for ws in wb.worksheets())
+    old_values = []
+    if sheetname in worksheets:
+        old_values = batch_get_values(
+            wb, [sheetname],
+            params={'valueRenderOption': 'UNFORMATTED_VALUE'})[sheetname]
+    old_header = [u'{}'.format(h) for h in old_values[0]] if old_values else []
+    old_rows = old_values[1:]
+    old_index = dict((_row_key(r, positions), i + 2)
+                     for i, r in enumerate(old_rows))
+
+    if old_header != [u'{}'.format(h) for h in header] or \
+            len(old_index) != len(old_rows):
+        if sheetname in worksheets:
+            wb.del_worksheet(worksheets[sheetname])
+        write_to_sheets(gc, data, title, sheetname)
+        return {'added': len(data), 'removed': len(old_rows),
+                'rows': len(new_values), 'cells': len(new_values) * len(header)}
+
+    new_rows = dict((_row_key(r, positions), r) for r in new_values[1:])
+    # sheet row -> key of the report row that ends up there
+    placed = dict((row, key) for key, row in old_index.items()
+                  if key in new_rows)
+    holes = sorted(row for key, row in old_index.items()
+                   if key not in new_rows)
+    added = [_row_key(r, positions) for r in new_values[1:]
+             if _row_key(r, positions) not in old_index]
+    nrows = len(new_values)
+    last = len(old_rows) + 1
+    for key in added:
+        if holes:
+            placed[holes.pop(0)] = key
+        else:
+            last += 1
+            placed[last] = key
+    # move rows up from the bottom into the holes that are left
+    while holes:
+        hole = holes.pop(0)
+        if hole > nrows:
+            continue
+        bottom = max(placed)
+        placed[hole] = placed.pop(bottom)
+
+    blocks = []
+    rewritten = 0
+    for row, key in sorted(placed.items()):
+        old_row = old_rows[row - 2] if row <= len(old_rows) + 1 else []
+        row_blocks = _diff_blocks(old_row, new_rows[key], row)
+        rewritten += bool(row_blocks)
+        blocks.extend(row_blocks)
+
+    wks = worksheets[sheetname]
+    if nrows > wks.row_count:
+        wks.resize(rows=nrows)
+    if blocks:
+        batch_update_values(wb, wks, blocks)
+    if nrows < wks.row_count:
+        wks.resize(rows=nrows)
+    return {'added': len(added),
+            'removed': len(old_rows) + len(added) - len(data),
+            'rows': rewritten,
+            'cells': sum(len(values[0]) for _, _, values in blocks)}
+
+
+def compare_block_values(df):
+    """
+    Cell values for one block of the compare report: two header rows, where
+    'AOL'/'Keen' column names are split into a group label in the first row
+    and the rest of the name in the second, followed by the data.
+    """
+    groups, names = [], []
+    for col_name in df.columns:
+        if 'AOL' in col_name:
+            groups.append('AOL')
+            names.append(col_name.replace('AOL', ''))
+        elif 'Keen' in col_name:
+            groups.append('Keen')
+            names.append(col_name.replace('Keen', ''))
+        else:
+            groups.append('')
+            names.append(col_name)
+    return [groups, names] + frame_to_values(df, header=False)
 
 
 def write_df(wks, df, row, col):
-    """Write a pd.DataFrame to a google sheets sheet
+    """Write a pd.DataFrame to a google sheets sheet in one batched update
 
     Parameters
     ----------
@@ -104,46 +466,49 @@ def write_df(wks, df, row, col):
     col : int
         col to put first row of df (indexed from 0)
     """
-
-    # header row
-    for j, col_name in enumerate(df.columns):
-        if 'AOL' in col_name:
-            wks.update_cell(row+1, col+j+1, 'AOL')
-            wks.update_cell(row+2, col+j+1, col_name.replace('AOL', ''))
-        elif 'Keen' in col_name:
-            wks.update_cell(row+1, col+j+1, 'Keen')
-            wks.update_cell(row+2, col+j+1, col_name.replace('Keen', ''))
-        else:
-            wks.update_cell(row+2, col+j+1, col_name)
-    # data
-    for i, row_of_data in df.iterrows():
-        for j, col_name in enumerate(df.columns):
-            wks.update_cell(row+3+i, col+j+1, row_of_data[j])
+    update_values(wks.spreadsheet, wks, compare_block_values(df),
+                  row=row + 1, col=col + 1)
 
 
 def create_compare_report(gc, data, title, sheetname, blank_cols=None):
+    """
+    Write several frames one below the other on a new sheet, each with the
+    split AOL/Keen header rows of `compare_block_values` and a blank row
+    between blocks. The layout is built in memory first so the sheet is
+    created at its final size and each block is a single batched update.
 
-    cols = max(len(data[0].columns), len(data[1].columns))
-    rows = len(data[0]) + len(data[1]) + 3 + 2 # 2 additonal rows to split out the header columns
-
-    wb = gc.open(title)
-    wb.add_worksheet(title=sheetname, rows=rows, cols=cols)
-    wks = wb.worksheet(sheetname)
-
+    Parameters
+    ----------
+    gc : gspread.authorize
+        google drive client
+    data : list of pd.DataFrame
+    title : str
+        sheets title
+    sheetname : str
+        the sheetname in the google sheet
+    blank_cols : list of int
+        number of blank columns to the left of each block
+    """
+    layout = []
     current_row = 0
     for i, d in enumerate(data):
+        col = blank_cols[i] if blank_cols else 0
+        layout.append((current_row, col, compare_block_values(d)))
+        current_row += len(d) + 2 + 1
 
-        if blank_cols:
-            col = blank_cols[i]
-        else:
-            col = 0
+    rows = max(current_row, 1)
+    cols = max([col + len(d.columns) for (_, col, _), d in zip(layout, data)] + [1])
 
-        write_df(wks, d, row=current_row, col=col)
-        current_row += len(d) + 2 + 1
+    wb = open_workbook(gc, title)
+    wb.add_worksheet(title=sheetname, rows=rows, cols=cols)
+    wks = wb.worksheet(sheetname)
+
+    for row, col, values in layout:
+        update_values(wb, wks, values, row=row + 1, col=col + 1)
 
 
 def delete_sheet(gc, title, sheetname):
-    wb = gc.open(title)
+    wb = open_workbook(gc, title)
     worksheets = wb.worksheets()
     for ws in worksheets:
         if ws.title == sheetname:
@@ -167,7 +532,7 @@ def clean_sheets(gc, title, max_sheets):
     max_sheets : str
         the maximum number of sheets to keep in the workbook
     """
-    wb = gc.open(title)
+    wb = open_workbook(gc, title)
     worksheets = wb.worksheets()
 
     if len(worksheets) <= max_sheets:
@@ -0,0 +1,305 @@
+"""
+A background queue for google sheets writes, so reports can be computed while
+earlier ones are being published.
+
+    queue = SheetsWriteQueue(gc)
+    queue.write(report, title, sheetname)
+    ...  # compute the next report
+    queue.clean(title, max_sheets=20)
+    queue.flush()
+
+Jobs run one at a time in submission order on a worker thread, with every
+api request paced by token buckets matched to google's per-user read and
+write quotas and retried with backoff on 429s and server errors. A 401 from
+an access token that expired during a long run authorizes the client again
+with its `login` and is retried once. The quota
+is per user, so the report's own reads go through the same paced client,
+`queue.gc`, and its requests are made one at a time, from either thread.
+"""
+import threading
+from collections import deque
+from time import sleep
+
+from sheets import (write_to_sheets, create_compare_report, update_sheet,
+                    delete_sheet, clean_sheets, error_status)
+from throttle import RETRY_STATUSES, TokenBucket, backoff_delay
+
+
+QUOTA_PER_MINUTE = 60 # google's read and write request limits per user
+BURST = 6
+# a full bucket plus a minute of refill stays within the quota
+REQUESTS_PER_SECOND = (QUOTA_PER_MINUTE - BURST) / 60.0
+MAX_RETRIES = 6
+
+WRITE_METHODS = frozenset([
+    'add_worksheet', 'del_worksheet', 'duplicate_sheet', 'batch_update',
+    'values_update', 'values_append', 'values_clear', 'values_batch_update',
+    'update_cells', 'update_cell', 'update_acell', 'insert_row', 'append_row',
+    'delete_row', 'add_rows', 'add_cols', 'resize', 'update_title', 'clear'])
+
+
+class PublishTimeout(Exception):
+    pass
+
+
+class PacedSheetsClient(object):
+    """
+    Wraps a gspread client, spreadsheet or worksheet so that every api
+    request waits for a token from the read or write bucket and is retried
+    with exponential backoff when google answers with a 429 or a 5xx. On a
+    401 `refresh` is called, e.g. the gspread client's login, and the request
+    is tried again once. Requests are made one at a time under `lock`, so
+    threads can share the client. Spreadsheets and worksheets it returns are
+    wrapped the same way.
+    """
+
+    def __init__(self, target, buckets, stats, max_retries=MAX_RETRIES,
+                 lock=None, refresh=None):
+        self._target = target
+        self._buckets = buckets
+        self._stats = stats
+        self._max_retries = max_retries
+        self._lock = lock or threading.Lock()
+        self._refresh = refresh
+
+    def _wrap(self, value):
+        if isinstance(value, list):
+            return [self._wrap(v) for v in value]
+        if hasattr(value, 'worksheets') or hasattr(value, 'get_all_values'):
+            return PacedSheetsClient(value, self._buckets, self._stats,
+                                     self._max_retries, self._lock,
+                                     self._refresh)
+        return value
+
+    def _request(self, name, method, args, kwargs):
+        bucket = self._buckets['write' if name in WRITE_METHODS else 'read']
+        args = [getattr(a, '_target', a) for a in args]
+        attempt = 0
+        refreshed = False
+        while True:
+            self._stats.bump('throttled_seconds', bucket.acquire())
+            self._stats.bump('requests')
+            try:
+                with self._lock:
+                    return method(*args, **kwargs)
+            except Exception as e:
+                if error_status(e) == 401 and self._refresh is not None and \
+                        not refreshed:
+                    with self._lock:
+                        self._refresh()
+                    self._stats.bump('reauthorized')
+                    refreshed = True
+                    continue
+                if error_status(e) not in RETRY_STATUSES or \
+                        attempt >= self._max_retries:
+                    raise
+            self._stats.bump('retries')
+            sleep(backoff_delay(attempt))
+            attempt += 1
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return self._wrap(value)
+
+        def request(*args, **kwargs):
+            return self._wrap(self._request(name, value, args, kwargs))
+        return request
+
+
+class _Stats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'submitted': 0, 'done': 0, 'failed': 0,
+                       'coalesced': 0, 'requests': 0, 'retries': 0,
+                       'reauthorized': 0, 'throttled_seconds': 0.0}
+
+    def bump(self, name, value=1):
+        with self._lock:
+            self.counts[name] += value
+
+    def get(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+class PublishJob(object):
+    """Handle for a queued write. `wait` blocks until it has run."""
+
+    def __init__(self, func, args, kwargs, key=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+        self._replaced_by = None
+
+    def __repr__(self):
+        return '<PublishJob {} {}>'.format(self.func.__name__, self.key or '')
+
+    def done(self):
+        if self._replaced_by is not None:
+            return self._replaced_by.done()
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the job has run and return its result, re-raising its
+        error if it failed
+
+        Raises
+        ------
+        PublishTimeout
+            if `timeout` seconds pass first
+        """
+        if self._replaced_by is not None:
+            return self._replaced_by.wait(timeout)
+        if not self._done.wait(timeout):
+            raise PublishTimeout('{} still pending after {}s'.format(self,
+                                                                     timeout))
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def _finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self._done.set()
+
+
+class SheetsWriteQueue(object):
+    """
+    Publishes sheets jobs (write_to_sheets, create_compare_report,
+    update_sheet, delete_sheet, clean_sheets) on a background thread.
+
+    Jobs run in submission order. A job with the same coalescing key as one
+    still waiting to run replaces it: repeated clean_sheets of a workbook,
+    delete_sheet of the same worksheet and update_sheet of the same
+    worksheet (the latest data wins) run once. The replaced job's handle
+    resolves with the new job. Data frames are read when the job runs, so
+    don't modify them until then.
+
+    `gc` is the paced client the jobs use. Read through it too, so reads
+    count against the same quota.
+
+    Parameters
+    ----------
+    gc : gspread.authorize
+        google drive client
+    rate : float
+        read and write requests per second, each
+    burst : int
+        requests that can be made at once before pacing starts
+    max_retries : int
+        retries of one api request on 429s and 5xxs
+    """
+
+    def __init__(self, gc, rate=REQUESTS_PER_SECOND, burst=BURST,
+                 max_retries=MAX_RETRIES):
+        self._stats = _Stats()
+        buckets = {'read': TokenBucket(rate, burst),
+                   'write': TokenBucket(rate, burst)}
+        self.gc = PacedSheetsClient(gc, buckets, self._stats, max_retries,
+                                    refresh=getattr(gc, 'login', None))
+        self._pending = deque()
+        self._jobs = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(gc, *args, **kwargs). A `key` keyword coalesces the job
+        with a pending one of the same key.
+
+        Returns
+        -------
+        PublishJob
+        """
+        key = kwargs.pop('key', None)
+        job = PublishJob(func, args, kwargs, key)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('queue is closed')
+            if key is not None:
+                for old in list(self._pending):
+                    if old.key == key:
+                        self._pending.remove(old)
+                        old._replaced_by = job
+                        self._stats.bump('coalesced')
+            self._pending.append(job)
+            self._jobs.append(job)
+            self._stats.bump('submitted')
+            self._cond.notify()
+        return job
+
+    def write(self, data, title, sheetname):
+        return self.submit(write_to_sheets, data, title, sheetname)
+
+    def compare_report(self, data, title, sheetname, blank_cols=None):
+        return self.submit(create_compare_report, data, title, sheetname,
+                           blank_cols)
+
+    def update(self, data, title, sheetname, keys):
+        return self.submit(update_sheet, data, title, sheetname, keys,
+                           key=('update_sheet', title, sheetname))
+
+    def delete(self, title, sheetname):
+        return self.submit(delete_sheet, title, sheetname,
+                           key=('delete_sheet', title, sheetname))
+
+    def clean(self, title, max_sheets):
+        return self.submit(clean_sheets, title, max_sheets,
+                           key=('clean_sheets', title))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                job = self._pending.popleft()
+            try:
+                result = job.func(self.gc, *job.args, **job.kwargs)
+            except Exception as e:
+                self._stats.bump('failed')
+                job._finish(error=e)
+            else:
+                self._stats.bump('done')
+                job._finish(result)
+
+    def flush(self, timeout=None):
+        """Wait for every job submitted so far. Re-raises the first error of
+        a failed job, after all of them have run."""
+        with self._cond:
+            jobs = list(self._jobs)
+            self._jobs = []
+        errors = []
+        for job in jobs:
+            try:
+                job.wait(timeout)
+            except PublishTimeout:
+                raise
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    def close(self, timeout=None):
+        """Flush and stop the worker thread"""
+        try:
+            self.flush(timeout)
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify()
+            self._thread.join(timeout)
+
+    def stats(self):
+        """Jobs submitted/done/failed/coalesced, api requests, retries,
+        re-authorizations and seconds spent waiting for quota"""
+        return self._stats.get()
@@ -0,0 +1,64 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from alert_engine import CompiledRule, compile_rules
+from offline_sheets import get_alert_rules_sample
+
+
+def _report():
+    rng = np.random.RandomState(0)
+    n = 200
+    data = pd.DataFrame({
+        'campaign': ['campaign-%d' % i for i in range(n)],
+        'a': rng.randint(0, 10, n), 'b': rng.randint(0, 10, n),
+        'playerload': rng.randint(0, 2000, n),
+        'prerollplay': rng.randint(0, 500, n),
+        'errorpage': rng.randint(0, 20, n)})
+    data['preroll/playerload'] = data['prerollplay'] / data['playerload']
+    return data
+
+
+def _pandas(formula, data):
+    return np.asarray(pd.eval(formula, local_dict={'data': data}), dtype=bool)
+
+
+class TestParityWithPandasEval(unittest.TestCase):
+
+    formulas = [
+        'data["a"] > 1 & data["b"] < 2',
+        'data["a"] > 1 | data["b"] < 2 & data["a"] < 8',
+        '(data["a"] > 1) & (data["b"] < 2)',
+        'data["a"] + data["b"] > 5 & data["a"] * 2 <= data["b"]',
+        '~(data["a"] > 3) | data["b"] == 4',
+        'data["a"] > 1 and data["b"] < 2 or data["a"] == 0',
+        '(data["playerload"] > 1000) & (data["errorpage"] > 5)']
+
+    def assert_parity(self, formula, data):
+        rule = CompiledRule('rule', formula)
+        columns = dict((c, data[c].values) for c in rule.columns)
+        np.testing.assert_array_equal(rule.evaluate(columns),
+                                      _pandas(formula, data), formula)
+
+    def test_reported_case(self):
+        data = pd.DataFrame({'a': [5, 0, 5], 'b': [1, 1, 9]})
+        rule = CompiledRule('rule', 'data["a"] > 1 & data["b"] < 2')
+        columns = dict((c, data[c].values) for c in rule.columns)
+        self.assertEqual(rule.evaluate(columns).tolist(), [True, False, False])
+
+    def test_formulas(self):
+        data = _report()
+        for formula in self.formulas:
+            self.assert_parity(formula, data)
+
+    def test_rule_sheet(self):
+        data = _report()
+        rules = get_alert_rules_sample()
+        self.assertEqual(len(compile_rules(rules)), len(rules))
+        for formula in rules['formula']:
+            self.assert_parity(formula, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
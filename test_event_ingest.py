@@ -0,0 +1,100 @@
+import json
+import unittest
+from time import sleep
+
+try:
+    from urllib2 import Request, urlopen, HTTPError
+except ImportError:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+
+from event_ingest import EventCounters, serve_ingest
+from run_alerts import apply_alert_rules, get_alert_exclusions, \
+    get_alert_rules
+from run_bw_video_keen import get_filters, get_keen_report
+
+FILTERED_PLAYER = '35c29464-50f0-4e82-a1db-a7a328d24c58'
+
+
+def _post(url, body):
+    request = Request(url, json.dumps(body).encode('utf8'),
+                      {'Content-Type': 'application/json'})
+    return json.loads(urlopen(request).read().decode('utf8'))
+
+
+def _events(campaign, n, playerid='player-1'):
+    return [{'program': 'aol', 'campaign': campaign, 'refer': 'en',
+             'playerid': playerid} for _ in range(n)]
+
+
+class TestLivePath(unittest.TestCase):
+
+    def setUp(self):
+        self.server = serve_ingest(EventCounters(
+            filters=get_filters(None, offline=True), flush_interval=0.01))
+        self.counters = self.server.counters
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.counters.stop()
+
+    def post(self, body):
+        _post(self.server.base_url + '/3.0/projects/p/events', body)
+
+    def flush(self):
+        for _ in range(200):
+            if not self.counters.stats()['pending']:
+                break
+            sleep(0.01)
+        sleep(0.05)
+
+    def test_alerts_from_posted_events(self):
+        self.post({
+            'playerload': _events('broken', 1500) + _events('ok', 100) +
+            _events('low-fill', 100),
+            'prerollplay': _events('ok', 50) + _events('low-fill', 10),
+            'pageviewevent': _events('ok', 10)})
+        # the FILTERS sheet leaves out this player's events
+        self.post({'playerload': _events('ok', 5000, FILTERED_PLAYER)})
+        self.flush()
+        self.assertEqual(self.counters.stats()['filtered'], 5000)
+
+        report = get_keen_report(self.counters, None, 'previous_5_minutes',
+                                 'US/Pacific', offline=True)
+        report = report.set_index('campaign')
+        self.assertEqual(report.loc['broken', 'playerload'], 1500)
+        self.assertEqual(report.loc['ok', 'playerload'], 100)
+        self.assertEqual(report.loc['ok', 'preroll/playerload'], 0.5)
+
+        alerts = apply_alert_rules(report.reset_index(),
+                                   get_alert_rules(None, offline=True),
+                                   get_alert_exclusions(None, offline=True))
+        self.assertEqual(sorted(alerts),
+                         [('broken-player-alert', ['broken']),
+                          ('no-fill-alert', ['low-fill'])])
+
+    def test_bad_events_dont_stop_counting(self):
+        with self.assertRaises(HTTPError) as raised:
+            self.post({'playerload': 5})
+        self.assertEqual(raised.exception.code, 400)
+        self.post({'playerload': [{'program': 'aol', 'campaign': ['x'],
+                                   'refer': 'en'}]})
+        with self.assertRaises(ValueError):
+            self.counters.add('playerload', 5)
+
+        self.post({'playerload': _events('ok', 10)})
+        self.flush()
+        self.assertEqual(self.counters.stats()['counted'], 11)
+        self.assertEqual(self.counters.count('playerload',
+                                             'previous_5_minutes'), 11)
+
+    def test_filter_not_applied_at_ingest(self):
+        with self.assertRaises(ValueError):
+            self.counters.count('playerload', 'previous_5_minutes',
+                                filters=[{'property_name': 'playerid',
+                                          'operator': 'eq',
+                                          'property_value': 'x'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
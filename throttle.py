@@ -0,0 +1,103 @@
+import random
+import threading
+from contextlib import contextmanager
+from time import sleep, time
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket rate limiter
+
+    Parameters
+    ----------
+    rate : float
+        tokens added per second
+    capacity : float
+        maximum burst size, defaults to `rate`
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time()
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` are available. Returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(time())
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    self.waited += waited
+                    return waited
+                wait = (tokens - self.tokens) / self.rate
+            sleep(wait)
+            waited += wait
+
+    def drain(self, seconds):
+        """Take the bucket empty for `seconds`, e.g. after the server asked
+        us to back off"""
+        with self._lock:
+            self._refill(time())
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+# http statuses worth retrying: rate limited or a server error
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """Exponential backoff with full jitter for retry `attempt` (from 0)"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after_seconds(value):
+    """Seconds from a Retry-After header, or None if it is missing or an
+    http-date"""
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+_local = threading.local()
+
+
+def current_deadline():
+    """Unix time the work on this thread has to finish by, or None"""
+    return getattr(_local, 'deadline', None)
+
+
+@contextmanager
+def deadline(at):
+    """Set the deadline of this thread's work, see `current_deadline`. A
+    deadline already set that is earlier is kept."""
+    previous = current_deadline()
+    if previous is not None:
+        at = previous if at is None else min(at, previous)
+    _local.deadline = at
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def carry_deadline(func):
+    """`func` run under the calling thread's deadline, for work handed to
+    another thread"""
+    at = current_deadline()
+    if at is None:
+        return func
+
+    def call(*args, **kwargs):
+        with deadline(at):
+            return func(*args, **kwargs)
+    return call